@@ -1,9 +1,10 @@
+import json
 import logging
-import secrets
+import os
+import tempfile
 from flask import Flask
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 def create_app():
@@ -11,7 +12,154 @@ def create_app():
     Application factory function
     """
     app = Flask(__name__)
-    app.secret_key = secrets.token_hex(16)  # Generate a random secret key for sessions
+    
+    # Database settings, overridable through NOTES_* environment variables
+    app.config.from_mapping(
+        DB_BACKEND="memory",
+        DB_PATH="notes.db",
+        DB_POOL_SIZE=5,
+        DB_DATA_DIR=None,
+        DB_WAL_FSYNC="interval",
+        DB_WAL_FSYNC_INTERVAL=1.0,
+        DB_SNAPSHOT_INTERVAL=300,
+        DB_SNAPSHOT_BYTES=64 * 1024 * 1024,
+        DB_BLOB_THRESHOLD=64 * 1024,
+        CACHE_MAX_ENTRIES=10000,
+        CACHE_MAX_BYTES=64 * 1024 * 1024,
+        FRAGMENT_CACHE_MAX_ENTRIES=100000,
+        FRAGMENT_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        JSON_PROVIDER="auto",
+        SECRET_KEY=None,
+        TOKEN_TTL=24 * 60 * 60,
+        TOKEN_CACHE_MAX_ENTRIES=10000,
+        RATE_LIMIT_ENABLED=True,
+        RATE_LIMIT_USER_RATE=50,
+        RATE_LIMIT_USER_BURST=100,
+        RATE_LIMIT_CLIENT_RATE=200,
+        RATE_LIMIT_CLIENT_BURST=400,
+        RATE_LIMIT_COSTS={},
+        RATE_LIMIT_MAX_BUCKETS=100000,
+        RATE_LIMIT_IDLE_TIMEOUT=300,
+        CHANGES_CAPACITY=10000,
+        CHANGES_MAX_WAITERS=4,
+        CHANGES_POLL_TIMEOUT=30,
+        CHANGES_STREAM_TIMEOUT=300,
+        CHANGES_HEARTBEAT=15,
+        PROFILE_SAMPLE_RATE=0.0,
+        PROFILE_SLOW_THRESHOLD=0,
+        PROFILE_SAMPLE_INTERVAL=0.01,
+        PROFILE_DIR=None,
+        PROFILE_MAX_FILES=100,
+        DELETE_CHUNK_SIZE=500,
+        DELETE_CHUNK_PAUSE=0.01,
+        HOST="0.0.0.0",
+        PORT=12001,
+        WORKERS=1,
+        THREADS=8,
+        LOG_LEVEL="INFO",
+        LOG_FORMAT="text",
+        LOG_FILE=None,
+        LOG_QUEUE_SIZE=10000,
+        LOG_SAMPLING={}
+    )
+    app.config.from_prefixed_env("NOTES")
+    
+    from app.log import configure_logging
+    sampling = app.config["LOG_SAMPLING"]
+    configure_logging(
+        level=app.config["LOG_LEVEL"],
+        fmt=app.config["LOG_FORMAT"],
+        sampling=json.loads(sampling) if isinstance(sampling, str) else sampling,
+        log_file=app.config["LOG_FILE"],
+        queue_size=app.config["LOG_QUEUE_SIZE"]
+    )
+    
+    from app.encoding import json_provider
+    app.json = json_provider(app.config["JSON_PROVIDER"])(app)
+    
+    from app import db, metrics
+    db.init_db(
+        app.config["DB_BACKEND"],
+        app.config["DB_PATH"],
+        app.config["DB_POOL_SIZE"],
+        data_dir=app.config["DB_DATA_DIR"],
+        fsync=app.config["DB_WAL_FSYNC"],
+        fsync_interval=app.config["DB_WAL_FSYNC_INTERVAL"],
+        snapshot_interval=app.config["DB_SNAPSHOT_INTERVAL"],
+        snapshot_bytes=app.config["DB_SNAPSHOT_BYTES"],
+        blob_threshold=app.config["DB_BLOB_THRESHOLD"]
+    )
+    metrics.instrument_store(db.store, db.backend)
+    
+    # Sessions and token hashes are signed with a key every worker shares:
+    # NOTES_SECRET_KEY if set, else one generated once and kept in the store
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = db.store.secret_key
+    from app import auth
+    auth.tokens.configure(app.config["SECRET_KEY"], app.config["TOKEN_TTL"], app.config["TOKEN_CACHE_MAX_ENTRIES"])
+    
+    # Keep the search index and response cache in step with every note change
+    from app import cache, crud, search
+    if app.config["DB_BACKEND"] == "memory":
+        # Owners are indexed on their first search, so a store restored
+        # from disk does not wait for every note to be tokenized
+        search.index.reset(crud.NoteRepo.by_owner)
+        crud.subscribe(search.index.handle)
+    else:
+        # SQLite maintains its own full-text index
+        crud.unsubscribe(search.index.handle)
+        search.index.reset()
+    cache.responses.configure(app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_MAX_BYTES"])
+    cache.responses.clear()
+    crud.subscribe(cache.responses.handle)
+    cache.fragments.configure(app.config["FRAGMENT_CACHE_MAX_ENTRIES"], app.config["FRAGMENT_CACHE_MAX_BYTES"])
+    cache.fragments.clear()
+    crud.subscribe(cache.fragments.handle)
+    cache.summaries.configure(app.config["FRAGMENT_CACHE_MAX_ENTRIES"], app.config["FRAGMENT_CACHE_MAX_BYTES"])
+    cache.summaries.clear()
+    crud.subscribe(cache.summaries.handle)
+    
+    # Per-owner change feed, read by long polls and event streams; in the
+    # database with SQLite, which several worker processes may share
+    from app import changes
+    changes.init_feed(
+        shared=app.config["DB_BACKEND"] == "sqlite",
+        capacity=app.config["CHANGES_CAPACITY"],
+        max_waiters=app.config["CHANGES_MAX_WAITERS"],
+        poll_timeout=app.config["CHANGES_POLL_TIMEOUT"],
+        stream_timeout=app.config["CHANGES_STREAM_TIMEOUT"],
+        heartbeat=app.config["CHANGES_HEARTBEAT"]
+    )
+    
+    from app import ratelimit
+    costs = app.config["RATE_LIMIT_COSTS"]
+    ratelimit.admission.configure(
+        enabled=app.config["RATE_LIMIT_ENABLED"],
+        user_rate=app.config["RATE_LIMIT_USER_RATE"],
+        user_burst=app.config["RATE_LIMIT_USER_BURST"],
+        client_rate=app.config["RATE_LIMIT_CLIENT_RATE"],
+        client_burst=app.config["RATE_LIMIT_CLIENT_BURST"],
+        costs=json.loads(costs) if isinstance(costs, str) else costs,
+        max_buckets=app.config["RATE_LIMIT_MAX_BUCKETS"],
+        idle_timeout=app.config["RATE_LIMIT_IDLE_TIMEOUT"]
+    )
+    
+    # Opt-in request profiles, kept next to the data when it is on disk
+    from app import profiling
+    profile_dir = app.config["PROFILE_DIR"]
+    if profile_dir is None:
+        profile_dir = os.path.join(app.config["DB_DATA_DIR"] or tempfile.gettempdir(), "notes-profiles")
+    profiling.profiler.configure(
+        sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+        slow_threshold=app.config["PROFILE_SLOW_THRESHOLD"],
+        interval=app.config["PROFILE_SAMPLE_INTERVAL"],
+        directory=profile_dir,
+        max_files=app.config["PROFILE_MAX_FILES"]
+    )
+    
+    # Background jobs, started by the first request of each process
+    from app import jobs
+    jobs.runner.configure(app.config["DELETE_CHUNK_SIZE"], app.config["DELETE_CHUNK_PAUSE"])
     
     # Register routes
     from app.routes import register_routes
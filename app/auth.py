@@ -0,0 +1,158 @@
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from app.crud import TokenRepo, UserRepo
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps of expired tokens
+PURGE_INTERVAL = 300
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of token hash -> (user, expires_at)
+
+    Every entry was looked up under one value of the store's revocation
+    counter. When a request sees a different value (a token was revoked or a
+    user deleted, in this process or another one) the cache is emptied, so a
+    revoked token never outlives the request that revoked it.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    def configure(self, max_entries):
+        with self._lock:
+            self.max_entries = max_entries
+            self._evict()
+
+    def get(self, token_id, version, now):
+        """
+        Return the cached user for a token, or None on a miss
+        """
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self.flushes += 1
+                self._entries.clear()
+                self.version = version
+            entry = self._entries.get(token_id)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token_id, version, user, expires_at):
+        with self._lock:
+            # A revocation since the lookup started makes the result suspect
+            if version != self.version:
+                return
+            self._entries[token_id] = (user, expires_at)
+            self._entries.move_to_end(token_id)
+            self._evict()
+
+    def discard(self, token_id):
+        with self._lock:
+            self._entries.pop(token_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "flushes": self.flushes
+            }
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class TokenAuth:
+    """
+    Issues, checks and revokes bearer tokens
+
+    Tokens are random strings handed to the client once. The store only
+    keeps an HMAC of each token under the shared secret key, with its expiry,
+    so a copy of the database is not a copy of anyone's credentials.
+    """
+    def __init__(self):
+        self.secret_key = secrets.token_hex(32)
+        self.ttl = 86400
+        self.cache = TokenCache()
+        self._last_purge = 0.0
+
+    def configure(self, secret_key, ttl=86400, cache_entries=10000):
+        self.secret_key = secret_key
+        self.ttl = ttl
+        self.cache.configure(cache_entries)
+        self.cache.clear()
+
+    def hash(self, token):
+        return hmac.new(self.secret_key.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user):
+        """
+        Create a token for a user, returns (token, expires_at)
+        """
+        now = time.time()
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            purged = TokenRepo.delete_expired(now)
+            if purged:
+                logger.info("Removed %s expired tokens", purged)
+        token = secrets.token_urlsafe(32)
+        expires_at = now + self.ttl
+        TokenRepo.create(self.hash(token), user.id, expires_at)
+        return token, expires_at
+
+    def authenticate(self, token):
+        """
+        The user a token belongs to, or None if it is unknown, expired or revoked
+        """
+        token_id = self.hash(token)
+        now = time.time()
+        version = TokenRepo.auth_version()
+        user = self.cache.get(token_id, version, now)
+        if user is not None:
+            return user
+        record = TokenRepo.by_id(token_id, now)
+        if record is None:
+            return None
+        user = UserRepo.by_id(record.user_id)
+        if user is not None:
+            self.cache.put(token_id, version, user, record.expires_at)
+        return user
+
+    def revoke(self, token):
+        token_id = self.hash(token)
+        self.cache.discard(token_id)
+        return TokenRepo.delete(token_id)
+
+
+# Token authentication of the process
+tokens = TokenAuth()
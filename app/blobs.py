@@ -0,0 +1,294 @@
+import codecs
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import threading
+import weakref
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Characters of content shown in a note summary
+SNIPPET_LENGTH = 100
+# Bytes handed out per step when a blob is streamed
+CHUNK_SIZE = 64 * 1024
+
+
+def _blob_name(number):
+    return f"{number:016x}.blob"
+
+def _pieces(data, pieces):
+    """
+    Yield the bytes of pieces that are either bytes or a (start, end) range
+    of `data`, ranges at most CHUNK_SIZE at a time
+    """
+    for piece in pieces:
+        if piece.__class__ is tuple:
+            for offset in range(piece[0], piece[1], CHUNK_SIZE):
+                yield data[offset:min(offset + CHUNK_SIZE, piece[1])]
+        elif piece:
+            yield piece
+
+def _byte_offsets(data, positions):
+    """
+    UTF-8 byte offsets in `data` of ascending character `positions`, found
+    by decoding it a chunk at a time; raises IndexError for a position past
+    the end
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")("surrogatepass")
+    offsets = []
+    count = len(positions)
+    i = 0
+    chars = 0
+    start = 0
+    for offset in range(0, len(data), CHUNK_SIZE):
+        final = offset + CHUNK_SIZE >= len(data)
+        text = decoder.decode(data[offset:offset + CHUNK_SIZE], final)
+        end = len(data) if final else offset + CHUNK_SIZE - len(decoder.getstate()[0])
+        ascii = end - start == len(text)
+        while i < count and positions[i] <= chars + len(text):
+            k = positions[i] - chars
+            offsets.append(start + (k if ascii else len(text[:k].encode("utf-8", "surrogatepass"))))
+            i += 1
+        chars += len(text)
+        start = end
+    while i < count and positions[i] == chars:
+        offsets.append(start)
+        i += 1
+    if i < count:
+        raise IndexError(positions[i])
+    return offsets
+
+
+class Blob:
+    """
+    Handle on a note content kept out of line, in a file of its own
+
+    Only the size of the content in UTF-8 bytes and its first SNIPPET_LENGTH
+    characters are held in memory; the text is read from a memory map of the
+    file when asked for. Handles are immutable like the rows holding them,
+    and `key` is the form they are logged and snapshotted in.
+    """
+    __slots__ = ("store", "number", "size", "snippet", "__weakref__")
+
+    def __init__(self, store, number, size, snippet):
+        self.store = store
+        self.number = number
+        self.size = size
+        self.snippet = snippet
+
+    @property
+    def key(self):
+        return self.number, self.size, self.snippet
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Yield the UTF-8 bytes of the content, at most `chunk_size` at a time
+        """
+        if not self.size:
+            # An empty file cannot be mapped
+            return
+        with open(self.store.path(self.number), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset in range(0, len(data), chunk_size):
+                    yield data[offset:offset + chunk_size]
+
+    def read(self):
+        """
+        The whole content as a string
+        """
+        if not self.size:
+            return ""
+        with open(self.store.path(self.number), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return str(data, "utf-8", "surrogatepass")
+
+    def __repr__(self):
+        return f"Blob({self.number}, size={self.size})"
+
+
+class BlobStore:
+    """
+    Directory of note contents too large to keep in memory, one file each
+
+    A blob is written once and never changed; a note whose content changes
+    gets a new one. Files are named by a counter that carries on from the
+    highest name found in the directory. A file is removed once the last row
+    referring to its handle is gone, which is only known once readers that
+    still hold an older row are done with it too.
+
+    With `durable` set the directory belongs to a persistent store: a blob is
+    forced to disk before the write that refers to it is logged, and files of
+    dropped blobs are only removed by `remove` once a snapshot no longer
+    refers to them, since replaying the log may still need them. Otherwise
+    the directory is scratch space and is deleted on close.
+    """
+    def __init__(self, directory, threshold=64 * 1024, durable=False, fsync=True):
+        self.directory = directory
+        self.threshold = threshold
+        self.durable = durable
+        self.fsync = fsync
+        self.written = 0
+        self.removed = 0
+        self._dead = []
+        self._live = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        numbers = [int(name[:-5], 16) for name in os.listdir(directory) if name.endswith(".blob")]
+        self._next = max(numbers, default=0) + 1
+
+    def path(self, number):
+        return os.path.join(self.directory, _blob_name(number))
+
+    def put(self, text):
+        """
+        Write a content out of line and return its handle
+        """
+        data = text.encode("utf-8", "surrogatepass")
+        number = self._write((data,))
+        return self._track(Blob(self, number, len(data), text[:SNIPPET_LENGTH]))
+
+    def patch(self, blob, edits):
+        """
+        Write a new blob holding the content of `blob` with `edits` applied
+        and return its handle and the SHA-256 of the new content
+
+        Edits are (start, end, text) tuples in ascending order that replace
+        characters start to end of the old content with text. The unchanged
+        ranges go from the memory map of the old file to the new one a chunk
+        at a time, without being decoded. Raises IndexError if an edit
+        reaches past the end of the content.
+        """
+        positions = [position for start, end, text in edits for position in (start, end)]
+        with open(self.path(blob.number), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offsets = iter(_byte_offsets(data, positions))
+                # Ranges of the old content and encoded insertions, in order
+                pieces = []
+                previous = 0
+                for start, end, text in edits:
+                    pieces.append((previous, next(offsets)))
+                    pieces.append(text.encode("utf-8", "surrogatepass"))
+                    previous = next(offsets)
+                pieces.append((previous, len(data)))
+                digest = hashlib.sha256()
+                number = self._write(_pieces(data, pieces), digest)
+                size = 0
+                # Enough bytes for SNIPPET_LENGTH characters of any width
+                head = b""
+                for piece in pieces:
+                    if piece.__class__ is tuple:
+                        size += piece[1] - piece[0]
+                        piece = data[piece[0]:min(piece[1], piece[0] + SNIPPET_LENGTH * 4)]
+                    else:
+                        size += len(piece)
+                    if len(head) < SNIPPET_LENGTH * 4:
+                        head += piece[:SNIPPET_LENGTH * 4 - len(head)]
+        snippet = codecs.getincrementaldecoder("utf-8")("surrogatepass").decode(head)
+        return self._track(Blob(self, number, size, snippet[:SNIPPET_LENGTH])), digest.hexdigest()
+
+    def _write(self, pieces, digest=None):
+        """
+        Write a new blob file from an iterable of bytes, feeding them to
+        `digest` too if given, and return its number
+        """
+        with self._lock:
+            number = self._next
+            self._next += 1
+        fd = os.open(self.path(number), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            for piece in pieces:
+                if digest is not None:
+                    digest.update(piece)
+                view = memoryview(piece)
+                while view:
+                    view = view[os.write(fd, view):]
+            if self.durable and self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self.durable and self.fsync:
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.written += 1
+        return number
+
+    def open(self, key):
+        """
+        Handle of a blob from its logged `key`, shared with any live handle
+        """
+        blob = self._live.get(key[0])
+        if blob is None:
+            blob = self._track(Blob(self, *key))
+        return blob
+
+    def _track(self, blob):
+        self._live[blob.number] = blob
+        finalizer = weakref.finalize(blob, self._drop, blob.number)
+        # Files must outlive the process, whatever happens to the handles
+        finalizer.atexit = False
+        return blob
+
+    def _drop(self, number):
+        if self.durable:
+            with self._lock:
+                self._dead.append(number)
+        else:
+            self._unlink(number)
+
+    def _unlink(self, number):
+        try:
+            os.remove(self.path(number))
+            self.removed += 1
+        except FileNotFoundError:
+            pass
+
+    def dropped(self):
+        """
+        Take the blobs dropped so far, for `remove` once a snapshot is written
+        """
+        with self._lock:
+            dead, self._dead = self._dead, []
+        return dead
+
+    def remove(self, numbers):
+        """
+        Delete the files of blobs taken from `dropped`
+        """
+        for number in numbers:
+            if number not in self._live:
+                self._unlink(number)
+
+    def sweep(self):
+        """
+        Remove the files no loaded row refers to: blobs dropped before a crash,
+        or written for a change that never made it into the log
+        """
+        swept = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".blob") and int(name[:-5], 16) not in self._live:
+                os.remove(os.path.join(self.directory, name))
+                swept += 1
+        if swept:
+            logger.info("Removed %s unreferenced blobs from %s", swept, self.directory)
+        return swept
+
+    def close(self):
+        if not self.durable:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "threshold": self.threshold,
+            "durable": self.durable,
+            "live": len(self._live),
+            "written": self.written,
+            "removed": self.removed,
+            "pending_removal": len(self._dead)
+        }
@@ -0,0 +1,186 @@
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized response bodies, bounded by entries and bytes
+
+    Entries are stored with the ETag they were rendered for and are only
+    served while the caller's current ETag still matches, so a stale body can
+    never leak out even if an invalidation is missed. Each entry belongs to
+    an owner; change events drop every entry of the affected owner (and the
+    changed note) as soon as the write is committed.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._owners = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, max_entries, max_bytes):
+        """
+        Change the bounds, evicting entries if the cache is now too large
+        """
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key, etag):
+        """
+        Return the cached body for key if it was rendered for etag
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, etag, body, owner_id):
+        """
+        Cache a body; bodies larger than the whole byte budget are skipped
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (etag, body, owner_id)
+            self._owners.setdefault(owner_id, set()).add(key)
+            self._bytes += len(body)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._discard(key):
+                self.invalidations += 1
+
+    def invalidate_owner(self, owner_id):
+        """
+        Drop every entry belonging to an owner
+        """
+        with self._lock:
+            for key in list(self._owners.get(owner_id, ())):
+                if self._discard(key):
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self._bytes = 0
+
+    def handle(self, event, row):
+        """
+        Change listener, see crud.subscribe
+        """
+        if event == "user_deleted":
+            self.invalidate_owner(row.id)
+        else:
+            # Any note change alters its owner's listings as well
+            self.invalidate(("note", row.id))
+            self.invalidate_owner(row.owner_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= len(entry[1])
+        keys = self._owners.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._owners[entry[2]]
+        return True
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            self._discard(key)
+            self.evictions += 1
+
+
+class FragmentCache(ResponseCache):
+    """
+    Serialized JSON of single notes, spliced into list responses
+
+    Entries are keyed by note id and validated against the note version, so
+    the bytes of a note are reused by every listing it appears in until that
+    note changes. Only the changed note is dropped on a change.
+    """
+    def encode(self, notes, encode):
+        """
+        Return the JSON bytes of each note, encoding only the ones not cached
+        """
+        fragments = []
+        missing = []
+        with self._lock:
+            for position, note in enumerate(notes):
+                entry = self._entries.get(note.id)
+                if entry is not None and entry[0] == note.version:
+                    self._entries.move_to_end(note.id)
+                    fragments.append(entry[1])
+                else:
+                    fragments.append(None)
+                    missing.append(position)
+            self.hits += len(fragments) - len(missing)
+            self.misses += len(missing)
+
+        encoded = []
+        for position in missing:
+            # Cache under the version that was actually serialized
+            data = notes[position].to_dict()
+            fragments[position] = body = encode(data)
+            encoded.append((data["id"], data["version"], data["owner_id"], body))
+        if encoded:
+            with self._lock:
+                for note_id, version, owner_id, body in encoded:
+                    if len(body) <= self.max_bytes:
+                        self._discard(note_id)
+                        self._entries[note_id] = (version, body, owner_id)
+                        self._owners.setdefault(owner_id, set()).add(note_id)
+                        self._bytes += len(body)
+                self._evict()
+        return fragments
+
+    def handle(self, event, row):
+        """
+        Change listener, see crud.subscribe
+        """
+        if event == "user_deleted":
+            self.invalidate_owner(row.id)
+        elif event != "note_created":
+            self.invalidate(row.id)
+
+
+# Caches shared by the whole process
+responses = ResponseCache()
+fragments = FragmentCache()
+# Serialized JSON of note summaries, the same way
+summaries = FragmentCache()
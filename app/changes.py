@@ -0,0 +1,357 @@
+import bisect
+import logging
+import secrets
+import threading
+import time
+
+from app import crud, db
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class BaseChangeFeed:
+    """
+    What the change feeds have in common: their settings, cursors and the
+    admission and bookkeeping of waiting readers
+
+    Subclasses record the changes, and read and wait for them; see
+    ChangeFeed and SharedChangeFeed. At most `max_waiters` readers wait at
+    once, each of them holds a request thread while it does.
+
+    `poll_timeout` bounds how long a long-poll waits, `stream_timeout` how
+    long an event stream stays open; a stream sends a comment every
+    `heartbeat` seconds while nothing happens, which also finds out about
+    clients that went away.
+    """
+    def __init__(self, capacity=10000, max_waiters=4, poll_timeout=30, stream_timeout=300, heartbeat=15):
+        self.id = secrets.token_hex(4)
+        self.waiting = 0
+        self.resyncs = 0
+        self.closed = False
+        # owner_id -> [condition, readers waiting, what they wait for]
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._settings(capacity, max_waiters, poll_timeout, stream_timeout, heartbeat)
+
+    def _settings(self, capacity, max_waiters, poll_timeout, stream_timeout, heartbeat):
+        if capacity < 1:
+            raise ValueError(f"Change feed needs a capacity of at least 1, got {capacity}")
+        self.capacity = capacity
+        self.max_waiters = max_waiters
+        self.poll_timeout = poll_timeout
+        self.stream_timeout = stream_timeout
+        self.heartbeat = heartbeat
+
+    def cursor(self, seq=None):
+        """
+        Cursor of a position in this feed, the current one by default
+        """
+        return f"{self.id}-{self.last() if seq is None else seq}"
+
+    def position(self, cursor):
+        """
+        Sequence number of a cursor, or None if it is not a position this
+        feed can still read from
+        """
+        feed_id, _, seq = (cursor or "").rpartition("-")
+        if feed_id != self.id or not seq.isdigit():
+            self.resyncs += 1
+            return None
+        return int(seq)
+
+    def admit(self):
+        """
+        Take one of the `max_waiters` slots, False if they are all taken
+        """
+        with self._lock:
+            if self.closed or self.waiting >= self.max_waiters:
+                return False
+            self.waiting += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def _join(self, owner_id):
+        """
+        Count a reader among the waiters of an owner, under the lock
+        """
+        waiters = self._owners.get(owner_id)
+        if waiters is None:
+            waiters = self._owners[owner_id] = [threading.Condition(self._lock), 0, 0]
+        waiters[1] += 1
+        return waiters
+
+    def _leave(self, owner_id, waiters):
+        waiters[1] -= 1
+        if not waiters[1]:
+            del self._owners[owner_id]
+
+    def close(self):
+        """
+        Wake every waiting reader and refuse new ones, for shutdown
+        """
+        with self._lock:
+            self.closed = True
+            for waiters in self._owners.values():
+                waiters[0].notify_all()
+
+    def _stats(self, seq):
+        return {
+            "id": self.id,
+            "seq": seq,
+            "capacity": self.capacity,
+            "oldest": max(seq - self.capacity + 1, 1) if seq else None,
+            "waiting": self.waiting,
+            "max_waiters": self.max_waiters,
+            "owners_waiting": len(self._owners),
+            "resyncs": self.resyncs
+        }
+
+
+class ChangeFeed(BaseChangeFeed):
+    """
+    Ring buffer of the last `capacity` note changes, read per owner
+
+    Every change event (see crud.subscribe) gets the next sequence number
+    and is kept as (seq, owner_id, event, note_id, version) until `capacity`
+    newer ones have pushed it out. A reader passes the last sequence number
+    it has seen and gets the changes of one owner after it; a reader whose
+    position has already been pushed out must resync, since changes it never
+    saw are gone. Each owner's sequence numbers in the ring are indexed in
+    order, so a read finds its first change by bisection and only touches
+    the changes it returns.
+
+    Waiting readers sleep on a condition of their owner and are only woken
+    by that owner's changes, so an idle reader costs nothing until its
+    timeout.
+
+    Sequence numbers only mean something within one process; `id` is new
+    for every feed and is part of the cursors handed out, so a cursor from
+    another process or an earlier run is recognized and answered with a
+    resync. Worker processes sharing a database use SharedChangeFeed.
+    """
+    def __init__(self, capacity=10000, max_waiters=4, poll_timeout=30, stream_timeout=300, heartbeat=15):
+        super().__init__(capacity, max_waiters, poll_timeout, stream_timeout, heartbeat)
+        self.seq = 0
+        self._ring = [None] * capacity
+        # owner_id -> [sequence numbers of their changes in the ring, index
+        # of the first one still there]
+        self._index = {}
+
+    def configure(self, capacity=10000, max_waiters=4, poll_timeout=30, stream_timeout=300, heartbeat=15):
+        """
+        Change the settings, which starts a new feed: every cursor handed
+        out so far gets a resync
+        """
+        with self._lock:
+            self._settings(capacity, max_waiters, poll_timeout, stream_timeout, heartbeat)
+            self.id = secrets.token_hex(4)
+            self.seq = 0
+            self.closed = False
+            self._ring = [None] * capacity
+            self._index = {}
+            for waiters in self._owners.values():
+                waiters[0].notify_all()
+
+    def handle(self, event, row):
+        """
+        Change listener, see crud.subscribe
+        """
+        if event == "user_deleted":
+            self.append(row.id, event, None, None)
+        else:
+            self.append(row.owner_id, event, row.id, row.version)
+
+    def append(self, owner_id, event, note_id, version):
+        with self._lock:
+            self.seq += 1
+            slot = self.seq % self.capacity
+            pushed_out = self._ring[slot]
+            if pushed_out is not None:
+                # The oldest change in the ring is the oldest of its owner
+                entry = self._index[pushed_out[1]]
+                entry[1] += 1
+                if entry[1] == len(entry[0]):
+                    del self._index[pushed_out[1]]
+                elif entry[1] * 2 > len(entry[0]):
+                    del entry[0][:entry[1]]
+                    entry[1] = 0
+            self._ring[slot] = (self.seq, owner_id, event, note_id, version)
+            entry = self._index.get(owner_id)
+            if entry is None:
+                entry = self._index[owner_id] = [[], 0]
+            entry[0].append(self.seq)
+            waiters = self._owners.get(owner_id)
+            if waiters is not None:
+                waiters[2] = self.seq
+                waiters[0].notify_all()
+
+    def last(self):
+        """
+        Sequence number of the latest change
+        """
+        return self.seq
+
+    def position(self, cursor):
+        seq = super().position(cursor)
+        if seq is not None and not self.seq - min(self.seq, self.capacity) <= seq <= self.seq:
+            self.resyncs += 1
+            return None
+        return seq
+
+    def read(self, owner_id, since, limit=1000):
+        """
+        Up to `limit` changes of an owner after `since`, and the position to
+        read on from; None if `since` has been pushed out meanwhile
+        """
+        with self._lock:
+            seq = self.seq
+            if not seq - min(seq, self.capacity) <= since <= seq:
+                self.resyncs += 1
+                return None
+            entry = self._index.get(owner_id)
+            if entry is None:
+                return [], seq
+            seqs, first = entry
+            start = bisect.bisect_right(seqs, since, first)
+            ring = self._ring
+            capacity = self.capacity
+            changes = [ring[position % capacity] for position in seqs[start:start + limit]]
+            if len(changes) == limit:
+                return changes, changes[-1][0]
+            return changes, seq
+
+    def wait(self, owner_id, since, timeout):
+        """
+        Block until the owner has a change after `since`, the feed is closed
+        or `timeout` seconds have passed; True unless it timed out
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if since < self.seq - self.capacity:
+                return True
+            waiters = self._join(owner_id)
+            # Changes made since the caller last read are not waited for
+            entry = self._index.get(owner_id)
+            if entry is not None:
+                waiters[2] = max(waiters[2], entry[0][-1])
+            feed_id = self.id
+            try:
+                while waiters[2] <= since and not self.closed and self.id == feed_id:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    waiters[0].wait(remaining)
+                return True
+            finally:
+                self._leave(owner_id, waiters)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats(self.seq), shared=False)
+
+
+class SharedChangeFeed(BaseChangeFeed):
+    """
+    Change feed kept in the database, read alike by every worker process
+
+    A feed in memory only sees the writes of its own process. With the
+    SQLite backend, triggers record every change in a `changes` table
+    instead (see db.CHANGES_SCHEMA), which keeps the last `capacity` of
+    them, and `id` is the database's epoch; so a cursor handed out by one
+    worker reads on at any other.
+
+    Waiting readers are woken at once by the changes of their own process
+    and look for those of other processes every `poll_interval` seconds.
+    """
+    def __init__(self, capacity=10000, max_waiters=4, poll_timeout=30, stream_timeout=300, heartbeat=15,
+                 poll_interval=0.5):
+        super().__init__(capacity, max_waiters, poll_timeout, stream_timeout, heartbeat)
+        self.poll_interval = poll_interval
+
+    def configure(self, capacity=10000, max_waiters=4, poll_timeout=30, stream_timeout=300, heartbeat=15,
+                  poll_interval=0.5):
+        with self._lock:
+            self._settings(capacity, max_waiters, poll_timeout, stream_timeout, heartbeat)
+            self.id = db.store.epoch
+            self.poll_interval = poll_interval
+            self.closed = False
+        crud.ChangeRepo.keep(capacity)
+
+    def handle(self, event, row):
+        """
+        Change listener, wakes the readers of the owner; the change itself
+        is recorded by the database
+        """
+        owner_id = row.id if event == "user_deleted" else row.owner_id
+        with self._lock:
+            waiters = self._owners.get(owner_id)
+            if waiters is not None:
+                waiters[2] += 1
+                waiters[0].notify_all()
+
+    def last(self):
+        return crud.ChangeRepo.last()
+
+    def read(self, owner_id, since, limit=1000):
+        changes, last, oldest = crud.ChangeRepo.after(owner_id, since, limit)
+        if since > last or (oldest is not None and since < oldest - 1):
+            self.resyncs += 1
+            return None
+        if len(changes) == limit:
+            return changes, changes[-1][0]
+        return changes, last
+
+    def wait(self, owner_id, since, timeout):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            # Waits for the count of the owner's changes seen here to move
+            waiters = self._join(owner_id)
+        try:
+            while True:
+                with self._lock:
+                    if self.closed:
+                        return True
+                    noticed = waiters[2]
+                # A position pushed out meanwhile is reported as a change,
+                # the reader finds out by reading
+                result = self.read(owner_id, since, 1)
+                if result is None or result[0]:
+                    return True
+                with self._lock:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    # Changes made here since the read are not waited for
+                    if waiters[2] == noticed and not self.closed:
+                        waiters[0].wait(min(remaining, self.poll_interval))
+        finally:
+            with self._lock:
+                self._leave(owner_id, waiters)
+
+    def stats(self):
+        last = self.last()
+        with self._lock:
+            return dict(self._stats(last), shared=True, poll_interval=self.poll_interval)
+
+
+def init_feed(shared=False, **settings):
+    """
+    Replace the change feed of the process: a SharedChangeFeed if `shared`,
+    for a database several processes use, else one in memory. Readers of
+    the old feed are woken and find their cursors gone.
+    """
+    global feed
+    old = feed
+    feed = SharedChangeFeed() if shared else ChangeFeed()
+    feed.configure(**settings)
+    crud.unsubscribe(old.handle)
+    old.close()
+    crud.subscribe(feed.handle)
+
+
+# Change feed of the process
+feed = ChangeFeed()
@@ -1,111 +1,458 @@
+import datetime
+import functools
 import logging
-from app.db import mock_users, mock_notes
+import re
+import secrets
+import time
+from app import db, metrics
+from app.db import get_db_connection, close_db_connection, VersionConflict, DuplicateUser, InvalidEdit
+from app.models import User, Note, Job, Token
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def query_db(query, args=(), one=False):
+# Callables notified as listener(event, row) after every committed change.
+# Events are note_created, note_updated, note_deleted and user_deleted; row is
+# the note or user as it is after the change (before it, for deletions). A
+# user deleted in the background is reported once, when it is hidden; the
+# notes reclaimed afterwards are not reported one by one.
+_listeners = []
+
+def subscribe(listener):
+    """
+    Register a listener for change events, registering twice is a no-op
     """
-    Mock function to simulate database queries
-    """
-    logger.info(f"Executing query: {query} with args: {args}")
-    
-    # Mock implementation for different query types
-    if "SELECT * FROM users WHERE" in query:
-        if "email" in query:
-            email = args[0]
-            user = next((u for u in mock_users if u["email"] == email), None)
-            return user if one else [user] if user else []
-        elif "name" in query:
-            name = args[0]
-            user = next((u for u in mock_users if u["name"] == name), None)
-            return user if one else [user] if user else []
-        elif "id" in query:
-            user_id = args[0]
-            user = next((u for u in mock_users if u["id"] == user_id), None)
-            return user if one else [user] if user else []
-    
-    elif "SELECT * FROM notes WHERE" in query:
-        if "owner_id" in query:
-            owner_id = args[0]
-            notes = [n for n in mock_notes if n["owner_id"] == owner_id]
-            return notes[0] if one and notes else notes if not one else None
-        elif "id" in query:
-            note_id = args[0]
-            note = next((n for n in mock_notes if n["id"] == note_id), None)
-            return note if one else [note] if note else []
-    
-    elif "INSERT INTO users" in query:
-        # Mock user creation
-        new_id = max([u["id"] for u in mock_users]) + 1 if mock_users else 1
-        new_user = {
-            "id": new_id,
-            "name": args[0],
-            "email": args[1],
-            "password": args[2],
-            "admin": args[3]
-        }
-        mock_users.append(new_user)
-        logger.info(f"Created new user: {new_user}")
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def unsubscribe(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def _emit(event, row):
+    for listener in _listeners:
+        try:
+            listener(event, row)
+        except Exception:
+            logger.exception("Listener %r failed on %s", listener, event)
+
+
+class UserRepo:
+    """
+    Typed access to the users table of the active backend
+    """
+    @staticmethod
+    def by_id(user_id):
+        return db.store.get_user(user_id)
+
+    @staticmethod
+    def by_email(email):
+        return db.store.user_by_email(email)
+
+    @staticmethod
+    def by_name(name):
+        return db.store.user_by_name(name)
+
+    @staticmethod
+    def all(after=None, limit=None):
+        """
+        Return users in id order, optionally the page after a given id
+        """
+        return db.store.all_users(after, limit)
+
+    @staticmethod
+    def columns(columns, after=None, limit=None):
+        """
+        all() as tuples of the given public columns, see User.PUBLIC_FIELDS
+        """
+        return db.store.user_columns(columns, after, limit)
+
+    @staticmethod
+    def count():
+        return db.store.count_users()
+
+    @staticmethod
+    def create(name, email, password, admin=False):
+        new_user = User(None, name, email, password, admin)
+        new_id = db.store.insert_user(new_user)
+        logger.info("Created new user %s: %s", new_id, name)
         return new_id
-    
-    elif "INSERT INTO notes" in query:
-        # Mock note creation
-        new_id = max([n["id"] for n in mock_notes]) + 1 if mock_notes else 1
-        new_note = {
-            "id": new_id,
-            "title": args[0],
-            "content": args[1],
-            "owner_id": args[2]
-        }
-        mock_notes.append(new_note)
-        logger.info(f"Created new note: {new_note}")
+
+    @staticmethod
+    def delete(user_id):
+        """
+        Delete a user together with all notes they own
+        """
+        deleted = db.store.delete_user(user_id)
+        if deleted is None:
+            return False
+        logger.info("Deleted user: %s", user_id)
+        _emit("user_deleted", deleted)
+        return True
+
+    @staticmethod
+    def hide(user_id):
+        """
+        First step of a background deletion: make the user and their notes
+        invisible to every read. Returns the number of notes left to reclaim,
+        or None if there is no such user.
+        """
+        hidden = db.store.hide_user(user_id)
+        if hidden is None:
+            return None
+        logger.info("Hid user %s and %s notes pending deletion", user_id, hidden[1])
+        _emit("user_deleted", hidden[0])
+        return hidden[1]
+
+    @staticmethod
+    def reclaim_notes(user_id, limit):
+        """
+        Delete up to `limit` notes of a hidden user, returns how many went
+        """
+        return db.store.reclaim_notes(user_id, limit)
+
+    @staticmethod
+    def purge(user_id):
+        """
+        Last step of a background deletion, once every note is reclaimed
+        """
+        deleted = db.store.purge_user(user_id)
+        if deleted is None:
+            return False
+        logger.info("Deleted user: %s", user_id)
+        return True
+
+
+class NoteRepo:
+    """
+    Typed access to the notes table of the active backend
+    """
+    @staticmethod
+    def by_id(note_id):
+        return db.store.get_note(note_id)
+
+    @staticmethod
+    def by_owner(owner_id, after=None, limit=None):
+        """
+        Return a user's notes in id order, optionally the page after a given id
+        """
+        return db.store.notes_by_owner(owner_id, after, limit)
+
+    @staticmethod
+    def summaries_by_owner(owner_id, after=None, limit=None):
+        """
+        by_owner as NoteSummary rows, without the contents
+        """
+        return db.store.note_summaries(owner_id, after, limit)
+
+    @staticmethod
+    def columns_by_owner(owner_id, columns, after=None, limit=None):
+        """
+        by_owner as tuples of the given columns, see Note.LIST_FIELDS
+        """
+        return db.store.note_columns(owner_id, columns, after, limit)
+
+    @staticmethod
+    def all():
+        return db.store.all_notes()
+
+    @staticmethod
+    def count():
+        return db.store.count_notes()
+
+    @staticmethod
+    def create(title, content, owner_id):
+        new_note = Note(None, title, content, owner_id)
+        new_id = db.store.insert_note(new_note)
+        logger.info("Created new note %s for user %s", new_id, owner_id)
+        _emit("note_created", new_note)
         return new_id
-    
-    elif "UPDATE notes SET" in query:
-        # Mock note update
-        note_id = args[-1]
-        note = next((n for n in mock_notes if n["id"] == note_id), None)
-        if note:
-            if len(args) == 3:  # Both title and content updated
-                note["title"] = args[0]
-                note["content"] = args[1]
-            elif "title" in query:
-                note["title"] = args[0]
-            elif "content" in query:
-                note["content"] = args[0]
-            logger.info(f"Updated note: {note}")
-            return True
-        return False
-    
-    elif "DELETE FROM notes WHERE" in query:
-        # Mock note deletion
-        note_id = args[0]
-        note_index = next((i for i, n in enumerate(mock_notes) if n["id"] == note_id), None)
-        if note_index is not None:
-            deleted_note = mock_notes.pop(note_index)
-            logger.info(f"Deleted note: {deleted_note}")
-            return True
-        return False
-    
-    elif "DELETE FROM users WHERE" in query:
-        # Mock user deletion
-        user_id = args[0]
-        user_index = next((i for i, u in enumerate(mock_users) if u["id"] == user_id), None)
-        if user_index is not None:
-            deleted_user = mock_users.pop(user_index)
-            # Also delete all notes owned by this user
-            mock_notes[:] = [n for n in mock_notes if n["owner_id"] != user_id]
-            logger.info(f"Deleted user: {deleted_user}")
-            return True
-        return False
-    
-    elif "SELECT * FROM users" in query:
-        # Return all users
-        return mock_users
-    
-    elif "SELECT * FROM notes" in query:
-        # Return all notes
-        return mock_notes
-    
-    return []
\ No newline at end of file
+
+    @staticmethod
+    def collection_version(owner_id):
+        """
+        Version of an owner's set of notes, bumped by every change to any of them
+        """
+        return db.store.collection_version(owner_id)
+
+    @staticmethod
+    def update(note_id, expected_version=None, **changes):
+        """
+        Update the given columns of a note and bump its version
+        Returns the updated note, or None if it does not exist. Raises
+        VersionConflict if expected_version is given and no longer current.
+        """
+        updated = db.store.update_note(note_id, changes, expected_version)
+        if updated is not None:
+            logger.info("Updated note: %s", note_id)
+            _emit("note_updated", updated)
+        return updated
+
+    @staticmethod
+    def patch(note_id, owner_id, edits, base_version):
+        """
+        Apply ascending (start, end, text) edits to the content of version
+        `base_version` of a note and bump its version
+        Returns (note, checksum of the new content), or None if the owner has
+        no such note. Raises VersionConflict if the base is no longer current
+        and InvalidEdit if an edit reaches past the end of the content.
+        """
+        patched = db.store.patch_note(note_id, owner_id, edits, base_version)
+        if patched is not None:
+            logger.info("Patched note: %s with %s edits", note_id, len(edits))
+            _emit("note_updated", patched[0])
+        return patched
+
+    @staticmethod
+    def delete(note_id):
+        deleted = db.store.delete_note(note_id)
+        if deleted is None:
+            return False
+        logger.info("Deleted note: %s", note_id)
+        _emit("note_deleted", deleted)
+        return True
+
+    @staticmethod
+    def by_ids(note_ids):
+        """
+        Fetch many notes at once, returns {note_id: note} for those that exist
+        """
+        return db.store.notes_by_ids(note_ids)
+
+    @staticmethod
+    def apply_batch(operations):
+        """
+        Apply ("create", Note) / ("update", note_id, changes[, version]) /
+        ("delete", note_id[, version]) operations atomically
+
+        Returns the affected notes in order, or None if nothing was applied
+        because a note was deleted or changed from the given version.
+        """
+        try:
+            rows = db.store.apply_batch(operations)
+        except KeyError as e:
+            logger.warning("Batch refused, note %s no longer exists", e)
+            return None
+        except VersionConflict as e:
+            logger.warning("Batch refused, note %s has been modified", e)
+            return None
+        events = {"create": "note_created", "update": "note_updated", "delete": "note_deleted"}
+        for operation, row in zip(operations, rows):
+            _emit(events[operation[0]], row)
+        logger.info("Applied batch of %s note operations", len(rows))
+        return rows
+
+
+class JobRepo:
+    """
+    Typed access to background job records of the active backend
+    """
+    @staticmethod
+    def by_id(job_id):
+        return db.store.get_job(job_id)
+
+    @staticmethod
+    def create(kind, target_id, total=0):
+        job = Job(secrets.token_hex(8), kind, target_id, total=total, created_at=_now())
+        return db.store.create_job(job)
+
+    @staticmethod
+    def update(job_id, progress=0, **changes):
+        return db.store.update_job(job_id, changes, progress)
+
+    @staticmethod
+    def finish(job_id, error=None):
+        return db.store.update_job(
+            job_id, {"status": "failed" if error else "done", "error": error, "finished_at": _now()}
+        )
+
+    @staticmethod
+    def claim(job_id, owner, lease):
+        """
+        Take or renew the lease on a job for `lease` seconds, returns the job
+        or None if it is finished or another owner holds it
+        """
+        now = time.time()
+        return db.store.claim_job(job_id, owner, now + lease, now)
+
+    @staticmethod
+    def unfinished():
+        return db.store.unfinished_jobs()
+
+
+class TokenRepo:
+    """
+    Typed access to the access tokens of the active backend, by token hash
+    """
+    @staticmethod
+    def create(token_id, user_id, expires_at):
+        token = Token(token_id, user_id, expires_at)
+        db.store.insert_token(token)
+        return token
+
+    @staticmethod
+    def by_id(token_id, now):
+        """
+        The token if it exists, has not expired and its user is not deleted
+        """
+        return db.store.get_token(token_id, now)
+
+    @staticmethod
+    def delete(token_id):
+        return db.store.delete_token(token_id) is not None
+
+    @staticmethod
+    def delete_expired(now):
+        return db.store.delete_expired_tokens(now)
+
+    @staticmethod
+    def auth_version():
+        """
+        Counter bumped by every revocation, shared by all processes
+        """
+        return db.store.auth_version()
+
+
+class ChangeRepo:
+    """
+    Typed access to the changes table of a shared database, which only the
+    SQLite backend has; see changes.SharedChangeFeed
+    """
+    @staticmethod
+    def last():
+        return db.store.last_change()
+
+    @staticmethod
+    def after(owner_id, since, limit):
+        """
+        Changes of an owner after `since`, the latest and the oldest kept
+        """
+        return db.store.changes_after(owner_id, since, limit)
+
+    @staticmethod
+    def keep(capacity):
+        db.store.keep_changes(capacity)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+# Plans for the statements query_db understands. Each pattern is matched
+# against the whitespace-normalized query; the builder turns the match into a
+# function of (args, one). Like the raw SQLite path they return plain dicts.
+def _select_one(lookup):
+    def plan(args, one):
+        row = lookup(args[0])
+        row = row.to_dict() if row else None
+        return row if one else [row] if row else []
+    return plan
+
+def _select_many(lookup):
+    def plan(args, one):
+        rows = lookup(*args)
+        if one:
+            return rows[0].to_dict() if rows else None
+        return [row.to_dict() for row in rows]
+    return plan
+
+def _insert_user(args, one):
+    return UserRepo.create(*args)
+
+def _insert_note(args, one):
+    return NoteRepo.create(*args)
+
+def _update_note(columns):
+    if not columns or any(column not in ("title", "content") for column in columns):
+        raise KeyError(columns)
+    def plan(args, one):
+        return NoteRepo.update(args[-1], **dict(zip(columns, args))) is not None
+    return plan
+
+_LOOKUPS = {
+    ("users", "id"): UserRepo.by_id,
+    ("users", "email"): UserRepo.by_email,
+    ("users", "name"): UserRepo.by_name,
+    ("notes", "id"): NoteRepo.by_id,
+}
+
+_PATTERNS = [
+    (re.compile(r"SELECT \* FROM (users|notes) WHERE (\w+) = \?$", re.I),
+     lambda m: _select_many(NoteRepo.by_owner) if (m[1], m[2]) == ("notes", "owner_id")
+     else _select_one(_LOOKUPS[(m[1], m[2])])),
+    (re.compile(r"SELECT \* FROM users$", re.I), lambda m: _select_many(UserRepo.all)),
+    (re.compile(r"SELECT \* FROM notes$", re.I), lambda m: _select_many(NoteRepo.all)),
+    (re.compile(r"SELECT COUNT\(\*\) FROM users$", re.I), lambda m: lambda args, one: UserRepo.count()),
+    (re.compile(r"SELECT COUNT\(\*\) FROM notes$", re.I), lambda m: lambda args, one: NoteRepo.count()),
+    (re.compile(r"INSERT INTO users \(name, email, password, admin\) VALUES", re.I), lambda m: _insert_user),
+    (re.compile(r"INSERT INTO notes \(title, content, owner_id\) VALUES", re.I), lambda m: _insert_note),
+    (re.compile(r"UPDATE notes SET (.+) WHERE id = \?$", re.I),
+     lambda m: _update_note([a.split("=")[0].strip() for a in m[1].split(",")])),
+    (re.compile(r"DELETE FROM notes WHERE id = \?$", re.I), lambda m: lambda args, one: NoteRepo.delete(args[0])),
+    (re.compile(r"DELETE FROM users WHERE id = \?$", re.I), lambda m: lambda args, one: UserRepo.delete(args[0])),
+]
+
+@functools.lru_cache(maxsize=256)
+def _plan(query):
+    """
+    Parse a query once and return the cached plan for it, or None
+    """
+    normalized = " ".join(query.split()).rstrip(";")
+    for pattern, build in _PATTERNS:
+        match = pattern.match(normalized)
+        if match:
+            try:
+                return build(match)
+            except KeyError:
+                return None
+    return None
+
+def query_db(query, args=(), one=False):
+    """
+    Run a SQL statement against the active backend
+
+    Kept for compatibility; new code should call UserRepo/NoteRepo directly.
+    Each distinct query string is parsed once and its plan is cached.
+    """
+    logger.debug("Executing query: %s", query)
+
+    plan = _plan(query)
+    if plan is not None:
+        metrics.queries_total.inc(("planned",))
+        return plan(args, one)
+
+    if db.backend == "sqlite":
+        metrics.queries_total.inc(("raw",))
+        start = time.perf_counter()
+        result = _query_sqlite(query, args, one)
+        # Raw statements are opaque, only the rows they produced are known
+        rows = metrics.count_rows(result)
+        metrics.observe_store("sqlite", "raw_query", time.perf_counter() - start, rows, rows)
+        return result
+
+    metrics.queries_total.inc(("unsupported",))
+    logger.warning("Unsupported query: %s", query)
+    return []
+
+def _query_sqlite(query, args, one):
+    """
+    Run a query against the SQLite backend and shape the result like the mock
+    """
+    conn = get_db_connection()
+    try:
+        statement = query.lstrip().upper()
+        if statement.startswith("SELECT"):
+            cursor = conn.execute(query, args)
+            if statement.startswith("SELECT COUNT(*)"):
+                return next(iter(cursor.fetchone().values()))
+            if one:
+                return cursor.fetchone()
+            return cursor.fetchall()
+
+        with conn:
+            cursor = conn.execute(query, args)
+        if statement.startswith("INSERT"):
+            return cursor.lastrowid
+        return cursor.rowcount > 0
+    finally:
+        close_db_connection(conn)
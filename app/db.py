@@ -1,32 +1,1887 @@
+import atexit
+import bisect
+import functools
+import hashlib
+import itertools
 import logging
+import operator
+import os
+import queue
+import secrets
 import sqlite3
+import sys
+import tempfile
+import threading
+
+from app import wal
+from app.blobs import Blob, BlobStore
+from app.models import User, Note, NoteSummary, Job, Token, SNIPPET_LENGTH
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Rows visited by store operations on each thread, read by app.metrics
+_scans = threading.local()
+
+def rows_scanned():
+    """
+    Total number of rows the stores have visited on this thread
+    """
+    return getattr(_scans, "count", 0)
+
+def _scanned(count):
+    _scans.count = getattr(_scans, "count", 0) + count
+
+
+# Sorted key lists are shared with readers that walk them without a lock, so
+# they are only ever changed at the end (which leaves every position a reader
+# may be at in place) or replaced by an updated copy
+
+def _with_key(keys, key):
+    """
+    Add a key to a sorted key list, returns the list to keep
+    """
+    if not keys or keys[-1] < key:
+        keys.append(key)
+        return keys
+    position = bisect.bisect_left(keys, key)
+    if keys[position] == key:
+        return keys
+    return keys[:position] + [key] + keys[position:]
+
+def _without_key(keys, key):
+    """
+    Remove a key from a sorted key list, returns the list to keep
+    """
+    position = bisect.bisect_left(keys, key)
+    if position == len(keys) or keys[position] != key:
+        return keys
+    if position == len(keys) - 1:
+        keys.pop()
+        return keys
+    return keys[:position] + keys[position + 1:]
+
+
+class Table:
+    """
+    In-memory table of model records with hash indexes
+
+    Rows are kept in a dict keyed by primary key, so point lookups by id are
+    O(1). Unique indexes map a column value to the primary key of its row and
+    secondary indexes map a column value to the sorted list of primary keys
+    that share it. Every write goes through insert/update/delete so the indexes
+    always agree with the rows.
+
+    Primary keys are also kept in a sorted list so pages can be read in key
+    order starting after any key. Deleted keys are left in that list and
+    skipped until enough of them pile up to be worth compacting.
+
+    Reads take no lock. Rows are never changed in place (an update swaps in a
+    new record) and key lists are appended to or replaced, never shifted, so
+    a reader sees each row either before or after a write. Writes are not
+    synchronized here: the owner of the table serializes them.
+    """
+    def __init__(self, primary_key="id", unique=(), indexed=()):
+        self.primary_key = primary_key
+        self.rows = {}
+        self.order = []
+        self.unique = {column: {} for column in unique}
+        self.indexes = {column: {} for column in indexed}
+        self.last_id = 0
+        self._dead = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        _scanned(len(self.rows))
+        return iter(list(self.rows.values()))
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def get(self, key):
+        """
+        Look up a row by primary key
+        """
+        _scanned(1)
+        return self.rows.get(key)
+
+    def get_by(self, column, value):
+        """
+        Look up a row through a unique index
+        """
+        _scanned(1)
+        key = self.unique[column].get(value)
+        return None if key is None else self.rows.get(key)
+
+    def find(self, column, value):
+        """
+        Return all rows with the given value through a secondary index
+        """
+        keys = self.indexes[column].get(value, ())
+        _scanned(len(keys))
+        rows = (self.rows.get(key) for key in keys)
+        return [row for row in rows if row is not None]
+
+    def page(self, after=None, limit=None, column=None, value=None, exclude=()):
+        """
+        Return up to `limit` rows with a primary key greater than `after`
+
+        Rows come in primary key order, either from the whole table or, when
+        `column` is given, from the secondary index bucket for `value`. Keys in
+        `exclude` are skipped as if they were not there.
+        """
+        if column is None:
+            keys = self.order
+        else:
+            keys = self.indexes[column].get(value, ())
+        start = 0 if after is None else bisect.bisect_right(keys, after)
+
+        rows = []
+        visited = 0
+        for key in itertools.islice(keys, start, None):
+            visited += 1
+            row = self.rows.get(key)
+            if row is None or key in exclude:
+                continue
+            rows.append(row)
+            if limit is not None and len(rows) >= limit:
+                break
+        _scanned(visited)
+        return rows
+
+    def next_id(self):
+        """
+        Allocate the next primary key without scanning the table
+        """
+        self.last_id += 1
+        return self.last_id
+
+    def insert(self, row):
+        """
+        Insert a row and add it to every index
+        """
+        key = getattr(row, self.primary_key)
+        if key is None:
+            key = self.next_id()
+            setattr(row, self.primary_key, key)
+        elif key in self.rows:
+            raise ValueError(f"Duplicate primary key: {key}")
+        else:
+            self.last_id = max(self.last_id, key)
+
+        for column, index in self.unique.items():
+            if getattr(row, column) in index:
+                raise ValueError(f"Duplicate value for unique column {column}")
+
+        self.rows[key] = row
+        position = bisect.bisect_left(self.order, key)
+        if position < len(self.order) and self.order[position] == key:
+            # Re-inserting a key whose stale entry is still in the list
+            self._dead -= 1
+        else:
+            self.order = _with_key(self.order, key)
+        for column, index in self.unique.items():
+            index[getattr(row, column)] = key
+        for column, index in self.indexes.items():
+            value = getattr(row, column)
+            index[value] = _with_key(index.get(value, []), key)
+        return key
+
+    def load(self, rows, last_id=0):
+        """
+        Fill an empty table from rows in primary key order
+
+        Builds every index in one pass, without the per-row checks of insert;
+        used to restore a snapshot, whose rows are known to be consistent.
+        """
+        order = self.order
+        for row in rows:
+            key = getattr(row, self.primary_key)
+            self.rows[key] = row
+            order.append(key)
+            for column, index in self.unique.items():
+                index[getattr(row, column)] = key
+            for column, index in self.indexes.items():
+                value = getattr(row, column)
+                bucket = index.get(value)
+                if bucket is None:
+                    index[value] = [key]
+                else:
+                    bucket.append(key)
+        self.last_id = max(self.last_id, last_id, order[-1] if order else 0)
+
+    def update(self, key, changes):
+        """
+        Replace a row with a copy that has the given columns changed, moving
+        it between index buckets; returns the new row
+        """
+        row = self.rows.get(key)
+        if row is None:
+            return None
+
+        for column, value in changes.items():
+            if column in self.unique and getattr(row, column) != value:
+                owner = self.unique[column].get(value)
+                if owner is not None and owner != key:
+                    raise ValueError(f"Duplicate value for unique column {column}")
+
+        new = row.replace(changes)
+        for column, value in changes.items():
+            old = getattr(row, column)
+            if old == value:
+                continue
+            if column in self.unique:
+                self.unique[column][value] = key
+            if column in self.indexes:
+                index = self.indexes[column]
+                index[value] = _with_key(index.get(value, []), key)
+        self.rows[key] = new
+        for column, value in changes.items():
+            old = getattr(row, column)
+            if old == value:
+                continue
+            if column in self.unique:
+                del self.unique[column][old]
+            if column in self.indexes:
+                self._unindex(column, old, key)
+        return new
+
+    def delete(self, key):
+        """
+        Remove a row and drop it from every index
+        """
+        row = self.rows.pop(key, None)
+        if row is None:
+            return None
+        for column, index in self.unique.items():
+            index.pop(getattr(row, column), None)
+        for column in self.indexes:
+            self._unindex(column, getattr(row, column), key)
+
+        self._dead += 1
+        if self._dead > len(self.order) // 2:
+            self.order = [k for k in self.order if k in self.rows]
+            self._dead = 0
+        return row
+
+    def memory_usage(self, sample=10000):
+        """
+        Approximate bytes held by the rows, their values and the indexes
+
+        Containers are measured exactly; the per-row cost is measured on up
+        to `sample` rows and scaled. Objects shared between rows (interned
+        owner ids, small ints, booleans) are only counted once.
+        """
+        seen = set()
+
+        def size(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        total = size(self.rows) + size(self.order)
+        for index in self.unique.values():
+            total += size(index)
+        for index in self.indexes.values():
+            total += size(index) + sum(size(bucket) for bucket in index.values())
+
+        rows = list(self.rows.values())[:sample]
+        if rows:
+            per_row = 0
+            for row in rows:
+                per_row += size(row) + sum(size(getattr(row, field)) for field in row.__slots__)
+            total += per_row * len(self.rows) // len(rows)
+        return total
+
+    def _unindex(self, column, value, key):
+        index = self.indexes[column]
+        bucket = index.get(value)
+        if bucket is not None:
+            bucket = _without_key(bucket, key)
+            if bucket:
+                index[value] = bucket
+            else:
+                del index[value]
+
+
+def new_tables():
+    """
+    Empty users and notes tables with their indexes
+    """
+    return Table(unique=("email", "name")), Table(indexed=("owner_id",))
+
+
 # Mock database for testing
-mock_users = [
-    {"id": 1, "name": "admin", "email": "admin@example.com", "password": "admin123", "admin": True},
-    {"id": 2, "name": "user", "email": "user@example.com", "password": "user123", "admin": False}
-]
+mock_users, mock_notes = new_tables()
+
+for _user in [
+    User(1, "admin", "admin@example.com", "admin123", True),
+    User(2, "user", "user@example.com", "user123", False)
+]:
+    mock_users.insert(_user)
+
+for _note in [
+    Note(1, "Admin Note", "This is an admin note", 1),
+    Note(2, "User Note", "This is a user note", 2)
+]:
+    mock_notes.insert(_note)
+
+
+class VersionConflict(Exception):
+    """
+    Raised when a conditional update finds a different note version
+    """
+
+
+class DuplicateUser(Exception):
+    """
+    Raised when a new user's name or email is already taken, including by a
+    user whose deletion is still in progress
+    """
+
+
+class InvalidEdit(Exception):
+    """
+    Raised when an edit of a note content reaches past its end
+    """
+
+
+def content_checksum(content):
+    """
+    SHA-256 of a note content in UTF-8, as returned for patched notes
+    """
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+def _apply_edits(content, edits):
+    """
+    Content with ascending (start, end, text) edits applied, each replacing
+    characters start to end of the original
+    """
+    if edits[-1][1] > len(content):
+        raise IndexError(edits[-1][1])
+    pieces = []
+    previous = 0
+    for start, end, text in edits:
+        pieces.append(content[previous:start])
+        pieces.append(text)
+        previous = end
+    pieces.append(content[previous:])
+    return "".join(pieces)
+
+
+def _durable(method):
+    """
+    Make a write of the memory store return only once the records it logged
+    are written out, see wal.WriteAheadLog
+    """
+    @functools.wraps(method)
+    def write(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        log = self.wal
+        if log is not None:
+            log.sync()
+        return result
+    return write
+
+
+def _column_getter(columns, derived):
+    """
+    Function turning a row into the tuple of its `columns`; a column in
+    `derived` is computed by the function it maps to, the others are read
+    straight from the row's slots
+    """
+    if not any(column in derived for column in columns):
+        if len(columns) > 1:
+            return operator.attrgetter(*columns)
+        get = operator.attrgetter(columns[0])
+        return lambda row: (get(row),)
+    getters = [derived.get(column) or operator.attrgetter(column) for column in columns]
+    return lambda row: tuple([get(row) for get in getters])
+
+# Note.LIST_FIELDS that are not slots of the row, or not as stored
+_NOTE_DERIVED = {"content": Note.text, "size": Note.size, "snippet": Note.snippet}
+
+
+class MemoryStore:
+    """
+    Store backed by the in-memory mock tables
+
+    Owner ids are interned, so the notes of one owner all point at a single
+    int object instead of each holding their own copy.
+
+    Besides the per-note version it keeps a version per owner that changes
+    whenever any of their notes is created, updated or deleted. Versions are
+    only meaningful together with `epoch`, which is new for every store.
+
+    Users being deleted are hidden first: their ids go into `hidden`, which
+    every read checks, and their notes are reclaimed later in chunks.
+
+    Writes are serialized by one lock, which makes id allocation, unique
+    checks and read-then-write operations (versioned updates, batches) atomic.
+    Reads never take it; the tables are built to be read while a write is
+    in progress.
+
+    Access tokens are kept by their hash. `auth_version` changes whenever a
+    token is revoked, so token caches know when to drop what they hold.
+
+    With a write-ahead log attached (`wal`, see app.wal.Persistence) every
+    write is logged, under the write lock, as the method call that replays
+    it. A batch is logged as one record once it has fully applied.
+
+    With a blob store attached (`blobs`) note contents of at least its
+    threshold in characters are written out of line before the write lock is
+    taken, and rows hold a Blob handle in their place.
+    """
+    # Logged writes whose first argument is a row, logged as its tuple
+    ROW_ARGUMENTS = {"insert_user": User, "insert_note": Note, "insert_token": Token, "create_job": Job}
+
+    def __init__(self, users, notes):
+        self.users = users
+        self.notes = notes
+        self.collection_versions = {}
+        self.epoch = secrets.token_hex(4)
+        self.hidden = set()
+        self.jobs = {}
+        self.tokens = {}
+        self.secret_key = secrets.token_hex(32)
+        self._revocations = 0
+        self._user_tokens = {}
+        self._owner_ids = {}
+        self._lock = threading.RLock()
+        self.wal = None
+        self.blobs = None
+        self._batch = None
+
+    def _log(self, operation, *args):
+        if self.wal is None:
+            return
+        if operation in self.ROW_ARGUMENTS:
+            args = (args[0].to_tuple(),) + args[1:]
+        elif operation == "update_note" and isinstance(args[1].get("content"), Blob):
+            args = (args[0], dict(args[1], content=args[1]["content"].key))
+        if self._batch is not None:
+            self._batch.append((operation,) + args)
+        else:
+            self.wal.append((operation,) + args)
+
+    def replay(self, record):
+        """
+        Apply a logged write again, while loading the store
+        """
+        operation, args = record[0], record[1:]
+        if operation == "batch":
+            for step in args[0]:
+                self.replay(step)
+            return
+        if operation in self.ROW_ARGUMENTS:
+            args = (self.ROW_ARGUMENTS[operation](*args[0]),) + args[1:]
+        getattr(self, operation)(*args)
+
+    def load(self, meta, users, notes):
+        """
+        Fill an empty store from a snapshot: row tuples in id order and the
+        rest of its state in `meta`
+        """
+        self.secret_key = meta["secret_key"]
+        self.users.load((User(*row) for row in users), meta["last_user_id"])
+        owner_ids = self._owner_ids
+        blobs = self.blobs
+        self.notes.load(
+            (Note(id, title, content if content.__class__ is str else blobs.open(content),
+                  owner_ids.setdefault(owner_id, owner_id), version)
+             for id, title, content, owner_id, version in notes),
+            meta["last_note_id"]
+        )
+        self.hidden.update(meta["hidden"])
+        for row in meta["jobs"]:
+            self.jobs[row[0]] = Job(*row)
+        for row in meta["tokens"]:
+            token = self.tokens[row[0]] = Token(*row)
+            self._user_tokens.setdefault(token.user_id, set()).add(token.id)
+
+    def checkpoint(self):
+        """
+        Start a new log segment and return (lsn, meta, users, notes) as of
+        its start, for a snapshot
+
+        Only the row dicts are copied under the write lock. Rows are never
+        changed in place and the sorted key lists are only appended to or
+        replaced, so the copies are turned into row tuples afterwards.
+        """
+        with self._lock:
+            lsn = self.wal.rotate()
+            tables = []
+            for table in (self.users, self.notes):
+                tables.append((dict(table.rows), table.order, len(table.order)))
+            meta = {
+                "secret_key": self.secret_key,
+                "last_user_id": self.users.last_id,
+                "last_note_id": self.notes.last_id,
+                "hidden": sorted(self.hidden),
+                "jobs": [job.to_tuple() for job in self.jobs.values()],
+                "tokens": [token.to_tuple() for token in self.tokens.values()]
+            }
+
+        def rows(copy, order, count):
+            for key in itertools.islice(order, count):
+                row = copy.get(key)
+                if row is not None:
+                    yield row.to_tuple()
+
+        return lsn, meta, rows(*tables[0]), rows(*tables[1])
+
+    def _content(self, content):
+        """
+        Stored form of a note content: a large string is moved out of line,
+        the key of a logged blob turned back into its handle
+        """
+        blobs = self.blobs
+        if blobs is None:
+            return content
+        if isinstance(content, str):
+            return blobs.put(content) if blobs.threshold and len(content) >= blobs.threshold else content
+        if isinstance(content, tuple):
+            return blobs.open(content)
+        return content
+
+    def _changes(self, changes):
+        if self.blobs is None or "content" not in changes:
+            return changes
+        return dict(changes, content=self._content(changes["content"]))
+
+    def _touch(self, owner_id):
+        self.collection_versions[owner_id] = self.collection_versions.get(owner_id, 0) + 1
+
+    def _visible(self, row, owner_id):
+        return None if row is None or owner_id in self.hidden else row
+
+    def get_user(self, user_id):
+        return self._visible(self.users.get(user_id), user_id)
+
+    def user_by_email(self, email):
+        user = self.users.get_by("email", email)
+        return user and self._visible(user, user.id)
+
+    def user_by_name(self, name):
+        user = self.users.get_by("name", name)
+        return user and self._visible(user, user.id)
+
+    def all_users(self, after=None, limit=None):
+        if after is None and limit is None and not self.hidden:
+            return list(self.users)
+        return self.users.page(after, limit, exclude=self.hidden)
+
+    def user_columns(self, columns, after=None, limit=None):
+        """
+        all_users as tuples of the given columns, which must be among
+        User.PUBLIC_FIELDS
+        """
+        if not set(columns) <= set(User.PUBLIC_FIELDS):
+            raise KeyError(columns)
+        return list(map(_column_getter(columns, {}), self.all_users(after, limit)))
+
+    def count_users(self):
+        return len(self.users) - len(self.hidden)
+
+    @_durable
+    def insert_user(self, user):
+        with self._lock:
+            try:
+                new_id = self.users.insert(user)
+            except ValueError as e:
+                raise DuplicateUser(str(e)) from None
+            self._log("insert_user", user)
+            return new_id
+
+    @_durable
+    def delete_user(self, user_id):
+        with self._lock:
+            if self.get_user(user_id) is None:
+                return None
+            self._log("delete_user", user_id)
+            self._revoke_user_tokens(user_id)
+            # Also delete all notes owned by this user, last first so each
+            # removal from the owner's index bucket is at its end
+            for note in reversed(self.notes.find("owner_id", user_id)):
+                self.notes.delete(note.id)
+            return self._drop_user(user_id)
+
+    def _drop_user(self, user_id):
+        user = self.users.delete(user_id)
+        self.hidden.discard(user_id)
+        self.collection_versions.pop(user_id, None)
+        self._owner_ids.pop(user_id, None)
+        return user
+
+    @_durable
+    def hide_user(self, user_id):
+        """
+        Hide a user and their notes from every read, returns the user and
+        the number of notes left to reclaim
+        """
+        with self._lock:
+            user = self.get_user(user_id)
+            if user is None:
+                return None
+            self._log("hide_user", user_id)
+            self.hidden.add(user_id)
+            self._revoke_user_tokens(user_id)
+            return user, len(self.notes.indexes["owner_id"].get(user_id, ()))
+
+    @_durable
+    def reclaim_notes(self, user_id, limit):
+        """
+        Delete up to `limit` notes of a hidden user, returns how many went
+        """
+        with self._lock:
+            if user_id not in self.hidden:
+                return 0
+            self._log("reclaim_notes", user_id, limit)
+            keys = self.notes.indexes["owner_id"].get(user_id, [])[-limit:]
+            _scanned(len(keys))
+            for key in reversed(keys):
+                self.notes.delete(key)
+            return len(keys)
+
+    @_durable
+    def purge_user(self, user_id):
+        """
+        Remove a hidden user whose notes have all been reclaimed
+        """
+        with self._lock:
+            if user_id not in self.hidden or user_id in self.notes.indexes["owner_id"]:
+                return None
+            self._log("purge_user", user_id)
+            return self._drop_user(user_id)
+
+    def hidden_users(self):
+        return sorted(self.hidden)
+
+    @_durable
+    def insert_token(self, token):
+        with self._lock:
+            self._log("insert_token", token)
+            self.tokens[token.id] = token
+            self._user_tokens.setdefault(token.user_id, set()).add(token.id)
+
+    def get_token(self, token_id, now):
+        """
+        Look up a token that has not expired and belongs to a visible user
+        """
+        token = self.tokens.get(token_id)
+        if token is None or token.expires_at <= now or self.get_user(token.user_id) is None:
+            return None
+        return token
+
+    @_durable
+    def delete_token(self, token_id):
+        with self._lock:
+            token = self.tokens.pop(token_id, None)
+            if token is None:
+                return None
+            self._log("delete_token", token_id)
+            self._user_tokens.get(token.user_id, set()).discard(token_id)
+            self._revocations += 1
+            return token
+
+    @_durable
+    def delete_expired_tokens(self, now):
+        with self._lock:
+            expired = [token for token in self.tokens.values() if token.expires_at <= now]
+            if expired:
+                self._log("delete_expired_tokens", now)
+            for token in expired:
+                del self.tokens[token.id]
+                self._user_tokens.get(token.user_id, set()).discard(token.id)
+            return len(expired)
+
+    def auth_version(self):
+        return self._revocations
+
+    def _revoke_user_tokens(self, user_id):
+        for token_id in self._user_tokens.pop(user_id, ()):
+            self.tokens.pop(token_id, None)
+        self._revocations += 1
+
+    def get_note(self, note_id):
+        row = self.notes.get(note_id)
+        return row and self._visible(row, row.owner_id)
+
+    def _notes_of(self, owner_id, after, limit):
+        if owner_id in self.hidden:
+            return []
+        if after is None and limit is None:
+            return self.notes.find("owner_id", owner_id)
+        return self.notes.page(after, limit, "owner_id", owner_id)
+
+    def notes_by_owner(self, owner_id, after=None, limit=None):
+        return self._notes_of(owner_id, after, limit)
+
+    def note_summaries(self, owner_id, after=None, limit=None):
+        return [row.summary() for row in self._notes_of(owner_id, after, limit)]
+
+    def note_columns(self, owner_id, columns, after=None, limit=None):
+        """
+        notes_by_owner as tuples of the given columns, which must be among
+        Note.LIST_FIELDS; no row or dict is built per note
+        """
+        if not set(columns) <= set(Note.LIST_FIELDS):
+            raise KeyError(columns)
+        return list(map(_column_getter(columns, _NOTE_DERIVED), self._notes_of(owner_id, after, limit)))
+
+    def all_notes(self):
+        if self.hidden:
+            return [row for row in self.notes if row.owner_id not in self.hidden]
+        return list(self.notes)
 
-mock_notes = [
-    {"id": 1, "title": "Admin Note", "content": "This is an admin note", "owner_id": 1},
-    {"id": 2, "title": "User Note", "content": "This is a user note", "owner_id": 2}
+    def count_notes(self):
+        owners = self.notes.indexes["owner_id"]
+        hidden = sum(len(owners.get(owner_id, ())) for owner_id in tuple(self.hidden))
+        return len(self.notes) - hidden
+
+    def collection_version(self, owner_id):
+        return self.collection_versions.get(owner_id, 0)
+
+    @_durable
+    def insert_note(self, note):
+        note.content = self._content(note.content)
+        with self._lock:
+            note.owner_id = self._owner_ids.setdefault(note.owner_id, note.owner_id)
+            note.version = 1
+            new_id = self.notes.insert(note)
+            self._log("insert_note", note)
+            self._touch(note.owner_id)
+            return new_id
+
+    @_durable
+    def update_note(self, note_id, changes, expected_version=None):
+        changes = self._changes(changes)
+        with self._lock:
+            row = self.get_note(note_id)
+            if row is None:
+                return None
+            if expected_version is not None and row.version != expected_version:
+                raise VersionConflict(note_id)
+            row = self.notes.update(note_id, dict(changes, version=row.version + 1))
+            self._log("update_note", note_id, changes)
+            self._touch(row.owner_id)
+            return row
+
+    @_durable
+    def patch_note(self, note_id, owner_id, edits, base_version):
+        """
+        Apply content edits (see _apply_edits) to version `base_version` of a
+        note of `owner_id`. Returns the updated row and the checksum of its
+        new content, or None if the owner has no such note.
+
+        The new content is built before the write lock is taken, an
+        out-of-line one straight from the old blob's file into a new one; a
+        write that gets in first makes the base stale all the same.
+        """
+        row = self.get_note(note_id)
+        if row is None or row.owner_id != owner_id:
+            return None
+        if row.version != base_version:
+            raise VersionConflict(note_id)
+        content = row.content
+        try:
+            if content.__class__ is Blob:
+                content, checksum = self.blobs.patch(content, edits)
+                if content.size < self.blobs.threshold:
+                    content = content.read()
+            else:
+                content = _apply_edits(content, edits)
+                checksum = content_checksum(content)
+                content = self._content(content)
+        except IndexError:
+            raise InvalidEdit(note_id)
+        changes = {"content": content}
+        with self._lock:
+            row = self.get_note(note_id)
+            if row is None:
+                return None
+            if row.version != base_version:
+                raise VersionConflict(note_id)
+            row = self.notes.update(note_id, dict(changes, version=row.version + 1))
+            self._log("update_note", note_id, changes)
+            self._touch(row.owner_id)
+            return row, checksum
+
+    @_durable
+    def delete_note(self, note_id):
+        with self._lock:
+            if self.get_note(note_id) is None:
+                return None
+            self._log("delete_note", note_id)
+            row = self.notes.delete(note_id)
+            self._touch(row.owner_id)
+            return row
+
+    def notes_by_ids(self, note_ids):
+        rows = (self.get_note(note_id) for note_id in note_ids)
+        return {row.id: row for row in rows if row is not None}
+
+    @_durable
+    def create_job(self, job):
+        with self._lock:
+            self.jobs[job.id] = job
+            self._log("create_job", job)
+            return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    @_durable
+    def update_job(self, job_id, changes, progress=0):
+        """
+        Set columns of a job and add `progress` to its done count
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = self.jobs[job_id] = job.replace(dict(changes, done=job.done + progress))
+            self._log("update_job", job_id, changes, progress)
+            return job
+
+    @_durable
+    def claim_job(self, job_id, owner, lease_until, now):
+        """
+        Mark a job running for `owner` until `lease_until`, returns the job or
+        None if it is finished or another owner's lease has not expired by
+        `now`; the owner claims it again to extend its lease
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or not (job.status == "queued" or job.status == "running" and (
+                    job.owner == owner or job.lease_until is None or job.lease_until < now)):
+                return None
+            job = self.jobs[job_id] = job.replace({"status": "running", "owner": owner, "lease_until": lease_until})
+            self._log("claim_job", job_id, owner, lease_until, now)
+            return job
+
+    def unfinished_jobs(self):
+        return [job for job in list(self.jobs.values()) if job.status in ("queued", "running")]
+
+    @_durable
+    def apply_batch(self, operations):
+        """
+        Apply (op, ...) tuples all-or-nothing, returns the affected rows
+
+        An update or delete may end with the version its note must still be
+        at. Every operation is checked under the write lock before any is
+        applied: a note that is missing, deleted earlier in the batch or at
+        another version raises KeyError or VersionConflict and nothing
+        changes. A batch is never undone, so no version number is handed
+        out twice; readers may see one being applied, never one rolled back.
+        """
+        operations = list(operations)
+        results = []
+        # Large contents are written out before the lock, not while holding
+        # it; those of a refused batch are dropped along with this dict
+        contents = {}
+        if self.blobs is not None:
+            for index, operation in enumerate(operations):
+                if operation[0] == "create":
+                    contents[index] = self._content(operation[1].content)
+                elif operation[0] == "update":
+                    operations[index] = ("update", operation[1], self._changes(operation[2])) + operation[3:]
+        with self._lock:
+            deleted = set()
+            for operation in operations:
+                if operation[0] == "create":
+                    continue
+                if operation[0] not in ("update", "delete"):
+                    raise ValueError(f"Unknown batch operation: {operation[0]}")
+                note_id = operation[1]
+                row = self.get_note(note_id)
+                if row is None or note_id in deleted:
+                    raise KeyError(note_id)
+                expected = operation[3:] if operation[0] == "update" else operation[2:]
+                if expected and expected[0] != row.version:
+                    raise VersionConflict(note_id)
+                if operation[0] == "delete":
+                    deleted.add(note_id)
+            if self.wal is not None:
+                self._batch = []
+            try:
+                for index, operation in enumerate(operations):
+                    if operation[0] == "create":
+                        note = operation[1]
+                        if index in contents:
+                            note.content = contents[index]
+                        self.insert_note(note)
+                        results.append(note)
+                    elif operation[0] == "update":
+                        results.append(self.update_note(operation[1], operation[2]))
+                    else:
+                        results.append(self.delete_note(operation[1]))
+            finally:
+                logged, self._batch = self._batch, None
+            if logged:
+                self._log("batch", logged)
+        return results
+
+
+# SQLite backend
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    admin BOOLEAN NOT NULL DEFAULT 0,
+    deleted BOOLEAN NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    owner_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS note_collections (
+    owner_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TEXT,
+    finished_at TEXT,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_name ON users (name);
+CREATE INDEX IF NOT EXISTS idx_notes_owner_id ON notes (owner_id, id);
+CREATE INDEX IF NOT EXISTS idx_tokens_user_id ON tokens (user_id);
+CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at);
+"""
+
+# Columns added after the first release, applied to older databases
+MIGRATIONS = [
+    ("notes", "version", "ALTER TABLE notes ADD COLUMN version INTEGER NOT NULL DEFAULT 1"),
+    ("users", "deleted", "ALTER TABLE users ADD COLUMN deleted BOOLEAN NOT NULL DEFAULT 0"),
+    ("jobs", "owner", "ALTER TABLE jobs ADD COLUMN owner TEXT"),
+    ("jobs", "lease_until", "ALTER TABLE jobs ADD COLUMN lease_until REAL"),
 ]
 
+# Indexes over migrated columns, created once the migrations have run
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_users_deleted ON users (id) WHERE deleted;
+"""
+
+# Tables whose ids must never be handed out twice. Caches and ETags identify
+# rows by (id, version), which a recycled id would make ambiguous.
+AUTOINCREMENT_TABLES = ("users", "notes")
+
+# Per-owner collection versions are maintained by the database itself, so
+# every write path (including batches and the user-delete cascade) bumps them
+TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS notes_collection_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO note_collections (owner_id, version) VALUES (NEW.owner_id, 1)
+    ON CONFLICT (owner_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS notes_collection_update AFTER UPDATE ON notes BEGIN
+    INSERT INTO note_collections (owner_id, version) VALUES (NEW.owner_id, 1)
+    ON CONFLICT (owner_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS notes_collection_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO note_collections (owner_id, version) VALUES (OLD.owner_id, 1)
+    ON CONFLICT (owner_id) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_collection_delete AFTER DELETE ON users BEGIN
+    DELETE FROM note_collections WHERE owner_id = OLD.id;
+END;
+"""
+
+# Full-text index over notes, kept in sync by triggers so every process
+# sharing the database searches the same data. The owner is indexed too, so
+# a search matches it along with the terms and the index only walks the
+# documents of that owner and the term, skipping ahead in the longer list.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    title, content, owner_id, content='notes', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts (rowid, title, content, owner_id)
+    VALUES (NEW.id, NEW.title, NEW.content, NEW.owner_id);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, title, content, owner_id)
+    VALUES ('delete', OLD.id, OLD.title, OLD.content, OLD.owner_id);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, title, content, owner_id)
+    VALUES ('delete', OLD.id, OLD.title, OLD.content, OLD.owner_id);
+    INSERT INTO notes_fts (rowid, title, content, owner_id)
+    VALUES (NEW.id, NEW.title, NEW.content, NEW.owner_id);
+END;
+"""
+
+# Change feed shared by every process using the database, see
+# changes.SharedChangeFeed. Triggers record each change like crud's events: a
+# user deleted at once or hidden for a background deletion is one
+# user_deleted, the notes that go with them are not reported one by one.
+# Only the last `changes_capacity` (a meta key) changes are kept.
+CHANGES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner_id INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    note_id INTEGER,
+    version INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_changes_owner_id ON changes (owner_id, seq);
+CREATE TRIGGER IF NOT EXISTS changes_note_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO changes (owner_id, event, note_id, version)
+    VALUES (NEW.owner_id, 'note_created', NEW.id, NEW.version);
+END;
+CREATE TRIGGER IF NOT EXISTS changes_note_update AFTER UPDATE ON notes BEGIN
+    INSERT INTO changes (owner_id, event, note_id, version)
+    VALUES (NEW.owner_id, 'note_updated', NEW.id, NEW.version);
+END;
+CREATE TRIGGER IF NOT EXISTS changes_note_delete AFTER DELETE ON notes
+WHEN EXISTS (SELECT 1 FROM users WHERE id = OLD.owner_id AND NOT deleted) BEGIN
+    INSERT INTO changes (owner_id, event, note_id, version)
+    VALUES (OLD.owner_id, 'note_deleted', OLD.id, OLD.version);
+END;
+CREATE TRIGGER IF NOT EXISTS changes_user_hide AFTER UPDATE OF deleted ON users
+WHEN NEW.deleted AND NOT OLD.deleted BEGIN
+    INSERT INTO changes (owner_id, event) VALUES (NEW.id, 'user_deleted');
+END;
+CREATE TRIGGER IF NOT EXISTS changes_user_delete AFTER DELETE ON users WHEN NOT OLD.deleted BEGIN
+    INSERT INTO changes (owner_id, event) VALUES (OLD.id, 'user_deleted');
+END;
+CREATE TRIGGER IF NOT EXISTS changes_trim AFTER INSERT ON changes BEGIN
+    DELETE FROM changes
+    WHERE seq <= NEW.seq - (SELECT CAST(value AS INTEGER) FROM meta WHERE key = 'changes_capacity');
+END;
+"""
+
+# Number of compiled statements each connection keeps around
+STATEMENT_CACHE_SIZE = 128
+
+backend = "memory"
+store = MemoryStore(mock_users, mock_notes)
+# Snapshot and write-ahead log of the memory store, when it is kept on disk
+persistence = None
+# Blob store of the mock tables, which like them outlives any one store
+_scratch_blobs = None
+_pool = None
+
+
+def _dict_factory(cursor, row):
+    """
+    Turn SQLite rows into dicts, used for raw queries
+    """
+    result = {column[0]: value for column, value in zip(cursor.description, row)}
+    if "admin" in result:
+        result["admin"] = bool(result["admin"])
+    return result
+
+# Build model records straight from `SELECT *`/`RETURNING *` tuples, whose
+# columns come in table order (id, name, email, password, admin, deleted),
+# (id, title, content, owner_id, version) and the Job fields; note summaries
+# select their columns in NoteSummary order
+def _user_factory(cursor, row):
+    return User(row[0], row[1], row[2], row[3], bool(row[4]))
+
+def _note_factory(cursor, row):
+    return Note(*row)
+
+def _tuple_factory(cursor, row):
+    return row
+
+def _bool_factory(index):
+    """
+    Factory of tuple rows whose column `index` is a boolean
+    """
+    def factory(cursor, row):
+        return row[:index] + (bool(row[index]),) + row[index + 1:]
+    return factory
+
+def _patched_factory(cursor, row):
+    return Note(*row[:5]), row[5]
+
+def _summary_factory(cursor, row):
+    return NoteSummary(*row)
+
+def _job_factory(cursor, row):
+    return Job(*row)
+
+def _token_factory(cursor, row):
+    return Token(*row)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of SQLite connections
+
+    At most `size` connections are opened. A thread that already holds a
+    connection gets the same one back on nested acquires, so a request never
+    needs more than one slot. Threads block for up to `timeout` seconds when
+    the pool is exhausted.
+    """
+    def __init__(self, path, size=5, timeout=30.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            uri=self.path.startswith("file:")
+        )
+        conn.row_factory = _dict_factory
+        conn.create_function("sha256", 1, content_checksum, deterministic=True)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self):
+        """
+        Get a connection for the current thread
+        """
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    conn = self._connect()
+                    self._connections.append(conn)
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise RuntimeError("Timed out waiting for a database connection")
+
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        """
+        Hand a connection back once the outermost acquire is done with it
+        """
+        if getattr(self._local, "conn", None) is not conn:
+            return
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close_all(self):
+        """
+        Close every connection the pool has opened
+        """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._created = 0
+            self._idle = queue.LifoQueue()
+
+
+class SQLiteStore:
+    """
+    Store backed by SQLite through the connection pool
+
+    Every operation uses a fixed statement, so each one is compiled once per
+    connection and then served from the statement cache.
+
+    Users being deleted keep their row with `deleted` set until their notes
+    are reclaimed; every read filters them and their notes out, so all
+    processes sharing the database stop serving them at once.
+
+    The token signing key and a revocation counter live in the meta table,
+    so every process agrees on both.
+    """
+    # Columns that may be changed through update_note
+    NOTE_COLUMNS = ("title", "content")
+    # Expressions of the columns listings may be projected on, anything
+    # else (passwords, the deleted flag) cannot be selected through them
+    USER_EXPRESSIONS = {"id": "id", "name": "name", "email": "email", "admin": "admin"}
+    NOTE_EXPRESSIONS = {
+        "id": "id", "title": "title", "content": "content", "owner_id": "owner_id", "version": "version",
+        "size": "length(CAST(content AS BLOB))", "snippet": f"substr(content, 1, {SNIPPET_LENGTH})"
+    }
+    # Bumps the revocation counter that token caches compare against
+    REVOKE = "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'revocations'"
+    # Condition that keeps writes away from the notes of hidden users
+    VISIBLE = "NOT EXISTS (SELECT 1 FROM users WHERE users.id = notes.owner_id AND users.deleted)"
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.epoch = self._one("SELECT value FROM meta WHERE key = 'epoch'")["value"]
+        self.secret_key = self._one("SELECT value FROM meta WHERE key = 'secret_key'")["value"]
+
+    @staticmethod
+    def _execute(conn, sql, args, factory):
+        if factory is None:
+            return conn.execute(sql, args)
+        cursor = conn.cursor()
+        cursor.row_factory = factory
+        return cursor.execute(sql, args)
+
+    def _one(self, sql, args=(), factory=None):
+        conn = self.pool.acquire()
+        try:
+            row = self._execute(conn, sql, args, factory).fetchone()
+        finally:
+            self.pool.release(conn)
+        _scanned(0 if row is None else 1)
+        return row
+
+    def _all(self, sql, args=(), factory=None):
+        conn = self.pool.acquire()
+        try:
+            rows = self._execute(conn, sql, args, factory).fetchall()
+        finally:
+            self.pool.release(conn)
+        _scanned(len(rows))
+        return rows
+
+    def _write(self, sql, args=()):
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                return conn.execute(sql, args)
+        finally:
+            self.pool.release(conn)
+
+    def _write_returning(self, sql, args=(), factory=None):
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                row = self._execute(conn, sql, args, factory).fetchone()
+        finally:
+            self.pool.release(conn)
+        _scanned(0 if row is None else 1)
+        return row
+
+    def get_user(self, user_id):
+        return self._one("SELECT * FROM users WHERE id = ? AND NOT deleted", (user_id,), _user_factory)
+
+    def user_by_email(self, email):
+        return self._one("SELECT * FROM users WHERE email = ? AND NOT deleted", (email,), _user_factory)
+
+    def user_by_name(self, name):
+        return self._one("SELECT * FROM users WHERE name = ? AND NOT deleted", (name,), _user_factory)
+
+    def all_users(self, after=None, limit=None):
+        return self._all(
+            "SELECT * FROM users WHERE id > ? AND NOT deleted ORDER BY id LIMIT ?",
+            (-1 if after is None else after, -1 if limit is None else limit),
+            _user_factory
+        )
+
+    def user_columns(self, columns, after=None, limit=None):
+        """
+        all_users as tuples of the given columns, selecting only those
+        """
+        select = ", ".join(self.USER_EXPRESSIONS[column] for column in columns)
+        factory = None
+        if "admin" in columns:
+            factory = _bool_factory(columns.index("admin"))
+        return self._all(
+            f"SELECT {select} FROM users WHERE id > ? AND NOT deleted ORDER BY id LIMIT ?",
+            (-1 if after is None else after, -1 if limit is None else limit),
+            factory or _tuple_factory
+        )
+
+    def count_users(self):
+        count = self._one("SELECT COUNT(*) AS count FROM users WHERE NOT deleted")["count"]
+        # COUNT(*) walks the smallest index of the table
+        _scanned(count)
+        return count
+
+    def insert_user(self, user):
+        try:
+            cursor = self._write(
+                "INSERT INTO users (name, email, password, admin) VALUES (?, ?, ?, ?)",
+                (user.name, user.email, user.password, user.admin)
+            )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUser(str(e)) from None
+        user.id = cursor.lastrowid
+        return cursor.lastrowid
+
+    def delete_user(self, user_id):
+        # Notes and tokens are removed by the ON DELETE CASCADE foreign keys
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                user = self._execute(
+                    conn, "DELETE FROM users WHERE id = ? AND NOT deleted RETURNING *", (user_id,), _user_factory
+                ).fetchone()
+                if user is not None:
+                    conn.execute(self.REVOKE)
+        finally:
+            self.pool.release(conn)
+        return user
+
+    def hide_user(self, user_id):
+        """
+        Hide a user and their notes from every read, returns the user and
+        the number of notes left to reclaim
+        """
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                user = self._execute(
+                    conn, "UPDATE users SET deleted = 1 WHERE id = ? AND NOT deleted RETURNING *", (user_id,),
+                    _user_factory
+                ).fetchone()
+                if user is None:
+                    return None
+                conn.execute("DELETE FROM tokens WHERE user_id = ?", (user_id,))
+                conn.execute(self.REVOKE)
+                count = conn.execute(
+                    "SELECT COUNT(*) AS count FROM notes WHERE owner_id = ?", (user_id,)
+                ).fetchone()["count"]
+        finally:
+            self.pool.release(conn)
+        _scanned(count)
+        return user, count
+
+    def reclaim_notes(self, user_id, limit):
+        """
+        Delete up to `limit` notes of a hidden user, returns how many went
+        """
+        cursor = self._write(
+            "DELETE FROM notes WHERE id IN (SELECT id FROM notes WHERE owner_id = ? ORDER BY id DESC LIMIT ?) "
+            "AND EXISTS (SELECT 1 FROM users WHERE id = ? AND deleted)",
+            (user_id, limit, user_id)
+        )
+        _scanned(cursor.rowcount)
+        return cursor.rowcount
+
+    def purge_user(self, user_id):
+        """
+        Remove a hidden user whose notes have all been reclaimed
+        """
+        return self._write_returning(
+            "DELETE FROM users WHERE id = ? AND deleted AND NOT EXISTS (SELECT 1 FROM notes WHERE owner_id = ?) "
+            "RETURNING *", (user_id, user_id), _user_factory
+        )
+
+    def hidden_users(self):
+        return [row["id"] for row in self._all("SELECT id FROM users WHERE deleted ORDER BY id")]
+
+    def last_change(self):
+        """
+        Sequence number of the latest change in the changes table, 0 if none
+        """
+        row = self._one("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+        return 0 if row is None else row["seq"]
+
+    def changes_after(self, owner_id, since, limit):
+        """
+        Up to `limit` changes of an owner after `since` as (seq, owner_id,
+        event, note_id, version) tuples, with the sequence numbers of the
+        latest change and of the oldest one kept. Changes are read up to
+        the latest only, and the oldest after them: trimming goes oldest
+        first, so if it has not passed `since` by then, no change after
+        `since` was missing when they were read.
+        """
+        conn = self.pool.acquire()
+        try:
+            last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            last = 0 if last is None else last["seq"]
+            rows = self._execute(
+                conn, "SELECT seq, owner_id, event, note_id, version FROM changes "
+                "WHERE owner_id = ? AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (owner_id, since, last, limit), _tuple_factory
+            ).fetchall()
+            oldest = conn.execute("SELECT min(seq) AS seq FROM changes").fetchone()["seq"]
+        finally:
+            self.pool.release(conn)
+        _scanned(len(rows))
+        return rows, last, oldest
+
+    def keep_changes(self, capacity):
+        """
+        Set how many changes the changes table keeps, for every process
+        """
+        self._write(
+            "INSERT INTO meta (key, value) VALUES ('changes_capacity', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (str(capacity),)
+        )
+
+    def insert_token(self, token):
+        self._write(
+            "INSERT INTO tokens (id, user_id, expires_at) VALUES (?, ?, ?)",
+            (token.id, token.user_id, token.expires_at)
+        )
+
+    def get_token(self, token_id, now):
+        """
+        Look up a token that has not expired and belongs to a visible user
+        """
+        return self._one(
+            "SELECT tokens.* FROM tokens JOIN users ON users.id = tokens.user_id "
+            "WHERE tokens.id = ? AND tokens.expires_at > ? AND NOT users.deleted", (token_id, now), _token_factory
+        )
+
+    def delete_token(self, token_id):
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                token = self._execute(
+                    conn, "DELETE FROM tokens WHERE id = ? RETURNING *", (token_id,), _token_factory
+                ).fetchone()
+                if token is not None:
+                    conn.execute(self.REVOKE)
+        finally:
+            self.pool.release(conn)
+        return token
+
+    def delete_expired_tokens(self, now):
+        return self._write("DELETE FROM tokens WHERE expires_at <= ?", (now,)).rowcount
+
+    def auth_version(self):
+        return int(self._one("SELECT value FROM meta WHERE key = 'revocations'")["value"])
+
+    def get_note(self, note_id):
+        return self._one(
+            "SELECT notes.* FROM notes JOIN users ON users.id = notes.owner_id "
+            "WHERE notes.id = ? AND NOT users.deleted", (note_id,), _note_factory
+        )
+
+    def notes_by_owner(self, owner_id, after=None, limit=None):
+        return self._all(
+            "SELECT * FROM notes WHERE owner_id = ? AND id > ? "
+            "AND NOT EXISTS (SELECT 1 FROM users WHERE id = ? AND deleted) ORDER BY id LIMIT ?",
+            (owner_id, -1 if after is None else after, owner_id, -1 if limit is None else limit),
+            _note_factory
+        )
+
+    def note_summaries(self, owner_id, after=None, limit=None):
+        """
+        notes_by_owner without the contents, only their size and snippet
+        leave the database
+        """
+        return self._all(
+            "SELECT id, title, owner_id, version, length(CAST(content AS BLOB)), substr(content, 1, ?) "
+            "FROM notes WHERE owner_id = ? AND id > ? "
+            "AND NOT EXISTS (SELECT 1 FROM users WHERE id = ? AND deleted) ORDER BY id LIMIT ?",
+            (SNIPPET_LENGTH, owner_id, -1 if after is None else after, owner_id, -1 if limit is None else limit),
+            _summary_factory
+        )
+
+    def note_columns(self, owner_id, columns, after=None, limit=None):
+        """
+        notes_by_owner as tuples of the given columns, selecting only those
+        """
+        select = ", ".join(self.NOTE_EXPRESSIONS[column] for column in columns)
+        return self._all(
+            f"SELECT {select} FROM notes WHERE owner_id = ? AND id > ? "
+            "AND NOT EXISTS (SELECT 1 FROM users WHERE id = ? AND deleted) ORDER BY id LIMIT ?",
+            (owner_id, -1 if after is None else after, owner_id, -1 if limit is None else limit),
+            _tuple_factory
+        )
+
+    def all_notes(self):
+        return self._all(
+            "SELECT notes.* FROM notes JOIN users ON users.id = notes.owner_id "
+            "WHERE NOT users.deleted ORDER BY notes.id", (), _note_factory
+        )
+
+    def count_notes(self):
+        count = self._one(
+            "SELECT (SELECT COUNT(*) FROM notes) - (SELECT COUNT(*) FROM notes WHERE owner_id IN "
+            "(SELECT id FROM users WHERE deleted)) AS count"
+        )["count"]
+        # COUNT(*) walks the smallest index of the table
+        _scanned(count)
+        return count
+
+    def insert_note(self, note):
+        cursor = self._write(
+            "INSERT INTO notes (title, content, owner_id) VALUES (?, ?, ?)",
+            (note.title, note.content, note.owner_id)
+        )
+        note.id = cursor.lastrowid
+        note.version = 1
+        return cursor.lastrowid
+
+    def collection_version(self, owner_id):
+        row = self._one("SELECT version FROM note_collections WHERE owner_id = ?", (owner_id,))
+        return 0 if row is None else row["version"]
+
+    def update_note(self, note_id, changes, expected_version=None):
+        columns = [column for column in self.NOTE_COLUMNS if column in changes]
+        assignments = "".join(f"{column} = ?, " for column in columns)
+        args = [changes[column] for column in columns] + [note_id]
+        if expected_version is None:
+            return self._write_returning(
+                f"UPDATE notes SET {assignments}version = version + 1 WHERE id = ? AND {self.VISIBLE} RETURNING *",
+                args, _note_factory
+            )
+        row = self._write_returning(
+            f"UPDATE notes SET {assignments}version = version + 1 WHERE id = ? AND version = ? "
+            f"AND {self.VISIBLE} RETURNING *",
+            args + [expected_version], _note_factory
+        )
+        if row is None and self.get_note(note_id) is not None:
+            raise VersionConflict(note_id)
+        return row
+
+    def patch_note(self, note_id, owner_id, edits, base_version):
+        """
+        MemoryStore.patch_note done in one UPDATE: the new content is spliced
+        together from substrings of the old one by SQLite and only its
+        checksum comes back, the returned row holds no content
+        """
+        assignment = "content = "
+        args = []
+        previous = 0
+        for start, end, text in edits:
+            assignment += "substr(content, ?, ?) || ? || "
+            args += [previous + 1, start - previous, text]
+            previous = end
+        assignment += "substr(content, ?)"
+        args += [previous + 1, note_id, owner_id, base_version, previous]
+        row = self._write_returning(
+            f"UPDATE notes SET {assignment}, version = version + 1 WHERE id = ? AND owner_id = ? AND version = ? "
+            f"AND length(content) >= ? AND {self.VISIBLE} RETURNING id, title, NULL, owner_id, version, sha256(content)",
+            args, _patched_factory
+        )
+        if row is not None:
+            return row
+        current = self._one(
+            f"SELECT owner_id, version FROM notes WHERE id = ? AND {self.VISIBLE}", (note_id,)
+        )
+        if current is None or current["owner_id"] != owner_id:
+            return None
+        if current["version"] != base_version:
+            raise VersionConflict(note_id)
+        raise InvalidEdit(note_id)
+
+    def delete_note(self, note_id):
+        return self._write_returning(
+            f"DELETE FROM notes WHERE id = ? AND {self.VISIBLE} RETURNING *", (note_id,), _note_factory
+        )
+
+    def search_notes(self, owner_id, terms, limit):
+        """
+        Return up to `limit` (note_id, score) pairs containing every term
+
+        Scores are bm25, whose term weights come from the notes of every
+        owner; the owner column is matched but carries no weight.
+        """
+        match = 'owner_id : "%d" ' % owner_id + " ".join(
+            '{title content} : "%s"' % term.replace('"', '""') for term in terms
+        )
+        rows = self._all(
+            "SELECT rowid AS id, -bm25(notes_fts, 3.0, 1.0, 0.0) AS score FROM notes_fts "
+            "WHERE notes_fts MATCH ? ORDER BY score DESC LIMIT ?",
+            (match, limit)
+        )
+        return [(row["id"], row["score"]) for row in rows]
+
+    def notes_by_ids(self, note_ids):
+        note_ids = list(note_ids)
+        if not note_ids:
+            return {}
+        placeholders = ", ".join("?" * len(note_ids))
+        rows = self._all(
+            f"SELECT notes.* FROM notes JOIN users ON users.id = notes.owner_id "
+            f"WHERE notes.id IN ({placeholders}) AND NOT users.deleted", note_ids, _note_factory
+        )
+        return {row.id: row for row in rows}
+
+    def create_job(self, job):
+        self._write(
+            f"INSERT INTO jobs ({', '.join(Job.__slots__)}) VALUES ({', '.join('?' * len(Job.__slots__))})",
+            job.to_tuple()
+        )
+        return job
+
+    def get_job(self, job_id):
+        return self._one("SELECT * FROM jobs WHERE id = ?", (job_id,), _job_factory)
+
+    def update_job(self, job_id, changes, progress=0):
+        """
+        Set columns of a job and add `progress` to its done count
+        """
+        assignments = "".join(f"{column} = ?, " for column in changes if column in Job.__slots__)
+        args = [value for column, value in changes.items() if column in Job.__slots__]
+        return self._write_returning(
+            f"UPDATE jobs SET {assignments}done = done + ? WHERE id = ? RETURNING *",
+            args + [progress, job_id], _job_factory
+        )
+
+    def claim_job(self, job_id, owner, lease_until, now):
+        """
+        Mark a job running for `owner` until `lease_until`, in one statement
+        so only one runner of all the processes gets it; see
+        MemoryStore.claim_job
+        """
+        return self._write_returning(
+            "UPDATE jobs SET status = 'running', owner = ?, lease_until = ? WHERE id = ? AND "
+            "(status = 'queued' OR status = 'running' AND (owner = ? OR lease_until IS NULL OR lease_until < ?)) "
+            "RETURNING *",
+            (owner, lease_until, job_id, owner, now), _job_factory
+        )
+
+    def unfinished_jobs(self):
+        return self._all(
+            "SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at", (), _job_factory
+        )
+
+    def apply_batch(self, operations):
+        """
+        Apply (op, ...) tuples in one transaction, returns the affected rows;
+        see MemoryStore.apply_batch
+        """
+        results = []
+        # Versions are those from before the batch, which only the first
+        # operation on a note can still check
+        changed = set()
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                for operation in operations:
+                    if operation[0] == "create":
+                        note = operation[1]
+                        cursor = conn.execute(
+                            "INSERT INTO notes (title, content, owner_id) VALUES (?, ?, ?)",
+                            (note.title, note.content, note.owner_id)
+                        )
+                        note.id = cursor.lastrowid
+                        note.version = 1
+                        row = note
+                    elif operation[0] == "update":
+                        note_id, changes = operation[1], operation[2]
+                        expected = operation[3:] if note_id not in changed else ()
+                        columns = [column for column in self.NOTE_COLUMNS if column in changes]
+                        assignments = "".join(f"{column} = ?, " for column in columns)
+                        row = self._execute(
+                            conn,
+                            f"UPDATE notes SET {assignments}version = version + 1 WHERE id = ? AND {self.VISIBLE}"
+                            f"{' AND version = ?' if expected else ''} RETURNING *",
+                            [changes[column] for column in columns] + [note_id, *expected], _note_factory
+                        ).fetchone()
+                    elif operation[0] == "delete":
+                        expected = operation[2:] if operation[1] not in changed else ()
+                        row = self._execute(
+                            conn,
+                            f"DELETE FROM notes WHERE id = ? AND {self.VISIBLE}"
+                            f"{' AND version = ?' if expected else ''} RETURNING *",
+                            (operation[1], *expected), _note_factory
+                        ).fetchone()
+                    else:
+                        raise ValueError(f"Unknown batch operation: {operation[0]}")
+                    if row is None:
+                        # Tell a note at another version from a missing one
+                        if expected and conn.execute(
+                            f"SELECT 1 FROM notes WHERE id = ? AND {self.VISIBLE}", (operation[1],)
+                        ).fetchone():
+                            raise VersionConflict(operation[1])
+                        raise KeyError(operation[1])
+                    changed.add(row.id)
+                    results.append(row)
+        finally:
+            self.pool.release(conn)
+        return results
+
+
+def _migrate_autoincrement(conn, table):
+    """
+    Rebuild a table created without AUTOINCREMENT so its ids are not reused
+
+    SQLite cannot add AUTOINCREMENT in place, so the rows are copied into a
+    new table that replaces the old one. Indexes and triggers go with the old
+    table and are recreated by init_db afterwards.
+    """
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if sql is None or "AUTOINCREMENT" in sql["sql"].upper():
+        return False
+    create = sql["sql"].replace(f"CREATE TABLE {table} (", f"CREATE TABLE {table}_rebuild (", 1)
+    create = create.replace("id INTEGER PRIMARY KEY", "id INTEGER PRIMARY KEY AUTOINCREMENT", 1)
+    columns = ", ".join(row["name"] for row in conn.execute(f"PRAGMA table_info({table})"))
+
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        with conn:
+            conn.execute(create)
+            conn.execute(f"INSERT INTO {table}_rebuild ({columns}) SELECT {columns} FROM {table}")
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+    logger.info("Rebuilt table %s with AUTOINCREMENT ids", table)
+    return True
+
+def _seed(memory_store):
+    """
+    Give a new memory store the same users and notes as the mock
+    """
+    for user in mock_users:
+        memory_store.insert_user(user.replace({}))
+    for note in mock_notes:
+        memory_store.insert_note(note.replace({"content": note.text()}))
+
+def init_db(db_backend="memory", path="notes.db", pool_size=5, data_dir=None, fsync="interval",
+            fsync_interval=1.0, snapshot_interval=300, snapshot_bytes=64 * 1024 * 1024,
+            blob_threshold=64 * 1024):
+    """
+    Select the database backend and prepare it for use
+
+    With `data_dir` the memory backend is loaded from, and logs every write
+    to, that directory instead of starting from the mock tables; the other
+    arguments are passed on to wal.Persistence.
+
+    The memory backend keeps note contents of `blob_threshold` characters or
+    more out of line (0 turns this off): in `data_dir`/blobs, or else in a
+    temporary directory removed when the process exits.
+    """
+    global backend, store, persistence, _pool, _scratch_blobs
+
+    if db_backend not in ("memory", "sqlite"):
+        raise ValueError(f"Unknown database backend: {db_backend}")
+
+    if _pool is not None:
+        _pool.close_all()
+        _pool = None
+    close_persistence()
+
+    backend = db_backend
+    store = MemoryStore(mock_users, mock_notes)
+    if backend == "memory" and data_dir:
+        store = MemoryStore(*new_tables())
+        # Kept even with blob_threshold 0, the snapshot may refer to blobs
+        store.blobs = BlobStore(os.path.join(data_dir, "blobs"), blob_threshold, durable=True,
+                                fsync=fsync != "never")
+        persistence = wal.Persistence(data_dir, fsync, fsync_interval, snapshot_interval, snapshot_bytes)
+        persistence.open(store, seed=_seed)
+    elif backend == "memory" and (blob_threshold or _scratch_blobs is not None):
+        if _scratch_blobs is None:
+            _scratch_blobs = BlobStore(tempfile.mkdtemp(prefix="notes-blobs-"), blob_threshold)
+        _scratch_blobs.threshold = blob_threshold
+        store.blobs = _scratch_blobs
+    if backend == "sqlite":
+        _pool = ConnectionPool(path, size=pool_size)
+        conn = _pool.acquire()
+        try:
+            conn.executescript(SCHEMA)
+            for table, column, statement in MIGRATIONS:
+                columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    conn.execute(statement)
+            if any([_migrate_autoincrement(conn, table) for table in AUTOINCREMENT_TABLES]):
+                conn.executescript(SCHEMA)
+            conn.executescript(INDEXES)
+            conn.executescript(TRIGGERS)
+            conn.executescript(CHANGES_SCHEMA)
+            search = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'notes_fts'").fetchone()
+            has_search = search is not None and "UNINDEXED" not in search["sql"]
+            if search is not None and not has_search:
+                # Built before owners were indexed, its triggers carry over
+                conn.execute("DROP TABLE notes_fts")
+            conn.executescript(SEARCH_SCHEMA)
+            if not has_search:
+                with conn:
+                    conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                    [("epoch", secrets.token_hex(4)), ("secret_key", secrets.token_hex(32)), ("revocations", "0")]
+                )
+            if conn.execute("SELECT COUNT(*) AS count FROM users").fetchone()["count"] == 0:
+                # Seed an empty database with the same data as the mock
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO users (id, name, email, password, admin) VALUES (?, ?, ?, ?, ?)",
+                        [(u.id, u.name, u.email, u.password, u.admin) for u in mock_users]
+                    )
+                    conn.executemany(
+                        "INSERT INTO notes (id, title, content, owner_id) VALUES (?, ?, ?, ?)",
+                        [(n.id, n.title, n.text(), n.owner_id) for n in mock_notes]
+                    )
+        finally:
+            _pool.release(conn)
+        store = SQLiteStore(_pool)
+
+    logger.info("Using %s database backend", backend)
+
+def close_persistence():
+    """
+    Stop logging the memory store's writes and force the log to disk
+    """
+    global persistence
+    if persistence is not None:
+        persistence.close()
+        persistence = None
+
+atexit.register(close_persistence)
+
+def _remove_scratch_blobs():
+    if _scratch_blobs is not None:
+        _scratch_blobs.close()
+
+atexit.register(_remove_scratch_blobs)
+
+def close_all_connections():
+    """
+    Close every pooled SQLite connection; the pool reopens them on demand
+    """
+    if _pool is not None:
+        _pool.close_all()
+
 def get_db_connection():
     """
-    Mock function to simulate database connection
-    In a real application, this would connect to SQLite
+    Get a pooled SQLite connection
+    Returns None when the in-memory mock backend is selected
     """
-    logger.info("Getting database connection")
-    return None
+    logger.debug("Getting database connection")
+    if _pool is None:
+        return None
+    return _pool.acquire()
 
 def close_db_connection(conn):
     """
-    Mock function to simulate closing database connection
+    Return a connection obtained from get_db_connection to the pool
     """
-    logger.info("Closing database connection")
-    return None
\ No newline at end of file
+    logger.debug("Closing database connection")
+    if _pool is not None and conn is not None:
+        _pool.release(conn)
+    return None
@@ -0,0 +1,92 @@
+import logging
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """
+    Flask's default provider plus `encode`, compact JSON as bytes
+    """
+    def encode(self, obj):
+        """
+        Serialize obj to compact UTF-8 JSON bytes
+        """
+        return self.dumps(obj, separators=(",", ":")).encode()
+
+
+class OrjsonProvider(StdlibJSONProvider):
+    """
+    JSON provider backed by the orjson C extension
+
+    Output matches the default provider: sorted keys, and dates, dataclasses
+    and other extra types go through the same `default` function. Values
+    orjson cannot represent (such as ints over 64 bits or non-string keys)
+    fall back to the stdlib encoder. Non-ASCII text is written as UTF-8
+    rather than escaped.
+    """
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson else 0
+
+    def _options(self, indent=None):
+        options = self.OPTIONS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def encode(self, obj, indent=None):
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options(indent))
+        except TypeError:
+            layout = {"indent": indent} if indent else {"separators": (",", ":")}
+            return DefaultJSONProvider.dumps(self, obj, **layout).encode()
+
+    def dumps(self, obj, **kwargs):
+        # orjson only writes the compact layout and that of indent=2, other
+        # layouts (including json.dumps's default one) go to the stdlib
+        indent = kwargs.get("indent")
+        separators = kwargs.get("separators")
+        if kwargs.keys() - {"indent", "separators"} or not (
+            (not indent and separators == (",", ":")) or (indent == 2 and separators in (None, (",", ": ")))
+        ):
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj, indent).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # Let the stdlib parser decide, it also accepts NaN and Infinity
+            return super().loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        return self._app.response_class(self.encode(obj, indent) + b"\n", mimetype=self.mimetype)
+
+
+PROVIDERS = {"orjson": OrjsonProvider, "stdlib": StdlibJSONProvider}
+
+
+def json_provider(name="auto"):
+    """
+    Provider class for a JSON_PROVIDER setting: orjson, stdlib, or auto
+    (orjson when it is installed)
+    """
+    if name == "auto":
+        name = "orjson" if orjson is not None else "stdlib"
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown JSON provider: {name}")
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER=orjson needs the orjson package")
+    return PROVIDERS[name]
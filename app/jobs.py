@@ -0,0 +1,130 @@
+import logging
+import os
+import queue
+import secrets
+import socket
+import threading
+import time
+
+from app.crud import UserRepo, JobRepo
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """
+    Runs background jobs one at a time on a daemon thread
+
+    Deleting a user is split in two: the request hides the user and their
+    notes, which is a single write, and this runner reclaims the notes in
+    chunks of `chunk_size` with a pause between chunks so the deletion never
+    holds the store for long. Job records live in the store, so any process
+    sharing a SQLite database can report on them and pick up the jobs a
+    stopped process left unfinished.
+
+    A runner only runs a job it has claimed in the store, which hands each
+    job to one runner. The claim is a lease of `lease` seconds, renewed after
+    every chunk; a job whose lease ran out was left by a stopped process, and
+    idle runners look for those every `lease` seconds and take them over.
+    """
+    def __init__(self, chunk_size=500, pause=0.01, lease=30.0):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, chunk_size=500, pause=0.01):
+        self.chunk_size = chunk_size
+        self.pause = pause
+
+    def start(self):
+        """
+        Start the worker thread and resume unfinished jobs, once per process
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="jobs", daemon=True)
+            self._thread.start()
+        self._resume()
+
+    def delete_user(self, user_id):
+        """
+        Hide a user now and reclaim their notes in the background
+
+        Returns the job, or None if there is no such user.
+        """
+        total = UserRepo.hide(user_id)
+        if total is None:
+            return None
+        job = JobRepo.create("delete_user", user_id, total)
+        self.start()
+        self._enqueue(job.id, user_id)
+        return job
+
+    def _enqueue(self, job_id, user_id):
+        with self._lock:
+            if job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        self._queue.put((job_id, user_id))
+
+    def _resume(self):
+        for job in JobRepo.unfinished():
+            self._enqueue(job.id, job.target_id)
+
+    def _run(self):
+        while True:
+            try:
+                job_id, user_id = self._queue.get(timeout=self.lease)
+            except queue.Empty:
+                self._resume()
+                continue
+            try:
+                if JobRepo.claim(job_id, self.owner, self.lease) is None:
+                    logger.debug("Job %s is finished or held by another runner", job_id)
+                    continue
+                self._delete_user(job_id, user_id)
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                JobRepo.finish(job_id, error=str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(job_id)
+
+    def _delete_user(self, job_id, user_id):
+        while True:
+            reclaimed = UserRepo.reclaim_notes(user_id, self.chunk_size)
+            if reclaimed:
+                JobRepo.update(job_id, progress=reclaimed)
+            if reclaimed < self.chunk_size:
+                break
+            if JobRepo.claim(job_id, self.owner, self.lease) is None:
+                logger.warning("Job %s was taken over by another runner", job_id)
+                return
+            time.sleep(self.pause)
+        UserRepo.purge(user_id)
+        JobRepo.finish(job_id)
+        logger.info("Job %s finished deleting user %s", job_id, user_id)
+
+    def wait(self, timeout=None):
+        """
+        Block until every queued job has run, for tests and benchmarks
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+
+# Runner of the process
+runner = JobRunner()
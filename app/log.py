@@ -0,0 +1,199 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Request id of the request being handled on this thread/context
+request_id = contextvars.ContextVar("request_id", default="-")
+
+# Keys whose values never reach a log line
+SENSITIVE_KEYS = frozenset({"password", "token", "content", "secret", "secret_key"})
+REDACTED = "[REDACTED]"
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if k in SENSITIVE_KEYS else _redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_redact(v) for v in value)
+    return value
+
+
+class ContextFilter(logging.Filter):
+    """
+    Stamp records with the current request id and redact sensitive payloads
+
+    Runs on the calling thread, before the record is queued, so it sees the
+    request context and the arguments as they were when the call was made.
+    """
+    def filter(self, record):
+        record.request_id = request_id.get()
+        if record.args:
+            record.args = _redact(record.args)
+        for key in vars(record).keys() - _RECORD_ATTRS:
+            setattr(record, key, _redact(getattr(record, key)))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of the records below WARNING for selected loggers
+
+    `rates` maps a logger name to the fraction to keep; it also applies to
+    child loggers. Warnings and errors are never sampled out.
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self.sampled_out = 0
+        self._cache = {}
+
+    def _rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split(".")
+            for i in range(len(parts), 0, -1):
+                prefix = ".".join(parts[:i])
+                if prefix in self.rates:
+                    rate = float(self.rates[prefix])
+                    break
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, including any fields passed through `extra`
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage()
+        }
+        for key in vars(record).keys() - _RECORD_ATTRS:
+            entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks and leaves formatting to the listener
+
+    The stdlib handler formats every message on the calling thread; this one
+    queues the record as is so %-formatting, JSON encoding and I/O all happen
+    on the listener thread. When the queue is full the record is dropped and
+    counted instead of stalling the request.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_sampler = None
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+def _start_listener():
+    if _listener is not None and _listener._thread is None:
+        _listener.start()
+
+
+def configure_logging(level="INFO", fmt="text", sampling=None, log_file=None, queue_size=10000):
+    """
+    Configure logging for the whole process
+
+    Every logger propagates to a single non-blocking queue handler on the
+    root logger; a background listener thread formats the records (as text
+    or JSON) and writes them to stderr and, optionally, to `log_file`.
+    Calling it again replaces the previous configuration.
+
+    Werkzeug sets its own logger to INFO unless it has a level already,
+    which would let its access lines through any configured level; it is
+    given the configured level too.
+    """
+    global _handler, _listener, _sampler
+
+    _stop_listener()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        outputs.append(logging.FileHandler(log_file))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    _sampler = SamplingFilter(sampling or {})
+    _handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    _handler.addFilter(_sampler)
+    _handler.addFilter(ContextFilter())
+    root.addHandler(_handler)
+    root.setLevel(level)
+    logging.getLogger("werkzeug").setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_handler.queue, *outputs, respect_handler_level=True)
+    _listener.start()
+
+
+def stats():
+    """
+    Counters that show what logging costs and loses
+    """
+    if _handler is None:
+        return {}
+    return {
+        "enqueued": _handler.enqueued,
+        "dropped": _handler.dropped,
+        "sampled_out": _sampler.sampled_out,
+        "queue_size": _handler.queue.qsize(),
+        "level": logging.getLevelName(logging.getLogger().level)
+    }
+
+
+# Flush whatever is still queued on exit, and make sure the listener thread
+# does not hold the queue's lock across a fork (worker processes restart it)
+atexit.register(_stop_listener)
+os.register_at_fork(before=_stop_listener, after_in_parent=_start_listener, after_in_child=_start_listener)
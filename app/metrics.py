@@ -0,0 +1,204 @@
+import bisect
+import threading
+import time
+
+from app import db
+
+# Request latency buckets in seconds, finer than the Prometheus defaults at
+# the low end because most requests are served from memory
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Store operations are mostly sub-millisecond
+STORE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 1)
+
+# Store methods that are timed and counted
+STORE_OPERATIONS = (
+    "get_user", "user_by_email", "user_by_name", "all_users", "user_columns", "count_users", "insert_user", "delete_user",
+    "hide_user", "reclaim_notes", "purge_user", "insert_token", "get_token", "delete_token", "auth_version",
+    "get_note", "notes_by_owner", "note_summaries", "note_columns", "all_notes", "count_notes", "collection_version", "insert_note",
+    "update_note", "patch_note", "delete_note", "notes_by_ids", "apply_batch", "search_notes",
+    "last_change", "changes_after"
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base for a family of samples that share a name and label names
+
+    Values are kept per tuple of label values and updated under one lock, so
+    recording a sample is a dict lookup and an addition.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            lines.extend(self._samples(labelvalues, value))
+        return lines
+
+    def _samples(self, labelvalues, value):
+        yield f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labelvalues=(), amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, labelvalues=(), amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, labelvalues=(), amount=1):
+        self.inc(labelvalues, -amount)
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets; each label set holds one count per bucket
+    plus the running sum, made cumulative only when rendered
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labelvalues, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[position] += 1
+            state[-1] += value
+
+    def _samples(self, labelvalues, state):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), state):
+            cumulative += count
+            le = f'le="{_number(bound)}"'
+            yield f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}"
+        labels = _labels(self.labelnames, labelvalues)
+        yield f"{self.name}_sum{labels} {_number(state[-1])}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the whole process
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "notes_http_requests_total", "HTTP requests handled", ("method", "route", "status")))
+request_duration = registry.register(Histogram(
+    "notes_http_request_duration_seconds", "Time spent handling HTTP requests", ("method", "route")))
+requests_in_flight = registry.register(Gauge(
+    "notes_http_requests_in_flight", "HTTP requests currently being handled", ("method", "route")))
+requests_limited = registry.register(Counter(
+    "notes_http_requests_limited_total", "HTTP requests refused by rate limiting", ("scope", "route")))
+
+store_duration = registry.register(Histogram(
+    "notes_store_operation_duration_seconds", "Time spent in store operations", ("backend", "op"),
+    buckets=STORE_BUCKETS))
+store_rows_scanned = registry.register(Counter(
+    "notes_store_rows_scanned_total", "Rows visited by store operations", ("backend", "op")))
+store_rows_returned = registry.register(Counter(
+    "notes_store_rows_returned_total", "Rows returned by store operations", ("backend", "op")))
+store_errors = registry.register(Counter(
+    "notes_store_errors_total", "Store operations that raised", ("backend", "op")))
+queries_total = registry.register(Counter(
+    "notes_query_db_total", "query_db calls by how they were executed", ("plan",)))
+
+
+def count_rows(result):
+    """
+    Number of rows in a store result
+    """
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple, dict)):
+        return len(result)
+    return 1
+
+def observe_store(backend, op, seconds, scanned, returned):
+    labelvalues = (backend, op)
+    store_duration.observe(labelvalues, seconds)
+    store_rows_scanned.inc(labelvalues, scanned)
+    store_rows_returned.inc(labelvalues, returned)
+
+def _timed(backend, op, method):
+    def timed(*args, **kwargs):
+        scanned = db.rows_scanned()
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            store_errors.inc((backend, op))
+            raise
+        elapsed = time.perf_counter() - start
+        observe_store(backend, op, elapsed, db.rows_scanned() - scanned, count_rows(result))
+        return result
+    timed.__wrapped__ = method
+    timed.timed = True
+    return timed
+
+def instrument_store(store, backend):
+    """
+    Time and count every operation of a store instance
+
+    The wrappers are set on the instance, so callers keep going through
+    `db.store` and nothing changes for them. Methods that are wrapped
+    already, by an earlier call, are left as they are; other decorators
+    (such as the memory store's write-ahead logging) are not mistaken for it.
+    """
+    for op in STORE_OPERATIONS:
+        method = getattr(store, op, None)
+        if method is not None and not getattr(method, "timed", False):
+            setattr(store, op, _timed(backend, op, method))
+    return store
@@ -1,10 +1,56 @@
-# This file would normally contain SQLAlchemy models or other ORM definitions
-# For this mock application, we'll define the structure of our data models
+# Row types held by the stores. They use __slots__ instead of a per-instance
+# dict, which keeps a row at a fraction of the memory of the equivalent dict;
+# dicts are only built by to_dict when a row is serialized.
 
-class User:
+from app.blobs import Blob, SNIPPET_LENGTH
+
+
+class Record:
+    """
+    Base of the row types, fields are the slots in declaration order
+    """
+    __slots__ = ()
+
+    def to_dict(self, fields=None):
+        """
+        Plain dict of the given fields (all of them by default)
+        """
+        return {field: getattr(self, field) for field in fields or self.__slots__}
+
+    def to_tuple(self):
+        """
+        Field values in slot order, the form rows are logged and snapshotted in
+        """
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def replace(self, changes):
+        """
+        Copy of the record with the given fields changed, the original is untouched
+        """
+        copy = object.__new__(type(self))
+        for field in self.__slots__:
+            setattr(copy, field, changes[field] if field in changes else getattr(self, field))
+        return copy
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class User(Record):
     """
     User model structure
     """
+    __slots__ = ("id", "name", "email", "password", "admin")
+
+    # Fields that may be shown to other users
+    PUBLIC_FIELDS = ("id", "name", "email", "admin")
+
     def __init__(self, id, name, email, password, admin=False):
         self.id = id
         self.name = name
@@ -12,30 +58,113 @@ class User:
         self.password = password
         self.admin = admin
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "email": self.email,
-            "password": self.password,
-            "admin": self.admin
-        }
-
 
-class Note:
+class Note(Record):
     """
     Note model structure
+
+    `content` is a string, or the handle of a content kept out of line (see
+    app.blobs.Blob), which to_dict and text() read back in full.
     """
-    def __init__(self, id, title, content, owner_id):
+    __slots__ = ("id", "title", "content", "owner_id", "version")
+
+    # Fields a note listing may be projected on: its own and its summary's
+    LIST_FIELDS = ("id", "title", "content", "owner_id", "version", "size", "snippet")
+
+    def __init__(self, id, title, content, owner_id, version=1):
         self.id = id
         self.title = title
         self.content = content
         self.owner_id = owner_id
+        self.version = version
+
+    def text(self):
+        """
+        The whole content as a string
+        """
+        content = self.content
+        return content.read() if isinstance(content, Blob) else content
+
+    def to_dict(self, fields=None):
+        data = super().to_dict(fields)
+        if isinstance(data.get("content"), Blob):
+            data["content"] = self.content.read()
+        return data
+
+    def to_tuple(self):
+        content = self.content
+        if isinstance(content, Blob):
+            content = content.key
+        return self.id, self.title, content, self.owner_id, self.version
+
+    def size(self):
+        """
+        Size of the content in UTF-8 bytes
+        """
+        content = self.content
+        if isinstance(content, Blob):
+            return content.size
+        return len(content) if content.isascii() else len(content.encode("utf-8", "surrogatepass"))
+
+    def snippet(self):
+        """
+        The first SNIPPET_LENGTH characters of the content
+        """
+        content = self.content
+        return content.snippet if isinstance(content, Blob) else content[:SNIPPET_LENGTH]
+
+    def summary(self):
+        """
+        The note without its content, only its size and snippet
+        """
+        return NoteSummary(self.id, self.title, self.owner_id, self.version, self.size(), self.snippet())
+
+
+class NoteSummary(Record):
+    """
+    What note listings show unless asked for the content, see Note.summary
+    """
+    __slots__ = ("id", "title", "owner_id", "version", "size", "snippet")
+
+    def __init__(self, id, title, owner_id, version, size, snippet):
+        self.id = id
+        self.title = title
+        self.owner_id = owner_id
+        self.version = version
+        self.size = size
+        self.snippet = snippet
+
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "title": self.title,
-            "content": self.content,
-            "owner_id": self.owner_id
-        }
\ No newline at end of file
+class Job(Record):
+    """
+    Background job structure, `owner` is the runner holding its lease until
+    the `lease_until` timestamp
+    """
+    __slots__ = ("id", "kind", "target_id", "status", "total", "done", "error", "created_at", "finished_at",
+                 "owner", "lease_until")
+
+    def __init__(self, id, kind, target_id, status="queued", total=0, done=0, error=None,
+                 created_at=None, finished_at=None, owner=None, lease_until=None):
+        self.id = id
+        self.kind = kind
+        self.target_id = target_id
+        self.status = status
+        self.total = total
+        self.done = done
+        self.error = error
+        self.created_at = created_at
+        self.finished_at = finished_at
+        self.owner = owner
+        self.lease_until = lease_until
+
+
+class Token(Record):
+    """
+    Access token structure, `id` is the keyed hash of the token itself
+    """
+    __slots__ = ("id", "user_id", "expires_at")
+
+    def __init__(self, id, user_id, expires_at):
+        self.id = id
+        self.user_id = user_id
+        self.expires_at = expires_at
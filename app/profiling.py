@@ -0,0 +1,265 @@
+import collections
+import cProfile
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Source files whose time is reported on its own in every profile
+STORE_FILES = ("app/db.py", "app/crud.py")
+SERIALIZATION_FILES = ("app/encoding.py",)
+
+
+def _in(filename, files):
+    return filename.replace(os.sep, "/").endswith(files)
+
+def _entered_time(stats, files):
+    """
+    Seconds spent in functions of `files` when called from outside them,
+    from cProfile stats; calls among their own functions are not counted twice
+    """
+    seconds = 0.0
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.items():
+        if not _in(filename, files):
+            continue
+        for caller, timing in callers.items():
+            if not _in(caller[0], files):
+                seconds += timing[3]
+    return seconds
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class Profiler:
+    """
+    Opt-in profiles of single requests, kept in a bounded ring of files
+
+    A request is profiled with cProfile when an admin asks for it or when it
+    is drawn at `sample_rate`. cProfile sees every call, which slows the
+    request down, and since Python 3.12 it watches every thread, so only one
+    request is profiled at a time; others that ask meanwhile are skipped.
+
+    With `slow_threshold` (seconds) set, every other request is watched by a
+    sampling thread instead: every `interval` seconds it records the stack
+    of each request in flight, and the samples of a request that took
+    longer than the threshold are written out, those of the rest dropped.
+    The thread sleeps while no request is in flight.
+
+    Each capture is a profile file (pstats for cProfile, folded stacks for
+    samples, as read by flamegraph tools) and a JSON file describing the
+    request, including the time spent in the store and in serialization.
+    Files go to `directory`, shared by every worker; beyond `max_files`
+    captures the oldest are removed. With neither a sample rate nor a
+    threshold set, a request not asking for a profile costs one check.
+    """
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_threshold = 0
+        self.interval = 0.01
+        self.directory = None
+        self.max_files = 100
+        self.captured = 0
+        self.skipped = 0
+        self.samples = 0
+        self._sequence = itertools.count(1)
+        self._profiling = threading.Lock()
+        # thread id -> Counter of stacks, as tuples of code object ids
+        # innermost first; ids are cheaper to hash than the code objects
+        self._in_flight = {}
+        # id -> code object of every frame seen, which also keeps ids unique
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sampler = None
+
+    def configure(self, sample_rate=0.0, slow_threshold=0, interval=0.01, directory=None, max_files=100):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.directory = directory
+        self.max_files = max_files
+
+    def begin(self, requested=False, slow=True):
+        """
+        Start watching the current request, with cProfile if `requested`
+        by an admin or drawn at the sample rate, else for the slow request
+        ring unless `slow` is false. Returns the (id, trigger, recording)
+        handle to pass to finish, None if the request is not watched.
+        """
+        if not (requested or self.sample_rate or self.slow_threshold):
+            return None
+        if requested:
+            trigger = "header"
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trigger = "sample"
+        else:
+            trigger = None
+        if trigger is not None:
+            if self._profiling.acquire(blocking=False):
+                profile = cProfile.Profile()
+                profile.enable()
+                return self._new_id(), trigger, profile
+            self.skipped += 1
+        if not (self.slow_threshold and slow):
+            return None
+        samples = collections.Counter()
+        with self._lock:
+            self._in_flight[threading.get_ident()] = samples
+            if not self._wake.is_set():
+                self._wake.set()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+                self._sampler.start()
+        return self._new_id(), "slow", samples
+
+    def finish(self, handle, method, path, status, seconds):
+        """
+        Stop watching a request and write out what was recorded, if it was
+        asked for or the request was slow
+        """
+        capture_id, trigger, recorded = handle
+        meta = {"id": capture_id, "trigger": trigger, "method": method, "path": path, "status": status,
+                "seconds": round(seconds, 6), "pid": os.getpid(), "time": time.time()}
+        if trigger == "slow":
+            with self._lock:
+                del self._in_flight[threading.get_ident()]
+                stacks = dict(recorded)
+            if seconds < self.slow_threshold or not stacks:
+                return
+            self._write_samples(meta, stacks)
+        else:
+            recorded.disable()
+            self._profiling.release()
+            self._write_profile(meta, recorded)
+
+    def _new_id(self):
+        # Sorts in the order captures were started, within each process
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._sequence):06d}"
+
+    def _sample(self):
+        """
+        Sampling thread: record the stack of every watched request
+        """
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                codes = self._codes
+                for thread_id, samples in self._in_flight.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        key = id(code)
+                        if key not in codes:
+                            codes[key] = code
+                        stack.append(key)
+                        frame = frame.f_back
+                    samples[tuple(stack)] += 1
+                    self.samples += 1
+                if not self._in_flight:
+                    self._wake.clear()
+            del frames
+
+    def _write_profile(self, meta, profile):
+        profile.create_stats()
+        meta["kind"] = "cprofile"
+        meta["store_seconds"] = round(_entered_time(profile.stats, STORE_FILES), 6)
+        meta["serialization_seconds"] = round(_entered_time(profile.stats, SERIALIZATION_FILES), 6)
+        self._save(meta, ".prof", profile.dump_stats)
+
+    def _write_samples(self, meta, stacks):
+        store = serialization = total = 0
+        lines = []
+        for stack, count in stacks.items():
+            total += count
+            stack = [self._codes[key] for key in stack]
+            filenames = [code.co_filename for code in stack]
+            if any(_in(filename, STORE_FILES) for filename in filenames):
+                store += count
+            if any(_in(filename, SERIALIZATION_FILES) for filename in filenames):
+                serialization += count
+            lines.append(";".join(_frame_name(code) for code in reversed(stack)) + f" {count}\n")
+        meta["kind"] = "sampled"
+        meta["samples"] = total
+        meta["interval"] = self.interval
+        meta["store_seconds"] = round(store * self.interval, 6)
+        meta["serialization_seconds"] = round(serialization * self.interval, 6)
+
+        def write(path):
+            with open(path, "w") as f:
+                f.writelines(lines)
+        self._save(meta, ".folded", write)
+
+    def _save(self, meta, extension, write):
+        """
+        Write a capture and its description, then trim the ring
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            meta["file"] = meta["id"] + extension
+            write(os.path.join(self.directory, meta["file"]))
+            with open(os.path.join(self.directory, meta["id"] + ".json"), "w") as f:
+                json.dump(meta, f)
+            self.captured += 1
+            logger.info("Captured %s profile %s of %s %s (%.3fs)",
+                        meta["kind"], meta["id"], meta["method"], meta["path"], meta["seconds"])
+            self._trim()
+        except OSError:
+            logger.exception("Could not write profile %s to %s", meta["id"], self.directory)
+
+    def _trim(self):
+        names = os.listdir(self.directory)
+        captures = sorted(name[:-5] for name in names if name.endswith(".json"))
+        stale = set(captures[:max(len(captures) - self.max_files, 0)])
+        for name in names:
+            if name.rpartition(".")[0] in stale:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # Trimmed by another worker
+                    pass
+
+    def captures(self):
+        """
+        Descriptions of the captures in the ring, newest first
+        """
+        if self.directory is None or not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    found.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or still being written by another worker
+                continue
+        return found
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_threshold": self.slow_threshold,
+            "interval": self.interval,
+            "directory": self.directory,
+            "max_files": self.max_files,
+            "captured": self.captured,
+            "skipped": self.skipped,
+            "samples": self.samples,
+            "in_flight": len(self._in_flight)
+        }
+
+
+# Profiler of the process
+profiler = Profiler()
@@ -0,0 +1,166 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Tokens each endpoint costs unless configured otherwise; everything else
+# costs 1. Login and registration are dear to slow down password guessing,
+# a batch does the work of many single requests.
+DEFAULT_ROUTE_COSTS = {
+    "login": 5,
+    "register": 5,
+    "batch_notes": 10,
+    "search_notes": 2
+}
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by an arbitrary key (a user id, a client address)
+
+    Each bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second; a request that costs more than the bucket holds is refused and
+    told how long to wait. Buckets are created full on first use and kept in
+    least-recently-used order, so idle ones are dropped from the front: after
+    `idle_timeout` seconds, or as soon as there are more than `max_buckets`.
+    A bucket left idle long enough to refill is full again anyway, so
+    forgetting it loses nothing.
+
+    With `rate` 0 buckets never refill, each key gets `burst` tokens until
+    its bucket has been left idle for `idle_timeout` seconds and starts
+    over full; refused requests are told to wait that long.
+    """
+    def __init__(self, rate, burst, max_buckets=100000, idle_timeout=300):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(rate, burst, max_buckets, idle_timeout)
+        self.admitted = 0
+        self.limited = 0
+        self.evictions = 0
+
+    def configure(self, rate, burst, max_buckets=100000, idle_timeout=300):
+        if rate < 0 or burst <= 0:
+            raise ValueError(f"Rate limit needs a rate of at least 0 and a positive burst, got {rate}/{burst}")
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.max_buckets = max_buckets
+            # A bucket is not forgotten before it would have refilled
+            self.idle_timeout = max(idle_timeout, self.burst / self.rate) if self.rate else idle_timeout
+            self._buckets.clear()
+
+    def take(self, key, cost=1, now=None):
+        """
+        Take `cost` tokens from the bucket of `key`
+
+        Returns 0 when the request is admitted, otherwise the number of
+        seconds until the bucket holds enough tokens.
+        """
+        if now is None:
+            now = time.monotonic()
+        cost = min(cost, self.burst)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._evict(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                self._buckets.move_to_end(key)
+                if self.rate:
+                    bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                elif now - bucket[1] >= self.idle_timeout:
+                    bucket[0] = self.burst
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.admitted += 1
+                return 0
+            self.limited += 1
+            return (cost - bucket[0]) / self.rate if self.rate else self.idle_timeout
+
+    def give_back(self, key, cost=1):
+        """
+        Return the tokens of a take that was admitted, for a request that
+        was refused after all
+        """
+        cost = min(cost, self.burst)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+                self.admitted -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "buckets": len(self._buckets),
+                "max_buckets": self.max_buckets,
+                "admitted": self.admitted,
+                "limited": self.limited,
+                "evictions": self.evictions
+            }
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, (_, updated) = next(iter(buckets.items()))
+            if len(buckets) < self.max_buckets and now - updated < self.idle_timeout:
+                break
+            del buckets[key]
+            self.evictions += 1
+
+
+class Admission:
+    """
+    Admission control for requests: one limiter per user and one per client
+    address, with a cost per endpoint
+
+    Anonymous requests are only limited by address. Authenticated ones must
+    pass both, so a single user cannot take more than their share even
+    from many addresses, and one address cannot hide behind many accounts.
+    A request refused by one limiter costs nothing at the other.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.users = RateLimiter(50, 100)
+        self.clients = RateLimiter(200, 400)
+        self.costs = dict(DEFAULT_ROUTE_COSTS)
+
+    def configure(self, enabled=True, user_rate=50, user_burst=100, client_rate=200, client_burst=400,
+                  costs=None, max_buckets=100000, idle_timeout=300):
+        self.enabled = enabled
+        self.users.configure(user_rate, user_burst, max_buckets, idle_timeout)
+        self.clients.configure(client_rate, client_burst, max_buckets, idle_timeout)
+        self.costs = dict(DEFAULT_ROUTE_COSTS, **(costs or {}))
+
+    def check(self, endpoint, user_id, address):
+        """
+        Returns None to admit the request, otherwise (scope, seconds to wait)
+        """
+        cost = self.costs.get(endpoint, 1)
+        if not cost:
+            return None
+        now = time.monotonic()
+        wait = self.clients.take(address, cost, now)
+        if wait:
+            return "client", math.ceil(wait)
+        if user_id is not None:
+            wait = self.users.take(user_id, cost, now)
+            if wait:
+                self.clients.give_back(address, cost)
+                return "user", math.ceil(wait)
+        return None
+
+    def stats(self):
+        return {"enabled": self.enabled, "costs": self.costs,
+                "users": self.users.stats(), "clients": self.clients.stats()}
+
+
+# Admission control of the process
+admission = Admission()
@@ -1,14 +1,398 @@
-from flask import request, jsonify, session
+from flask import request, jsonify, session, current_app, g, Response, stream_with_context, send_from_directory
+import codecs
 import logging
 import secrets
+import time
+import zlib
 from datetime import datetime
-from app.crud import query_db
-from app.db import mock_users, mock_notes
+from app.blobs import Blob
+from app.crud import UserRepo, NoteRepo, JobRepo, VersionConflict, DuplicateUser, InvalidEdit
+from app.models import User, Note
+from app import auth, cache, changes, db, jobs, log, metrics, profiling, ratelimit, search
 
 # Configure logging
 logger = logging.getLogger(__name__)
+# One record per request, with its id; sampled and levelled like any other
+access_logger = logging.getLogger("app.access")
+
+# Largest page a client may ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+# Rows fetched from the store per step while streaming a response
+STREAM_CHUNK_SIZE = 500
+# Largest number of operations in one POST /api/notes/batch
+MAX_BATCH_SIZE = 1000
+# Default and largest number of search results
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+# Longest client-supplied X-Request-ID that is passed through
+MAX_REQUEST_ID_LENGTH = 64
+# Most edits in one note patch
+MAX_PATCH_EDITS = 1000
+# Header by which an admin asks for a profile of the request
+PROFILE_HEADER = 'X-Profile'
+# Endpoints that wait by design and would fill the ring of slow requests
+UNPROFILED_ENDPOINTS = frozenset({'note_changes'})
+# Most changes in one response of the change feed
+CHANGES_PAGE_SIZE = 1000
+# Milliseconds an event stream client waits before reconnecting
+STREAM_RETRY_MS = 2000
+# Seconds a client is told to wait when every feed slot is taken
+FEED_RETRY_AFTER = 5
+
+def _pagination_args():
+    """
+    Read ?limit=&after= from the request, raises ValueError on bad values
+    """
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    limit = None if limit is None else int(limit)
+    after = None if after is None else int(after)
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return after, limit
+
+def _iter_pages(fetch, after, limit, tuples=False):
+    """
+    Yield chunks of rows from a keyset-paginated fetch function, rows are
+    column tuples with the id first if `tuples` is set
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining)
+        rows = fetch(after=after, limit=size)
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = rows[-1][0] if tuples else rows[-1].id
+        if remaining is not None:
+            remaining -= len(rows)
+
+def _encode(obj):
+    """
+    Compact JSON bytes of obj from the app's JSON provider
+    """
+    return current_app.json.encode(obj)
+
+def _fields_arg(allowed):
+    """
+    Fields asked for with ?fields=a,b in sorted order, None without it;
+    raises ValueError on a field that is not `allowed`
+    """
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    fields = sorted(set(fields.split(',')))
+    if not set(fields) <= set(allowed):
+        raise ValueError(fields)
+    return fields
+
+def _columns(fields):
+    """
+    Columns to fetch for a projection on `fields`: the id first, which
+    keyset pagination needs whether it was asked for or not
+    """
+    return ("id",) + tuple(field for field in fields if field != "id")
+
+def _field_dicts(fields, columns, rows):
+    """
+    Yield dicts of the asked for fields of column tuples fetched for
+    _columns(fields), one at a time
+    """
+    if "id" in fields:
+        return (dict(zip(columns, row)) for row in rows)
+    return (dict(zip(fields, row[1:])) for row in rows)
+
+def _include_content():
+    """
+    Whether a listing was asked for whole notes with ?include=content,
+    rather than summaries
+    """
+    return 'content' in request.args.get('include', '').split(',')
+
+def _note_fragments(notes):
+    """
+    JSON bytes of each note, reused from the fragment cache when unchanged
+    """
+    return cache.fragments.encode(notes, current_app.json.encode)
+
+def _summary_fragments(summaries):
+    """
+    JSON bytes of each note summary, reused from their own fragment cache
+    """
+    return cache.summaries.encode(summaries, current_app.json.encode)
+
+def _stream_note(note):
+    """
+    Yield the JSON of {"note": note} with a content kept out of line read
+    from its blob chunk by chunk, never whole
+    """
+    # Keys are sorted, so the content comes first
+    yield b'{"note":{"content":"'
+    decoder = codecs.getincrementaldecoder("utf-8")("surrogatepass")
+    for chunk in note.content.chunks():
+        text = decoder.decode(chunk)
+        if text:
+            yield _encode(text)[1:-1]
+    yield b'",' + _encode(note.to_dict(("id", "owner_id", "title", "version")))[1:] + b'}'
+
+def _json_response(body):
+    return current_app.response_class(body + b'\n', mimetype=current_app.json.mimetype)
+
+def _stream_rows(key, fragments, fmt):
+    """
+    Stream JSON-encoded rows as NDJSON or as a {key: [...]} JSON document
+    """
+    def generate_json():
+        yield b'{"%s":[' % key.encode()
+        for i, fragment in enumerate(fragments):
+            yield b',' + fragment if i else fragment
+        yield b']}'
+
+    def generate_ndjson():
+        for fragment in fragments:
+            yield fragment + b'\n'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+def _plan_batch(items, user_id, is_admin):
+    """
+    Validate batch items and turn them into store operations
+
+    Ownership is checked for the whole batch with a single multi-id lookup.
+    Items are validated in order against the state the earlier items leave
+    behind, so deleting a note and then updating it is rejected. Updates and
+    deletes carry the version they were checked against, so the store
+    refuses the batch if a note changes meanwhile.
+    Returns (operations, errors) where errors is a list of per-item problems.
+    """
+    referenced = {item.get('id') for item in items
+                  if isinstance(item, dict) and isinstance(item.get('id'), int)}
+    notes = NoteRepo.by_ids(referenced)
+    deleted = set()
+
+    operations = []
+    errors = []
+    for index, item in enumerate(items):
+        op = item.get('op') if isinstance(item, dict) else None
+        if op == 'create':
+            if not all(isinstance(item.get(k), str) for k in ('title', 'content')):
+                errors.append({"index": index, "status": 400, "error": "Missing required fields"})
+                continue
+            operations.append(("create", Note(None, item['title'], item['content'], user_id)))
+        elif op in ('update', 'delete'):
+            note_id = item.get('id')
+            note = notes.get(note_id) if isinstance(note_id, int) else None
+            if note is None or note.id in deleted:
+                errors.append({"index": index, "status": 404, "error": "Note not found"})
+                continue
+            if note.owner_id != user_id and not (op == 'delete' and is_admin):
+                errors.append({"index": index, "status": 403, "error": "Unauthorized"})
+                continue
+            if op == 'delete':
+                deleted.add(note.id)
+                operations.append(("delete", note.id, note.version))
+                continue
+            changes = {k: item[k] for k in ('title', 'content') if k in item}
+            if not changes:
+                errors.append({"index": index, "status": 400, "error": "No valid fields to update"})
+                continue
+            if not all(isinstance(value, str) for value in changes.values()):
+                errors.append({"index": index, "status": 400, "error": "Title and content must be strings"})
+                continue
+            operations.append(("update", note.id, changes, note.version))
+        else:
+            errors.append({"index": index, "status": 400, "error": "Unknown operation"})
+    return operations, errors
+
+def _parse_edits(items):
+    """
+    Turn the [start, end, text] items of a patch into edit tuples, None
+    unless they are well formed, ascending and do not overlap
+    """
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_PATCH_EDITS:
+        return None
+    edits = []
+    previous = 0
+    for item in items:
+        if not isinstance(item, list) or len(item) != 3:
+            return None
+        start, end, text = item
+        if start.__class__ is not int or end.__class__ is not int or not isinstance(text, str):
+            return None
+        if not previous <= start <= end:
+            return None
+        edits.append((start, end, text))
+        previous = end
+    return edits
+
+def _note_etag(note):
+    """
+    Strong ETag of a single note, changes with every update
+    """
+    return f"{db.store.epoch}-n{note.id}-v{note.version}"
+
+def _collection_etag(owner_id, version):
+    """
+    Strong ETag of a note listing; the query string selects the representation
+    """
+    return f"{db.store.epoch}-o{owner_id}-v{version}-{zlib.crc32(request.query_string):08x}"
+
+def _not_modified(etag):
+    """
+    304 response for a matching If-None-Match, sent without serializing anything
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def _cached_json(key, etag, owner_id, build):
+    """
+    JSON response for key, served from the response cache while etag matches
+
+    `build` returns the encoded body and is only called on a miss. Callers
+    must have done their authorization checks already.
+    """
+    body = cache.responses.get(key, etag)
+    if body is None:
+        body = build()
+        cache.responses.put(key, etag, body, owner_id)
+    response = _json_response(body)
+    response.set_etag(etag)
+    return response
+
+def _change_dict(change):
+    """
+    JSON-ready dict of a change feed entry
+    """
+    seq, owner_id, event, note_id, version = change
+    if note_id is None:
+        return {"seq": seq, "type": event, "owner_id": owner_id}
+    return {"seq": seq, "type": event, "owner_id": owner_id, "note_id": note_id, "version": version}
+
+def _resync(feed):
+    """
+    410 telling a change feed client to list its notes again and go on
+    from the cursor in the body
+    """
+    logger.info("Change feed client must resync")
+    return jsonify({"error": "Cursor is too old, list the notes again", "resync": True,
+                    "cursor": feed.cursor()}), 410
+
+def _stream_changes(feed, owner_id, since):
+    """
+    Yield the changes of an owner after `since` as Server-Sent Events until
+    the feed's stream timeout, with a heartbeat while nothing happens
+    """
+    deadline = time.monotonic() + feed.stream_timeout
+    yield b'retry: %d\n\n' % STREAM_RETRY_MS
+    position = since
+    while True:
+        result = feed.read(owner_id, position, CHANGES_PAGE_SIZE)
+        if result is None:
+            cursor = feed.cursor()
+            yield b'event: resync\nid: %s\ndata: %s\n\n' % (cursor.encode(), _encode({"cursor": cursor}))
+            return
+        found, position = result
+        for change in found:
+            yield b'event: %s\nid: %s\ndata: %s\n\n' % (
+                change[2].encode(), feed.cursor(change[0]).encode(), _encode(_change_dict(change))
+            )
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or feed.closed:
+            return
+        if not feed.wait(owner_id, position, min(feed.heartbeat, remaining)):
+            # Moves the client's Last-Event-ID on without dispatching an event
+            yield b': heartbeat\nid: %s\n\n' % feed.cursor(position).encode()
+
+def _request_token():
+    """
+    The bearer token of the request, else the token in the session cookie
+    """
+    authorization = request.authorization
+    if authorization is not None and authorization.type == "bearer":
+        return authorization.token
+    return session.get('token')
 
 def register_routes(app):
+    # Tag every log record of a request with its id
+    @app.before_request
+    def assign_request_id():
+        rid = request.headers.get('X-Request-ID', '')
+        if not rid or len(rid) > MAX_REQUEST_ID_LENGTH or not rid.isprintable():
+            rid = secrets.token_hex(8)
+        log.request_id.set(rid)
+
+    # Latency, status and in-flight metrics for every route
+    @app.before_request
+    def start_timer():
+        rule = request.url_rule
+        g.metric_labels = (request.method, rule.rule if rule is not None else "unmatched")
+        g.started = time.perf_counter()
+        metrics.requests_in_flight.inc(g.metric_labels)
+
+    # Resolve the caller from an `Authorization: Bearer` token, or from the
+    # token kept in the session cookie; g.user is None for anonymous
+    # requests. The first request of a process also resumes any deletions a
+    # stopped process left unfinished.
+    @app.before_request
+    def authenticate():
+        jobs.runner.start()
+        g.token = _request_token()
+        g.user = auth.tokens.authenticate(g.token) if g.token else None
+
+    # Admission control, after authentication so users are limited by id
+    @app.before_request
+    def limit_rate():
+        if not ratelimit.admission.enabled:
+            return None
+        refused = ratelimit.admission.check(
+            request.endpoint, g.user.id if g.user is not None else None, request.remote_addr
+        )
+        if refused is None:
+            return None
+        scope, retry_after = refused
+        metrics.requests_limited.inc((scope, g.metric_labels[1]))
+        logger.info("Rate limited %s request to %s, retry after %ss", scope, request.path, retry_after)
+        response = jsonify({"error": "Too many requests", "retry_after": retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+
+    # Opt-in profiling, once the request is admitted; see app.profiling
+    @app.before_request
+    def start_profile():
+        requested = PROFILE_HEADER in request.headers and g.user is not None and g.user.admin
+        g.profile = profiling.profiler.begin(requested, request.endpoint not in UNPROFILED_ENDPOINTS)
+
+    @app.after_request
+    def add_request_id(response):
+        response.headers['X-Request-ID'] = log.request_id.get()
+        # Only the admin who asked for a profile learns its id, sampled and
+        # slow captures are listed at /api/admin/profiles
+        profile = g.get('profile')
+        if profile is not None and profile[1] == "header":
+            response.headers['X-Profile-ID'] = profile[0]
+        g.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        # Runs once the body is sent, so streamed responses are timed in full
+        labels = g.pop('metric_labels', None)
+        if labels is not None:
+            elapsed = time.perf_counter() - g.started
+            metrics.request_duration.observe(labels, elapsed)
+            metrics.requests_in_flight.dec(labels)
+            metrics.requests_total.inc(labels + (str(g.get('status', 500)),))
+            profile = g.pop('profile', None)
+            if profile is not None:
+                profiling.profiler.finish(profile, request.method, request.path, g.get('status', 500), elapsed)
+            access_logger.info("%s %s %s %s %.1fms", request.remote_addr, request.method, request.path,
+                               g.get('status', 500), elapsed * 1000)
+        log.request_id.set("-")
+
     # User routes
     @app.route('/api/register', methods=['POST'])
     def register():
@@ -19,23 +403,25 @@ def register_routes(app):
             return jsonify({"error": "Missing required fields"}), 400
         
         # Check if user already exists
-        existing_user = query_db("SELECT * FROM users WHERE email = ?", (data['email'],), one=True)
+        existing_user = UserRepo.by_email(data['email'])
         if existing_user:
-            logger.warning(f"Registration failed: Email {data['email']} already exists")
+            logger.warning("Registration failed: Email %s already exists", data['email'])
             return jsonify({"error": "Email already exists"}), 409
         
-        existing_name = query_db("SELECT * FROM users WHERE name = ?", (data['name'],), one=True)
+        existing_name = UserRepo.by_name(data['name'])
         if existing_name:
-            logger.warning(f"Registration failed: Username {data['name']} already exists")
+            logger.warning("Registration failed: Username %s already exists", data['name'])
             return jsonify({"error": "Username already exists"}), 409
         
-        # Create new user (default non-admin)
-        user_id = query_db(
-            "INSERT INTO users (name, email, password, admin) VALUES (?, ?, ?, ?)",
-            (data['name'], data['email'], data['password'], False)
-        )
+        # Create new user (default non-admin); the name or email can still be
+        # held by a user whose deletion is in progress
+        try:
+            user_id = UserRepo.create(data['name'], data['email'], data['password'], False)
+        except DuplicateUser:
+            logger.warning("Registration failed: Name or email of %s still in use", data['name'])
+            return jsonify({"error": "Username or email already exists"}), 409
         
-        logger.info(f"User registered successfully: {data['name']}")
+        logger.info("User registered successfully: %s", data['name'])
         return jsonify({"message": "User registered successfully", "user_id": user_id}), 201
 
     @app.route('/api/login', methods=['POST'])
@@ -47,64 +433,121 @@ def register_routes(app):
             return jsonify({"error": "Missing required fields"}), 400
         
         # Check user credentials
-        user = query_db("SELECT * FROM users WHERE email = ?", (data['email'],), one=True)
+        user = UserRepo.by_email(data['email'])
         
-        if not user or user['password'] != data['password']:
-            logger.warning(f"Login failed: Invalid credentials for {data.get('email', 'unknown')}")
+        if not user or user.password != data['password']:
+            logger.warning("Login failed: Invalid credentials for %s", data.get('email', 'unknown'))
             return jsonify({"error": "Invalid credentials"}), 401
         
-        # Create session
-        session['user_id'] = user['id']
-        session['is_admin'] = user['admin']
+        # Issue a token, usable as a bearer token and kept in the session
+        # cookie for clients that rely on cookies
+        token, expires_at = auth.tokens.issue(user)
+        session.clear()
+        session['token'] = token
         
-        logger.info(f"User logged in: {user['name']}")
+        logger.info("User logged in: %s", user.name)
         return jsonify({
             "message": "Login successful",
-            "user_id": user['id'],
-            "name": user['name'],
-            "is_admin": user['admin'],
-            "token": secrets.token_hex(16)  # Simple session token
+            "user_id": user.id,
+            "name": user.name,
+            "is_admin": user.admin,
+            "token": token,
+            "token_type": "Bearer",
+            "expires_in": int(expires_at - time.time())
         }), 200
 
     @app.route('/api/logout', methods=['POST'])
     def logout():
-        session.pop('user_id', None)
-        session.pop('is_admin', None)
+        # The token stops working everywhere, not just in this cookie
+        if g.token:
+            auth.tokens.revoke(g.token)
+        session.clear()
         logger.info("User logged out")
         return jsonify({"message": "Logout successful"}), 200
 
     # Note routes
     @app.route('/api/notes', methods=['GET'])
     def get_notes():
-        if 'user_id' not in session:
+        if g.user is None:
             logger.warning("Unauthorized access attempt to notes")
             return jsonify({"error": "Unauthorized"}), 401
         
-        user_id = session['user_id']
-        notes = query_db("SELECT * FROM notes WHERE owner_id = ?", (user_id,))
+        user_id = g.user.id
+        try:
+            after, limit = _pagination_args()
+        except ValueError as e:
+            logger.warning("Invalid pagination parameters: %s", e)
+            return jsonify({"error": "Invalid pagination parameters"}), 400
+        
+        try:
+            fields = _fields_arg(Note.LIST_FIELDS)
+        except ValueError as e:
+            logger.warning("Invalid note fields: %s", e)
+            return jsonify({"error": "Invalid fields, expected some of: " + ",".join(Note.LIST_FIELDS)}), 400
+        
+        # Read the version before the notes so the tag can only be older than the body
+        etag = _collection_etag(user_id, NoteRepo.collection_version(user_id))
+        if request.if_none_match.contains_weak(etag):
+            logger.info("Notes not modified for user %s", user_id)
+            return _not_modified(etag)
+        
+        stream = request.args.get('stream')
+        # Only the asked for columns leave the store, else summaries unless
+        # the contents are asked for
+        if fields is not None:
+            columns = _columns(fields)
+            def fetch(owner_id, after=None, limit=None):
+                return NoteRepo.columns_by_owner(owner_id, columns, after, limit)
+            def encode(rows):
+                if stream == 'ndjson':
+                    return [_encode(row) for row in _field_dicts(fields, columns, rows)]
+                # A page of small rows is encoded in one go and spliced in
+                # without its brackets
+                return [_encode(list(_field_dicts(fields, columns, rows)))[1:-1]] if rows else []
+        elif _include_content():
+            fetch, encode = NoteRepo.by_owner, _note_fragments
+        else:
+            fetch, encode = NoteRepo.summaries_by_owner, _summary_fragments
+        
+        if stream in ('json', 'ndjson'):
+            logger.info("Streaming notes for user %s", user_id)
+            pages = _iter_pages(lambda **page: fetch(user_id, **page), after, limit, tuples=fields is not None)
+            fragments = (fragment for notes in pages for fragment in encode(notes))
+            response = _stream_rows('notes', fragments, stream)
+            response.set_etag(etag)
+            return response
+        
+        def build():
+            notes = fetch(user_id, after, limit)
+            logger.info("Retrieved %s notes for user %s", len(notes), user_id)
+            # Splice the per-note fragments into the array, keys in sorted order
+            items = b','.join(encode(notes))
+            if limit is None:
+                return b'{"notes":[%s]}' % items
+            next_after = None
+            if len(notes) == limit:
+                next_after = notes[-1][0] if fields is not None else notes[-1].id
+            return b'{"next_after":%s,"notes":[%s]}' % (_encode(next_after), items)
         
-        logger.info(f"Retrieved {len(notes)} notes for user {user_id}")
-        return jsonify({"notes": notes}), 200
+        key = ("notes", user_id, request.query_string)
+        return _cached_json(key, etag, user_id, build), 200
 
     @app.route('/api/notes', methods=['POST'])
     def create_note():
-        if 'user_id' not in session:
+        if g.user is None:
             logger.warning("Unauthorized attempt to create note")
             return jsonify({"error": "Unauthorized"}), 401
         
         data = request.get_json()
         
-        if not data or not all(k in data for k in ['title', 'content']):
+        if not isinstance(data, dict) or not all(isinstance(data.get(k), str) for k in ['title', 'content']):
             logger.warning("Note creation failed: Missing required fields")
             return jsonify({"error": "Missing required fields"}), 400
         
-        user_id = session['user_id']
-        note_id = query_db(
-            "INSERT INTO notes (title, content, owner_id) VALUES (?, ?, ?)",
-            (data['title'], data['content'], user_id)
-        )
+        user_id = g.user.id
+        note_id = NoteRepo.create(data['title'], data['content'], user_id)
         
-        logger.info(f"Note created: {data['title']} by user {user_id}")
+        logger.info("Note created: %s by user %s", note_id, user_id)
         return jsonify({
             "message": "Note created successfully",
             "note_id": note_id,
@@ -113,132 +556,444 @@ def register_routes(app):
             "owner_id": user_id
         }), 201
 
+    @app.route('/api/notes/batch', methods=['POST'])
+    def batch_notes():
+        if g.user is None:
+            logger.warning("Unauthorized attempt to run note batch")
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        data = request.get_json(silent=True)
+        items = data.get('operations') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            logger.warning("Note batch failed: Missing operations")
+            return jsonify({"error": "Missing operations"}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            logger.warning("Note batch failed: %s operations", len(items))
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} operations per batch"}), 400
+        
+        user_id = g.user.id
+        operations, errors = _plan_batch(items, user_id, g.user.admin)
+        if errors:
+            # Nothing is applied unless every item is valid
+            logger.warning("Note batch rejected for user %s: %s invalid operations", user_id, len(errors))
+            return jsonify({"error": "Batch rejected", "errors": errors}), errors[0]['status']
+        
+        rows = NoteRepo.apply_batch(operations)
+        if rows is None:
+            return jsonify({"error": "Batch conflicted with a concurrent change"}), 409
+        
+        results = []
+        for operation, row in zip(operations, rows):
+            if operation[0] == 'create':
+                results.append({"op": "create", "status": 201, "note_id": row.id})
+            elif operation[0] == 'update':
+                results.append({"op": "update", "status": 200, "note": row.to_dict()})
+            else:
+                results.append({"op": "delete", "status": 200, "note_id": row.id})
+        
+        logger.info("Note batch applied: %s operations by user %s", len(results), user_id)
+        return jsonify({"message": "Batch applied successfully", "results": results}), 200
+
+    @app.route('/api/notes/changes', methods=['GET'])
+    def note_changes():
+        if g.user is None:
+            logger.warning("Unauthorized access attempt to change feed")
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        # Admins may follow the notes of any owner
+        owner_id = request.args.get('owner', g.user.id, type=int)
+        if owner_id != g.user.id and not g.user.admin:
+            logger.warning("Unauthorized change feed access to owner %s by user %s", owner_id, g.user.id)
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        feed = changes.feed
+        # A reconnecting event stream says where it got to in Last-Event-ID
+        cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
+        stream = request.args.get('stream') == 'sse' or request.accept_mimetypes.best == 'text/event-stream'
+        if cursor is None:
+            since = feed.last()
+        else:
+            since = feed.position(cursor)
+            if since is None and not stream:
+                return _resync(feed)
+        
+        if stream:
+            if not feed.admit():
+                logger.warning("Change feed full, refusing stream for user %s", g.user.id)
+                response = jsonify({"error": "Too many clients waiting for changes"})
+                response.headers['Retry-After'] = str(FEED_RETRY_AFTER)
+                return response, 503
+            logger.info("Streaming changes of owner %s to user %s", owner_id, g.user.id)
+            # A cursor the feed cannot read on from gets a resync event straight away
+            response = Response(stream_with_context(_stream_changes(feed, owner_id, -1 if since is None else since)),
+                                mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.call_on_close(feed.release)
+            return response
+        
+        timeout = request.args.get('timeout', feed.poll_timeout, type=float)
+        timeout = max(0.0, min(timeout, feed.poll_timeout))
+        result = feed.read(owner_id, since, CHANGES_PAGE_SIZE)
+        if result is None:
+            return _resync(feed)
+        found, position = result
+        if not found and timeout and cursor is not None:
+            # Long poll: hold the request until the owner has a change
+            if not feed.admit():
+                logger.warning("Change feed full, refusing long poll for user %s", g.user.id)
+                response = jsonify({"error": "Too many clients waiting for changes"})
+                response.headers['Retry-After'] = str(FEED_RETRY_AFTER)
+                return response, 503
+            try:
+                feed.wait(owner_id, position, timeout)
+            finally:
+                feed.release()
+            result = feed.read(owner_id, position, CHANGES_PAGE_SIZE)
+            if result is None:
+                return _resync(feed)
+            found, position = result
+        
+        return jsonify({"changes": [_change_dict(change) for change in found],
+                        "cursor": feed.cursor(position), "resync": False}), 200
+
+    @app.route('/api/notes/search', methods=['GET'])
+    def search_notes():
+        if g.user is None:
+            logger.warning("Unauthorized search attempt")
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        query = request.args.get('q', '').strip()
+        if not query:
+            logger.warning("Search failed: Missing query")
+            return jsonify({"error": "Missing query"}), 400
+        
+        limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+        
+        user_id = g.user.id
+        hits = search.search(user_id, query, limit)
+        notes = []
+        scores = []
+        for note_id, score in hits:
+            note = NoteRepo.by_id(note_id)
+            if note is not None:
+                notes.append(note)
+                scores.append(round(score, 4))
+        if _include_content():
+            fragments = _note_fragments(notes)
+        else:
+            fragments = _summary_fragments([note.summary() for note in notes])
+        results = b','.join(
+            b'{"note":%s,"score":%s}' % (fragment, _encode(score))
+            for fragment, score in zip(fragments, scores)
+        )
+        
+        logger.info("Search returned %s notes for user %s", len(notes), user_id)
+        return _json_response(b'{"query":%s,"results":[%s]}' % (_encode(query), results))
+
     @app.route('/api/notes/<int:note_id>', methods=['GET'])
     def get_note(note_id):
-        if 'user_id' not in session:
+        if g.user is None:
             logger.warning("Unauthorized access attempt to note")
             return jsonify({"error": "Unauthorized"}), 401
         
-        user_id = session['user_id']
-        note = query_db("SELECT * FROM notes WHERE id = ?", (note_id,), one=True)
+        user_id = g.user.id
+        note = NoteRepo.by_id(note_id)
         
         if not note:
-            logger.warning(f"Note not found: {note_id}")
+            logger.warning("Note not found: %s", note_id)
             return jsonify({"error": "Note not found"}), 404
         
-        if note['owner_id'] != user_id and not session.get('is_admin', False):
-            logger.warning(f"Unauthorized access attempt to note {note_id} by user {user_id}")
+        if note.owner_id != user_id and not g.user.admin:
+            logger.warning("Unauthorized access attempt to note %s by user %s", note_id, user_id)
             return jsonify({"error": "Unauthorized"}), 403
         
-        logger.info(f"Retrieved note {note_id} for user {user_id}")
-        return jsonify({"note": note}), 200
+        etag = _note_etag(note)
+        if request.if_none_match.contains_weak(etag):
+            logger.info("Note %s not modified for user %s", note_id, user_id)
+            return _not_modified(etag)
+        
+        logger.info("Retrieved note %s for user %s", note_id, user_id)
+        if isinstance(note.content, Blob):
+            # Too large to cache, streamed straight from its blob
+            response = Response(stream_with_context(_stream_note(note)), mimetype=current_app.json.mimetype)
+            response.set_etag(etag)
+            return response, 200
+        
+        def build():
+            return b'{"note":%s}' % _note_fragments([note])[0]
+        
+        return _cached_json(("note", note_id), etag, note.owner_id, build), 200
 
     @app.route('/api/notes/<int:note_id>', methods=['PUT'])
     def update_note(note_id):
-        if 'user_id' not in session:
+        if g.user is None:
             logger.warning("Unauthorized attempt to update note")
             return jsonify({"error": "Unauthorized"}), 401
         
-        user_id = session['user_id']
-        note = query_db("SELECT * FROM notes WHERE id = ?", (note_id,), one=True)
+        user_id = g.user.id
+        note = NoteRepo.by_id(note_id)
         
         if not note:
-            logger.warning(f"Note not found for update: {note_id}")
+            logger.warning("Note not found for update: %s", note_id)
             return jsonify({"error": "Note not found"}), 404
         
-        if note['owner_id'] != user_id:
-            logger.warning(f"Unauthorized update attempt for note {note_id} by user {user_id}")
+        if note.owner_id != user_id:
+            logger.warning("Unauthorized update attempt for note %s by user %s", note_id, user_id)
             return jsonify({"error": "Unauthorized"}), 403
         
         data = request.get_json()
         
-        if not data:
+        if not data or not isinstance(data, dict):
             logger.warning("Note update failed: No data provided")
             return jsonify({"error": "No data provided"}), 400
         
         # Update note fields
-        if 'title' in data and 'content' in data:
-            query_db(
-                "UPDATE notes SET title = ?, content = ? WHERE id = ?",
-                (data['title'], data['content'], note_id)
-            )
-        elif 'title' in data:
-            query_db(
-                "UPDATE notes SET title = ? WHERE id = ?",
-                (data['title'], note_id)
-            )
-        elif 'content' in data:
-            query_db(
-                "UPDATE notes SET content = ? WHERE id = ?",
-                (data['content'], note_id)
-            )
-        else:
+        changes = {k: data[k] for k in ('title', 'content') if k in data}
+        if not changes:
             logger.warning("Note update failed: No valid fields to update")
             return jsonify({"error": "No valid fields to update"}), 400
+        if not all(isinstance(value, str) for value in changes.values()):
+            logger.warning("Note update failed: Fields must be strings")
+            return jsonify({"error": "Title and content must be strings"}), 400
         
-        updated_note = query_db("SELECT * FROM notes WHERE id = ?", (note_id,), one=True)
+        # Optimistic concurrency: If-Match must name the current version
+        expected_version = None
+        if request.if_match:
+            if not request.if_match.contains(_note_etag(note)):
+                logger.warning("Precondition failed for note %s by user %s", note_id, user_id)
+                return jsonify({"error": "Note has been modified"}), 412
+            if not request.if_match.star_tag:
+                expected_version = note.version
+        
+        try:
+            updated_note = NoteRepo.update(note_id, expected_version, **changes)
+        except VersionConflict:
+            logger.warning("Concurrent update of note %s by user %s", note_id, user_id)
+            return jsonify({"error": "Note has been modified"}), 412
+        if updated_note is None:
+            logger.warning("Note deleted during update: %s", note_id)
+            return jsonify({"error": "Note not found"}), 404
         
-        logger.info(f"Note updated: {note_id} by user {user_id}")
-        return jsonify({"message": "Note updated successfully", "note": updated_note}), 200
+        logger.info("Note updated: %s by user %s", note_id, user_id)
+        response = jsonify({"message": "Note updated successfully", "note": updated_note.to_dict()})
+        response.set_etag(_note_etag(updated_note))
+        return response, 200
+
+    @app.route('/api/notes/<int:note_id>', methods=['PATCH'])
+    def patch_note(note_id):
+        if g.user is None:
+            logger.warning("Unauthorized attempt to patch note")
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        user_id = g.user.id
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            logger.warning("Note patch failed: No data provided")
+            return jsonify({"error": "No data provided"}), 400
+        
+        base_version = data.get('base_version')
+        edits = _parse_edits(data.get('edits'))
+        if base_version.__class__ is not int or edits is None:
+            logger.warning("Note patch failed: Invalid base version or edits")
+            return jsonify({"error": "Expected base_version and up to %d ascending [start, end, text] edits"
+                                     % MAX_PATCH_EDITS}), 400
+        
+        try:
+            patched = NoteRepo.patch(note_id, user_id, edits, base_version)
+        except VersionConflict:
+            logger.warning("Stale patch of note %s by user %s", note_id, user_id)
+            return jsonify({"error": "Note has been modified"}), 409
+        except InvalidEdit:
+            logger.warning("Note patch failed: Edit past the end of note %s", note_id)
+            return jsonify({"error": "Edit reaches past the end of the content"}), 400
+        if patched is None:
+            # Only read the note to tell a missing one from another user's
+            if NoteRepo.by_id(note_id) is not None:
+                logger.warning("Unauthorized patch attempt for note %s by user %s", note_id, user_id)
+                return jsonify({"error": "Unauthorized"}), 403
+            logger.warning("Note not found for patch: %s", note_id)
+            return jsonify({"error": "Note not found"}), 404
+        
+        note, checksum = patched
+        logger.info("Note patched: %s by user %s", note_id, user_id)
+        response = jsonify({"version": note.version, "checksum": checksum})
+        response.set_etag(_note_etag(note))
+        return response, 200
 
     @app.route('/api/notes/<int:note_id>', methods=['DELETE'])
     def delete_note(note_id):
-        if 'user_id' not in session:
+        if g.user is None:
             logger.warning("Unauthorized attempt to delete note")
             return jsonify({"error": "Unauthorized"}), 401
         
-        user_id = session['user_id']
-        note = query_db("SELECT * FROM notes WHERE id = ?", (note_id,), one=True)
+        user_id = g.user.id
+        note = NoteRepo.by_id(note_id)
         
         if not note:
-            logger.warning(f"Note not found for deletion: {note_id}")
+            logger.warning("Note not found for deletion: %s", note_id)
             return jsonify({"error": "Note not found"}), 404
         
-        if note['owner_id'] != user_id and not session.get('is_admin', False):
-            logger.warning(f"Unauthorized deletion attempt for note {note_id} by user {user_id}")
+        if note.owner_id != user_id and not g.user.admin:
+            logger.warning("Unauthorized deletion attempt for note %s by user %s", note_id, user_id)
             return jsonify({"error": "Unauthorized"}), 403
         
-        query_db("DELETE FROM notes WHERE id = ?", (note_id,))
+        NoteRepo.delete(note_id)
         
-        logger.info(f"Note deleted: {note_id} by user {user_id}")
+        logger.info("Note deleted: %s by user %s", note_id, user_id)
         return jsonify({"message": "Note deleted successfully"}), 200
 
     # Admin routes
     @app.route('/api/admin/users', methods=['GET'])
     def get_users():
-        if 'user_id' not in session or not session.get('is_admin', False):
+        if g.user is None or not g.user.admin:
             logger.warning("Unauthorized access attempt to admin users list")
             return jsonify({"error": "Unauthorized"}), 403
         
-        users = query_db("SELECT * FROM users")
-        # Remove passwords from response
-        for user in users:
-            user.pop('password', None)
+        try:
+            after, limit = _pagination_args()
+        except ValueError as e:
+            logger.warning("Invalid pagination parameters: %s", e)
+            return jsonify({"error": "Invalid pagination parameters"}), 400
+        
+        try:
+            fields = _fields_arg(User.PUBLIC_FIELDS)
+        except ValueError as e:
+            logger.warning("Invalid user fields: %s", e)
+            return jsonify({"error": "Invalid fields, expected some of: " + ",".join(User.PUBLIC_FIELDS)}), 400
+        
+        # Only public columns can be fetched, so passwords never leave the store
+        fields = fields or sorted(User.PUBLIC_FIELDS)
+        columns = _columns(fields)
+        def fetch(after=None, limit=None):
+            return UserRepo.columns(columns, after, limit)
+        
+        stream = request.args.get('stream')
+        if stream in ('json', 'ndjson'):
+            logger.info("Admin streaming user list")
+            pages = _iter_pages(fetch, after, limit, tuples=True)
+            rows = (_encode(user) for page in pages for user in _field_dicts(fields, columns, page))
+            return _stream_rows('users', rows, stream)
         
-        logger.info(f"Admin retrieved user list, count: {len(users)}")
-        return jsonify({"users": users}), 200
+        page = fetch(after, limit)
+        users = list(_field_dicts(fields, columns, page))
+        
+        logger.info("Admin retrieved user list, count: %s", len(users))
+        if limit is None:
+            return jsonify({"users": users}), 200
+        next_after = page[-1][0] if len(page) == limit else None
+        return jsonify({"users": users, "next_after": next_after}), 200
 
     @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
     def delete_user(user_id):
-        if 'user_id' not in session or not session.get('is_admin', False):
+        if g.user is None or not g.user.admin:
             logger.warning("Unauthorized attempt to delete user")
             return jsonify({"error": "Unauthorized"}), 403
         
         # Prevent admin from deleting themselves
-        if user_id == session['user_id']:
+        if user_id == g.user.id:
             logger.warning("Admin attempted to delete their own account")
             return jsonify({"error": "Cannot delete your own admin account"}), 400
         
-        user = query_db("SELECT * FROM users WHERE id = ?", (user_id,), one=True)
+        # The user and their notes disappear now, the notes are reclaimed
+        # by a background job
+        job = jobs.runner.delete_user(user_id)
         
-        if not user:
-            logger.warning(f"User not found for deletion: {user_id}")
+        if job is None:
+            logger.warning("User not found for deletion: %s", user_id)
             return jsonify({"error": "User not found"}), 404
         
-        query_db("DELETE FROM users WHERE id = ?", (user_id,))
+        logger.info("Admin started deletion of user %s as job %s", user_id, job.id)
+        status_url = f"/api/admin/jobs/{job.id}"
+        response = jsonify({"message": "User deletion started", "job_id": job.id, "status_url": status_url})
+        response.headers['Location'] = status_url
+        return response, 202
+
+    @app.route('/api/admin/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to job status")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        job = JobRepo.by_id(job_id)
+        
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        
+        return jsonify({"job": job.to_dict()}), 200
+
+    @app.route('/api/admin/cache', methods=['GET'])
+    def cache_stats():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to cache stats")
+            return jsonify({"error": "Unauthorized"}), 403
         
-        logger.info(f"Admin deleted user: {user_id}")
-        return jsonify({"message": "User deleted successfully"}), 200
+        return jsonify({
+            "responses": cache.responses.stats(),
+            "fragments": cache.fragments.stats(),
+            "summaries": cache.summaries.stats(),
+            "tokens": auth.tokens.cache.stats()
+        }), 200
+
+    @app.route('/api/admin/ratelimit', methods=['GET'])
+    def ratelimit_stats():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to rate limit stats")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        return jsonify(ratelimit.admission.stats()), 200
+
+    @app.route('/api/admin/changes', methods=['GET'])
+    def changes_stats():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to change feed stats")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        return jsonify(changes.feed.stats()), 200
+
+    @app.route('/api/admin/storage', methods=['GET'])
+    def storage_stats():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to storage stats")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        blobs = getattr(db.store, "blobs", None)
+        blobs = blobs.stats() if blobs is not None else None
+        if db.persistence is None:
+            return jsonify({"backend": db.backend, "persistent": db.backend == "sqlite", "blobs": blobs}), 200
+        return jsonify(dict(db.persistence.stats(), backend=db.backend, persistent=True, blobs=blobs)), 200
+
+    @app.route('/api/admin/profiles', methods=['GET'])
+    def list_profiles():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to profiles")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        return jsonify({"profiler": profiling.profiler.stats(), "profiles": profiling.profiler.captures()}), 200
+
+    @app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+    def get_profile(profile_id):
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to profile %s", profile_id)
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        for capture in profiling.profiler.captures():
+            if capture["id"] == profile_id:
+                return send_from_directory(profiling.profiler.directory, capture["file"], as_attachment=True)
+        logger.warning("Profile not found: %s", profile_id)
+        return jsonify({"error": "Profile not found"}), 404
+
+    @app.route('/api/admin/logging', methods=['GET'])
+    def logging_stats():
+        if g.user is None or not g.user.admin:
+            logger.warning("Unauthorized access attempt to logging stats")
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        return jsonify({"logging": log.stats()}), 200
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics_export():
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
     # Status route
     @app.route('/api/status', methods=['GET'])
@@ -246,8 +1001,8 @@ def register_routes(app):
         return jsonify({
             "status": "online",
             "timestamp": datetime.now().isoformat(),
-            "user_count": len(mock_users),
-            "note_count": len(mock_notes)
+            "user_count": UserRepo.count(),
+            "note_count": NoteRepo.count()
         }), 200
 
     # Root route
@@ -262,8 +1017,20 @@ def register_routes(app):
                 "/api/logout",
                 "/api/notes",
                 "/api/notes/<id>",
+                "/api/notes/batch",
+                "/api/notes/search",
+                "/api/notes/changes",
                 "/api/admin/users",
                 "/api/admin/users/<id>",
+                "/api/admin/jobs/<id>",
+                "/api/admin/cache",
+                "/api/admin/ratelimit",
+                "/api/admin/changes",
+                "/api/admin/storage",
+                "/api/admin/profiles",
+                "/api/admin/profiles/<id>",
+                "/api/admin/logging",
+                "/api/metrics",
                 "/api/status"
             ]
         }), 200
\ No newline at end of file
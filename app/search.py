@@ -0,0 +1,248 @@
+import functools
+import heapq
+import logging
+import math
+import re
+import threading
+
+from app import db
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Title matches count this many times as much as content matches
+TITLE_WEIGHT = 3
+
+def tokenize(text):
+    """
+    Split text into lowercase word tokens
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _weights(note):
+    """
+    Term -> weight of a note, title terms counting TITLE_WEIGHT times
+    """
+    weights = {}
+    for term in tokenize(note.title):
+        weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+    for term in tokenize(note.text()):
+        weights[term] = weights.get(term, 0) + 1
+    return weights
+
+
+class SearchIndex:
+    """
+    Inverted index over note titles and contents, scoped per owner
+
+    Each owner has their own postings (term -> {note_id: weight}), so a search
+    only ever touches the postings of the searched terms for one owner and
+    its cost does not grow with the total number of notes. The index is kept
+    up to date through the change events emitted by the repositories.
+
+    After reset(source) owners are indexed lazily, on their first search,
+    from the notes `source(owner_id)` returns; changes to owners not indexed
+    yet are left for that first search to read from the store. An owner is
+    indexed without holding the lock, changes that arrive meanwhile are
+    queued and applied on top once the new postings are in place.
+    """
+    def __init__(self):
+        self._owners = {}
+        self._counts = {}
+        self._docs = {}
+        self._source = None
+        # Owners being indexed: owner_id -> (queued changes, done event)
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event, row):
+        """
+        Change listener, see crud.subscribe
+        """
+        if event in ("note_created", "note_updated"):
+            self.add(row)
+        elif event == "note_deleted":
+            self.remove(row.id)
+        elif event == "user_deleted":
+            self.drop_owner(row.id)
+
+    def add(self, note):
+        """
+        Index a note, replacing whatever was indexed for it before
+        """
+        owner_id = note.owner_id
+        if self._source is not None and owner_id not in self._owners and owner_id not in self._building:
+            # Committed before the owner's first search, which will read it
+            return
+        weights = _weights(note)
+        with self._lock:
+            building = self._building.get(owner_id)
+            if building is not None:
+                building[0].append(functools.partial(self._apply, note, weights))
+            elif self._source is None or owner_id in self._owners:
+                self._apply(note, weights)
+
+    def _apply(self, note, weights):
+        doc = self._docs.get(note.id)
+        if doc is not None and doc[2] > note.version:
+            # Events from concurrent writers can arrive out of order
+            return
+        self._add(note, weights)
+
+    def _add(self, note, weights):
+        self._remove(note.id)
+        postings = self._owners.setdefault(note.owner_id, {})
+        for term, weight in weights.items():
+            postings.setdefault(term, {})[note.id] = weight
+        self._docs[note.id] = (note.owner_id, tuple(weights), note.version)
+        self._counts[note.owner_id] = self._counts.get(note.owner_id, 0) + 1
+
+    def remove(self, note_id):
+        with self._lock:
+            for queued, _ in self._building.values():
+                queued.append(functools.partial(self._remove, note_id))
+            self._remove(note_id)
+
+    def _remove(self, note_id):
+        doc = self._docs.pop(note_id, None)
+        if doc is None:
+            return
+        owner_id, terms = doc[:2]
+        self._counts[owner_id] -= 1
+        postings = self._owners[owner_id]
+        for term in terms:
+            bucket = postings[term]
+            del bucket[note_id]
+            if not bucket:
+                del postings[term]
+
+    def drop_owner(self, owner_id):
+        """
+        Forget every note of an owner, used for the user-delete cascade
+        """
+        with self._lock:
+            building = self._building.get(owner_id)
+            if building is not None:
+                building[0].append(functools.partial(self._drop_owner, owner_id))
+            self._drop_owner(owner_id)
+
+    def _drop_owner(self, owner_id):
+        postings = self._owners.pop(owner_id, {})
+        self._counts.pop(owner_id, None)
+        for bucket in postings.values():
+            for note_id in bucket:
+                self._docs.pop(note_id, None)
+
+    def rebuild(self, notes):
+        """
+        Replace the index contents with the given notes
+        """
+        self.reset()
+        for note in notes:
+            self.add(note)
+        logger.info("Search index built with %s notes", len(self._docs))
+
+    def reset(self, source=None):
+        """
+        Forget everything indexed; with `source`, index owners on demand
+        """
+        with self._lock:
+            self._owners = {}
+            self._counts = {}
+            self._docs = {}
+            self._source = source
+            self._building = {}
+
+    def _build(self, owner_id):
+        """
+        Index all notes of an owner that has not been searched yet; callers
+        searching the same owner meanwhile wait for the first one
+        """
+        with self._lock:
+            if owner_id in self._owners:
+                return
+            building = self._building.get(owner_id)
+            if building is not None:
+                first = False
+            else:
+                building = self._building[owner_id] = ([], threading.Event())
+                first = True
+        if not first:
+            building[1].wait()
+            return
+
+        try:
+            notes = self._source(owner_id)
+            postings = {}
+            docs = {}
+            for note in notes:
+                weights = _weights(note)
+                for term, weight in weights.items():
+                    postings.setdefault(term, {})[note.id] = weight
+                docs[note.id] = (owner_id, tuple(weights), note.version)
+            with self._lock:
+                self._owners[owner_id] = postings
+                self._counts[owner_id] = len(docs)
+                self._docs.update(docs)
+                for change in building[0]:
+                    change()
+                self._building.pop(owner_id, None)
+            logger.info("Search index built for user %s with %s notes", owner_id, len(docs))
+        finally:
+            with self._lock:
+                if self._building.get(owner_id) is building:
+                    del self._building[owner_id]
+            building[1].set()
+
+    def search(self, owner_id, query, limit=20):
+        """
+        Return up to `limit` (note_id, score) pairs matching every query term
+
+        Scores are summed tf-idf weights within the owner's notes.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        if self._source is not None and owner_id not in self._owners:
+            self._build(owner_id)
+        with self._lock:
+            postings = self._owners.get(owner_id)
+            if not postings:
+                return []
+            buckets = [postings.get(term) for term in terms]
+            if not all(buckets):
+                return []
+            total = self._counts[owner_id]
+            buckets.sort(key=len)
+            candidates = set(buckets[0])
+            for bucket in buckets[1:]:
+                candidates.intersection_update(bucket)
+                if not candidates:
+                    return []
+            idf = [math.log(1 + total / len(bucket)) for bucket in buckets]
+            scored = (
+                (note_id, sum(bucket[note_id] * weight for bucket, weight in zip(buckets, idf)))
+                for note_id in candidates
+            )
+            return heapq.nlargest(limit, scored, key=lambda hit: (hit[1], hit[0]))
+
+
+# Index shared by the whole process
+index = SearchIndex()
+
+
+def search(owner_id, query, limit=20):
+    """
+    Search an owner's notes on the active backend
+
+    SQLite keeps its own full-text index so that every worker process sees
+    the same results; the memory backend uses the in-process index.
+    """
+    if db.backend == "sqlite":
+        terms = tokenize(query)
+        return db.store.search_notes(owner_id, terms, limit) if terms else []
+    return index.search(owner_id, query, limit)
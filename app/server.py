@@ -0,0 +1,185 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, select_address_family
+
+from app import changes, db
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds an idle keep-alive connection may hold a worker thread
+KEEPALIVE_TIMEOUT = 5
+# Pending connections the kernel queues while every thread is busy
+LISTEN_BACKLOG = 1024
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Request handler that gives up on idle keep-alive connections
+
+    Werkzeug's access log line is left out: the app logs each request
+    itself, as app.access, with its request id.
+    """
+    timeout = KEEPALIVE_TIMEOUT
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that handles connections on a fixed pool of threads
+
+    Unlike the development server it never starts more than `threads`
+    threads, and closing it waits for the requests already in flight.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, fd=None):
+        # The base class may call server_close() while setting up the socket
+        self.executor = None
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def _listen(host, port):
+    """
+    Bind the listening socket that all worker processes accept on
+    """
+    family = select_address_family(host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, host, port, threads, fd=None):
+    """
+    Serve until SIGTERM/SIGINT, then finish in-flight requests and return
+    """
+    server = PooledWSGIServer(host, port, app, threads, fd=fd)
+
+    def stop(signum, frame):
+        # Waiting change feed readers are answered now instead of holding
+        # their threads until they time out
+        changes.feed.close()
+        # shutdown() waits for serve_forever, so it must not run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Worker %s serving on %s:%s with %s threads", os.getpid(), host, server.port, threads)
+    server.serve_forever()
+    logger.info("Worker %s stopped", os.getpid())
+
+
+def serve(app, host="0.0.0.0", port=12001, workers=1, threads=8, graceful_timeout=30):
+    """
+    Run the app on a production server
+
+    With one worker the app is served by a thread pool in this process. With
+    more, worker processes are forked that accept on one shared socket;
+    since each process has its own memory, that requires the SQLite backend
+    so all of them see the same users and notes. Crashed workers are
+    replaced. SIGTERM/SIGINT stop accepting connections and give in-flight
+    requests up to `graceful_timeout` seconds to finish.
+    """
+    app.debug = False
+
+    if workers <= 1:
+        _run_worker(app, host, port, threads)
+        return
+
+    if db.backend != "sqlite":
+        raise RuntimeError("Multiple worker processes need NOTES_DB_BACKEND=sqlite to share data")
+
+    sock = _listen(host, port)
+    # SQLite connections must not cross a fork, each worker opens its own
+    db.close_all_connections()
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(app, host, port, threads, fd=sock.fileno())
+            except BaseException:
+                logger.exception("Worker crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info("Starting %s workers on %s:%s", workers, host, port)
+    for _ in range(workers):
+        spawn()
+
+    deadline = None
+    while children:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + graceful_timeout
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning("Workers did not stop in time, killing them")
+            for pid in list(children):
+                # Reap a worker that exited meanwhile rather than kill a
+                # pid that may no longer be ours
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        children.discard(pid)
+                        continue
+                    os.kill(pid, signal.SIGKILL)
+                except (ChildProcessError, ProcessLookupError):
+                    children.discard(pid)
+            deadline = float("inf")
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        children.discard(pid)
+        if not stopping:
+            logger.warning("Worker %s exited with status %s, restarting it", pid, status)
+            spawn()
+
+    sock.close()
+    logger.info("All workers stopped")
@@ -0,0 +1,479 @@
+import gc
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# When writes reach the disk: after every group commit, every few seconds
+# from a background thread, or whenever the OS writes its page cache back
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# Version of the marshal format logs and snapshots are written in. marshal
+# changes its format between Python releases, so files record the version
+# they were written in: a newer Python reads older versions, an older one
+# refuses a file it cannot read rather than misread it. Raising this is an
+# upgrade that every process reading the data directory has to be on a
+# Python whose marshal.version is at least as high for.
+MARSHAL_VERSION = 4
+
+# A log segment starts with its magic and marshal version. Segments written
+# before it had one start straight with a record.
+SEGMENT_MAGIC = b"NOTESWAL"
+SEGMENT_HEADER = struct.Struct("<8sI")
+# A log record is its payload length and CRC-32 followed by the marshalled
+# payload, a tuple of (lsn, operation, *arguments)
+RECORD_HEADER = struct.Struct("<II")
+
+SNAPSHOT_FILE = "snapshot.bin"
+SNAPSHOT_MAGIC = b"NOTESNAP"
+SNAPSHOT_FORMAT = 2
+# Magic, format version, the lsn of the last write the snapshot contains and
+# the marshal version of its sections; format 1 had no marshal version and
+# was written in that of the Python reading it
+SNAPSHOT_HEADER = struct.Struct("<8sIQI")
+SNAPSHOT_HEADER_V1 = struct.Struct("<8sIQ")
+# Sections follow the header: kind, length and CRC-32 of the marshalled body
+SECTION_HEADER = struct.Struct("<BII")
+SECTION_META, SECTION_USERS, SECTION_NOTES = 0, 1, 2
+# Rows marshalled together in one section
+SECTION_ROWS = 10000
+
+
+def _segment_name(lsn):
+    return f"wal-{lsn:016d}.log"
+
+def _segments(directory):
+    """
+    (lsn the segment follows, path) of every log segment, oldest first
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("wal-") and name.endswith(".log"):
+            segments.append((int(name[4:-4]), os.path.join(directory, name)))
+    return sorted(segments)
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _check_marshal(version, path):
+    if version > marshal.version:
+        raise RuntimeError(
+            f"{path} is in marshal format {version}, Python {sys.version.split()[0]} "
+            f"reads up to format {marshal.version}; run a newer Python"
+        )
+
+def _sync_directory(directory):
+    """
+    Make a file created or renamed in `directory` survive a crash
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the writes made to the memory store
+
+    Records are buffered as the store makes them, under its lock, and written
+    out by the first writer that waits for durability together with every
+    record buffered since (group commit): writers arriving while a group is
+    being written wait for it and are all covered by the next one. `fsync`
+    decides when the data is forced to disk, see FSYNC_POLICIES; with
+    `interval` a write survives a crash of the process at once and a crash
+    of the machine after at most `interval` seconds.
+
+    The log is cut into segments, a new one starting at every snapshot, so
+    the segments a snapshot covers can simply be deleted.
+    """
+    def __init__(self, directory, lsn=0, fsync="interval"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+        self.lsn = lsn
+        self.written = lsn
+        self.size = 0
+        self.groups = 0
+        self.fsyncs = 0
+        self._buffer = []
+        self._dirty = False
+        self._fd = None
+        self._start = lsn
+        # Guards the buffer and lsn, taken by appends
+        self._lock = threading.Lock()
+        # Guards the file, held by the writer flushing a group
+        self._write_lock = threading.Lock()
+        # Last lsn appended by each thread, what sync() has to wait for
+        self._last = threading.local()
+        self._open()
+
+    def _open(self):
+        self._start = self.lsn
+        path = os.path.join(self.directory, _segment_name(self._start))
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+        if not self.size:
+            _write_all(self._fd, SEGMENT_HEADER.pack(SEGMENT_MAGIC, MARSHAL_VERSION))
+            self.size = SEGMENT_HEADER.size
+        _sync_directory(self.directory)
+
+    def append(self, record):
+        """
+        Buffer a (operation, *arguments) record, returns its lsn
+        """
+        with self._lock:
+            self.lsn += 1
+            payload = marshal.dumps((self.lsn,) + record, MARSHAL_VERSION)
+            self._buffer.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._buffer.append(payload)
+            self._last.lsn = self.lsn
+            return self.lsn
+
+    def sync(self):
+        """
+        Wait until every record this thread appended is written (and, under
+        the `always` policy, on disk)
+        """
+        lsn = getattr(self._last, "lsn", 0)
+        if lsn <= self.written:
+            return
+        with self._write_lock:
+            if lsn > self.written:
+                self._flush()
+
+    def _flush(self):
+        with self._lock:
+            chunks, self._buffer = self._buffer, []
+            lsn = self.lsn
+        if chunks:
+            data = b"".join(chunks)
+            _write_all(self._fd, data)
+            self.size += len(data)
+            self.groups += 1
+            if self.fsync == "always":
+                os.fsync(self._fd)
+                self.fsyncs += 1
+            else:
+                self._dirty = True
+        self.written = lsn
+
+    def flush(self, fsync=True):
+        """
+        Write out everything buffered and, unless the policy is `never`,
+        force it to disk; run periodically under the `interval` policy
+        """
+        with self._write_lock:
+            if self._fd is None:
+                return
+            self._flush()
+            if fsync and self._dirty and self.fsync != "never":
+                os.fsync(self._fd)
+                self.fsyncs += 1
+                self._dirty = False
+
+    def rotate(self):
+        """
+        Close the current segment and start the next one, returns the lsn of
+        the last record in the closed segment. The caller holds the store's
+        write lock, so nothing is appended meanwhile.
+        """
+        self.flush()
+        with self._write_lock:
+            os.close(self._fd)
+            self._open()
+        return self._start
+
+    def discard(self, lsn):
+        """
+        Delete the segments that only hold records up to `lsn`
+        """
+        for start, path in _segments(self.directory):
+            if start < lsn and start != self._start:
+                os.remove(path)
+
+    def close(self):
+        self.flush()
+        with self._write_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def stats(self):
+        return {
+            "fsync": self.fsync,
+            "lsn": self.lsn,
+            "written": self.written,
+            "segment_bytes": self.size,
+            "groups": self.groups,
+            "fsyncs": self.fsyncs
+        }
+
+
+def replay(directory, after=0):
+    """
+    Yield (lsn, record) for every record logged after lsn `after`
+
+    A record cut short or garbled by a crash can only be the last one
+    written, so the last segment is truncated before it and replay ends
+    there; damage anywhere else is an error.
+    """
+    segments = _segments(directory)
+    for number, (_, path) in enumerate(segments):
+        with open(path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                continue
+            offset = 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if size >= SEGMENT_HEADER.size and data[:len(SEGMENT_MAGIC)] == SEGMENT_MAGIC:
+                    _check_marshal(SEGMENT_HEADER.unpack_from(data, 0)[1], path)
+                    offset = SEGMENT_HEADER.size
+                while offset < size:
+                    end = offset + RECORD_HEADER.size
+                    if end <= size:
+                        length, crc = RECORD_HEADER.unpack_from(data, offset)
+                        payload = data[end:end + length]
+                        if len(payload) == length and zlib.crc32(payload) == crc:
+                            record = marshal.loads(payload)
+                            offset = end + length
+                            if record[0] > after:
+                                yield record[0], record[1:]
+                            continue
+                    if number != len(segments) - 1:
+                        raise RuntimeError(f"Corrupt write-ahead log segment {path} at byte {offset}")
+                    logger.warning("Truncating torn write at byte %s of %s", offset, path)
+                    break
+            if offset < size:
+                f.truncate(offset)
+
+
+def write_snapshot(directory, lsn, meta, users, notes):
+    """
+    Write a snapshot of the store as of `lsn` and make it the current one
+
+    `meta` is a dict of marshallable values, `users` and `notes` iterables
+    of row tuples in id order. The file is written under a temporary name
+    and renamed over the previous snapshot once it is on disk, so a crash
+    leaves either the old snapshot or the new one. Returns its size.
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, lsn, MARSHAL_VERSION))
+
+        def section(kind, body):
+            data = marshal.dumps(body, MARSHAL_VERSION)
+            f.write(SECTION_HEADER.pack(kind, len(data), zlib.crc32(data)))
+            f.write(data)
+
+        section(SECTION_META, meta)
+        for kind, rows in ((SECTION_USERS, users), (SECTION_NOTES, notes)):
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == SECTION_ROWS:
+                    section(kind, chunk)
+                    chunk = []
+            if chunk:
+                section(kind, chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.replace(temporary, path)
+    _sync_directory(directory)
+    return size
+
+
+def read_snapshot(directory):
+    """
+    Map the current snapshot into memory and decode it
+
+    Returns (lsn, meta, users, notes) with the rows as lists of tuples, or
+    None if there is no snapshot yet. Sections are unmarshalled straight
+    from the mapped file, without reading it into a buffer first.
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return None
+    sections = {SECTION_META: [], SECTION_USERS: [], SECTION_NOTES: []}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, lsn = SNAPSHOT_HEADER_V1.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_FORMAT):
+            raise RuntimeError(f"{path} is not a snapshot this version can read")
+        if version == 1:
+            offset = SNAPSHOT_HEADER_V1.size
+        else:
+            _check_marshal(SNAPSHOT_HEADER.unpack_from(data, 0)[3], path)
+            offset = SNAPSHOT_HEADER.size
+        with memoryview(data) as view:
+            while offset < len(data):
+                kind, length, crc = SECTION_HEADER.unpack_from(data, offset)
+                offset += SECTION_HEADER.size
+                body = view[offset:offset + length]
+                if len(body) != length or zlib.crc32(body) != crc:
+                    body.release()
+                    raise RuntimeError(f"Corrupt snapshot {path} at byte {offset}")
+                sections[kind].append(marshal.loads(body))
+                body.release()
+                offset += length
+    meta, = sections[SECTION_META]
+    users = [row for chunk in sections[SECTION_USERS] for row in chunk]
+    notes = [row for chunk in sections[SECTION_NOTES] for row in chunk]
+    return lsn, meta, users, notes
+
+
+class Persistence:
+    """
+    Keeps the memory store in a directory: a snapshot plus the write-ahead
+    log of every write since
+
+    On open the snapshot is loaded and the log replayed on top of it, then
+    the log is attached to the store. A background thread forces the log to
+    disk every `fsync_interval` seconds (under the `interval` policy) and
+    takes a new snapshot once the log has grown past `snapshot_bytes`, or
+    when `snapshot_interval` seconds have passed with writes in between.
+    Taking one only blocks writers while the store's row dicts are copied;
+    rows are immutable, so the copies are serialized without any lock.
+    """
+    def __init__(self, directory, fsync="interval", fsync_interval=1.0,
+                 snapshot_interval=300, snapshot_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.store = None
+        self.wal = None
+        self.snapshots = 0
+        self.snapshot_size = 0
+        self.snapshot_seconds = None
+        self.load_seconds = None
+        self.replayed = 0
+        self._last_snapshot = time.monotonic()
+        self._snapshot_due = False
+        self._snapshot_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open(self, store, seed=None):
+        """
+        Load the directory into an empty store and start logging its writes
+
+        An empty directory is seeded with `seed(store)`, and a directory
+        without a snapshot gets one right away, so the store's secret key is
+        kept from the start.
+        """
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        # Millions of rows are created here and none of them can be part of
+        # a reference cycle, so the cycle collector would only walk the
+        # growing heap again and again; it is paused while loading, and what
+        # was loaded is moved out of its sight for good
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            snapshot = read_snapshot(self.directory)
+            lsn = 0
+            if snapshot is not None:
+                lsn, meta, users, notes = snapshot
+                store.load(meta, users, notes)
+                del users, notes
+            for lsn, record in replay(self.directory, lsn):
+                store.replay(record)
+                self.replayed += 1
+        finally:
+            gc.freeze()
+            if collecting:
+                gc.enable()
+        self.load_seconds = time.perf_counter() - start
+        logger.info("Loaded %s users and %s notes from %s in %.2fs (%s logged writes replayed)",
+                    len(store.users), len(store.notes), self.directory, self.load_seconds, self.replayed)
+
+        if store.blobs is not None:
+            # Blobs dropped during the replay go now, with any left behind
+            store.blobs.dropped()
+            store.blobs.sweep()
+        self.store = store
+        self.wal = WriteAheadLog(self.directory, lsn, self.fsync)
+        store.wal = self.wal
+        if snapshot is None:
+            if seed is not None and not self.replayed:
+                seed(store)
+            self.snapshot()
+        else:
+            # The segments replayed count towards the next snapshot too
+            replayed = sum(os.path.getsize(path) for _, path in _segments(self.directory))
+            self._snapshot_due = replayed >= self.snapshot_bytes
+        self._thread = threading.Thread(target=self._run, name="wal", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                if self.fsync == "interval":
+                    self.wal.flush()
+                if self._snapshot_due or self.wal.size >= self.snapshot_bytes or (
+                    self.wal.size and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+                ):
+                    self.snapshot()
+            except Exception:
+                logger.exception("Write-ahead log maintenance failed")
+
+    def snapshot(self):
+        """
+        Write a snapshot of the store now and drop the log it makes redundant
+        """
+        with self._snapshot_lock:
+            start = time.perf_counter()
+            # Blobs dropped by now were dropped by writes the snapshot covers
+            blobs = self.store.blobs
+            dropped = blobs.dropped() if blobs is not None else ()
+            lsn, meta, users, notes = self.store.checkpoint()
+            self.snapshot_size = write_snapshot(self.directory, lsn, meta, users, notes)
+            self.wal.discard(lsn)
+            if dropped:
+                blobs.remove(dropped)
+            self.snapshots += 1
+            self._snapshot_due = False
+            self.snapshot_seconds = time.perf_counter() - start
+            self._last_snapshot = time.monotonic()
+            logger.info("Wrote snapshot at lsn %s (%s bytes) in %.2fs", lsn, self.snapshot_size, self.snapshot_seconds)
+            return lsn
+
+    def close(self):
+        """
+        Stop the background thread and force the log to disk
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.store is not None:
+            self.store.wal = None
+        if self.wal is not None:
+            self.wal.close()
+        # Let the cycle collector reclaim the store once it is replaced
+        gc.unfreeze()
+
+    def stats(self):
+        return dict(
+            self.wal.stats(),
+            directory=self.directory,
+            replayed=self.replayed,
+            load_seconds=self.load_seconds,
+            snapshots=self.snapshots,
+            snapshot_bytes=self.snapshot_size,
+            snapshot_seconds=self.snapshot_seconds
+        )
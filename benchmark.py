@@ -0,0 +1,568 @@
+"""
+Load and benchmark suite for the Notes API
+
+Seeds the store with a configurable number of users and notes (notes per
+user follow a Zipf-like distribution, so a few users own most notes), drives
+a mixed workload from several client threads and reports throughput and
+p50/p95/p99 latency per endpoint. Results can be saved as JSON and compared
+against a stored baseline; the exit status is 1 when a regression is found.
+
+    # In-process through Flask's test client
+    python benchmark.py --notes 100000 --requests 20000
+
+    # Over real sockets against a server started in this process
+    python benchmark.py --target http --concurrency 8
+
+    # Against a running server (seeded through the API)
+    python benchmark.py --target http --url http://127.0.0.1:12001 --notes 10000
+
+    # Record a baseline, then compare later runs with it
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.15
+
+    # Restart time of the on-disk memory store
+    python benchmark.py --startup --notes 1000000 --requests 1000
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Configure logging
+logger = logging.getLogger("benchmark")
+
+# Relative weight of each operation in the default workload
+DEFAULT_MIX = {
+    "login": 5,
+    "list": 30,
+    "get": 35,
+    "create": 8,
+    "update": 15,
+    "delete": 4,
+    "admin_list": 3
+}
+ADMIN_EMAIL = "admin@example.com"
+ADMIN_PASSWORD = "admin123"
+# Notes created per batch request while seeding
+SEED_BATCH_SIZE = 1000
+PAGE_SIZE = 50
+WORDS = (
+    "alpha beta gamma delta meeting notes draft review budget plan travel idea todo "
+    "project release design api server cache index query latency report summary"
+).split()
+
+
+class TestClientTransport:
+    """
+    Sends requests through Flask's test client, without any sockets
+    """
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, body=None, cookie=None):
+        headers = {"Cookie": f"session={cookie}"} if cookie else None
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        data = response.get_data()
+        return response.status_code, data, _session_cookie(response.headers.getlist("Set-Cookie"))
+
+
+class HTTPTransport:
+    """
+    Sends requests over keep-alive HTTP connections
+    """
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, path, body=None, cookie=None):
+        headers = {"Cookie": f"session={cookie}"} if cookie else None
+        response = self.session.request(method, self.base_url + path, json=body, headers=headers)
+        data = response.content
+        # Cookies are passed explicitly per user, never through the jar
+        self.session.cookies.clear()
+        return response.status_code, data, _session_cookie(response.raw.headers.getlist("Set-Cookie"))
+
+
+def _session_cookie(set_cookie_headers):
+    for header in set_cookie_headers:
+        name, _, rest = header.partition("=")
+        if name == "session":
+            return rest.split(";", 1)[0]
+    return None
+
+
+def skewed_owners(users, notes, skew, rng):
+    """
+    Pick an owner index for every note, user i weighted 1 / (i + 1) ** skew
+    """
+    weights = list(itertools.accumulate(1 / (i + 1) ** skew for i in range(users)))
+    return rng.choices(range(users), cum_weights=weights, k=notes)
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def seed_in_process(users, notes, skew, content_size, rng):
+    """
+    Create users and notes directly through the repositories
+
+    Returns [(email, password, [note_id, ...]), ...] in user order.
+    """
+    from app.crud import UserRepo, NoteRepo
+    from app.models import Note
+
+    accounts = []
+    for i in range(users):
+        email, password = f"bench{i}@example.com", f"pw{i}"
+        existing = UserRepo.by_email(email)
+        user_id = existing.id if existing else UserRepo.create(f"bench{i}", email, password)
+        accounts.append((user_id, email, password, []))
+
+    owners = skewed_owners(users, notes, skew, rng)
+    for start in range(0, notes, SEED_BATCH_SIZE):
+        chunk = owners[start:start + SEED_BATCH_SIZE]
+        operations = [
+            ("create", Note(None, f"note {start + i}", _text(rng, content_size), accounts[owner][0]))
+            for i, owner in enumerate(chunk)
+        ]
+        for owner, row in zip(chunk, NoteRepo.apply_batch(operations)):
+            accounts[owner][3].append(row.id)
+    return [(email, password, ids) for _, email, password, ids in accounts]
+
+
+def seed_over_http(transport, users, notes, skew, content_size, rng):
+    """
+    Create users and notes through the public API of a running server
+    """
+    accounts = []
+    for i in range(users):
+        email, password = f"bench{i}@example.com", f"pw{i}"
+        transport.request("POST", "/api/register", {"name": f"bench{i}", "email": email, "password": password})
+        accounts.append((email, password, []))
+
+    owners = skewed_owners(users, notes, skew, rng)
+    by_owner = {}
+    for note, owner in enumerate(owners):
+        by_owner.setdefault(owner, []).append(note)
+    for owner, seeded in by_owner.items():
+        email, password, ids = accounts[owner]
+        status, _, cookie = transport.request("POST", "/api/login", {"email": email, "password": password})
+        if status != 200:
+            raise RuntimeError(f"Could not log in as {email} while seeding")
+        for start in range(0, len(seeded), SEED_BATCH_SIZE):
+            operations = [
+                {"op": "create", "title": f"note {note}", "content": _text(rng, content_size)}
+                for note in seeded[start:start + SEED_BATCH_SIZE]
+            ]
+            status, body, _ = transport.request("POST", "/api/notes/batch", {"operations": operations}, cookie)
+            if status != 200:
+                raise RuntimeError(f"Seeding batch failed with status {status}")
+            ids.extend(result["note_id"] for result in json.loads(body)["results"])
+    return accounts
+
+
+def store_memory():
+    """
+    Bytes per user and per note held by the in-memory store
+
+    Also reports what the same rows would take as plain dicts, the
+    representation the store used before rows became slotted records.
+    """
+    from app import db
+    if db.backend != "memory":
+        return None
+    report = {}
+    for name, table in (("user", db.store.users), ("note", db.store.notes)):
+        if not len(table):
+            continue
+        sample = list(itertools.islice(table.rows.values(), 10000))
+        report[f"bytes_per_{name}"] = table.memory_usage() / len(table)
+        report[f"record_bytes_per_{name}"] = sum(sys.getsizeof(row) for row in sample) / len(sample)
+        report[f"dict_bytes_per_{name}"] = sum(sys.getsizeof(row.to_dict()) for row in sample) / len(sample)
+    return report
+
+
+# Run in a new interpreter to time a restart of the app, as main.py does
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+from app import create_app, db
+create_app()
+print(json.dumps({"startup_s": time.perf_counter() - start, "load_s": db.persistence.load_seconds,
+                  "replayed": db.persistence.replayed}))
+"""
+
+
+def measure_startup():
+    """
+    Seconds a restart of the persistent memory store takes, replaying the
+    write-ahead log of everything done so far and then from a snapshot
+
+    Each restart is a new process running create_app, so it includes the
+    imports; `load_s` is the store's share.
+    """
+    import subprocess
+    from app import db
+    if db.persistence is None:
+        return None
+    db.persistence.wal.flush()
+    report = {"notes": len(db.store.notes), "wal_bytes": db.persistence.wal.size}
+    for name in ("wal", "snapshot"):
+        if name == "snapshot":
+            db.persistence.snapshot()
+            report["snapshot_write_s"] = db.persistence.snapshot_seconds
+            report["snapshot_bytes"] = db.persistence.snapshot_size
+        probe = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings = json.loads(probe.stdout.strip().splitlines()[-1])
+        report[f"{name}_startup_s"] = timings["startup_s"]
+        report[f"{name}_load_s"] = timings["load_s"]
+        report[f"{name}_replayed"] = timings["replayed"]
+    return report
+
+
+class Worker(threading.Thread):
+    """
+    One client thread driving the mixed workload for its share of the users
+
+    Users are split between workers so each note list is only touched by one
+    thread; within its share a worker picks users with the same skew the data
+    was seeded with, so heavy users also get most of the traffic.
+    """
+    def __init__(self, index, transport, accounts, mix, skew, operations, warmup, content_size, seed):
+        super().__init__(name=f"bench-{index}", daemon=True)
+        self.transport = transport
+        self.accounts = accounts
+        self.ops, weights = zip(*mix.items())
+        self.op_weights = list(itertools.accumulate(weights))
+        self.user_weights = list(itertools.accumulate(1 / (i + 1) ** skew for i in range(len(accounts))))
+        self.operations = operations
+        self.warmup = warmup
+        self.content_size = content_size
+        self.rng = random.Random(seed)
+        self.cookies = {}
+        self.admin_cookie = None
+        self.latencies = {op: [] for op in self.ops}
+        self.errors = {op: 0 for op in self.ops}
+        self.error = None
+
+    def _login(self, account):
+        email, password, _ = self.accounts[account]
+        status, _, cookie = self.transport.request("POST", "/api/login", {"email": email, "password": password})
+        if status == 200:
+            self.cookies[account] = cookie
+        return status
+
+    def _step(self, op):
+        rng = self.rng
+        if op == "admin_list":
+            path = f"/api/admin/users?limit={PAGE_SIZE}&after={rng.randrange(len(self.accounts))}"
+            return self.transport.request("GET", path, cookie=self.admin_cookie)[0]
+
+        account = rng.choices(range(len(self.accounts)), cum_weights=self.user_weights)[0]
+        if op == "login":
+            return self._login(account)
+        if account not in self.cookies:
+            self._login(account)
+        cookie = self.cookies.get(account)
+        ids = self.accounts[account][2]
+        if op in ("get", "update", "delete") and not ids:
+            op = "create"
+
+        if op == "list":
+            return self.transport.request("GET", f"/api/notes?limit={PAGE_SIZE}", cookie=cookie)[0]
+        if op == "get":
+            return self.transport.request("GET", f"/api/notes/{rng.choice(ids)}", cookie=cookie)[0]
+        if op == "create":
+            body = {"title": "new note", "content": _text(rng, self.content_size)}
+            status, data, _ = self.transport.request("POST", "/api/notes", body, cookie)
+            if status == 201:
+                ids.append(json.loads(data)["note_id"])
+            return status
+        if op == "update":
+            body = {"content": _text(rng, self.content_size)}
+            return self.transport.request("PUT", f"/api/notes/{rng.choice(ids)}", body, cookie)[0]
+        if op == "delete":
+            position = rng.randrange(len(ids))
+            ids[position], ids[-1] = ids[-1], ids[position]
+            status = self.transport.request("DELETE", f"/api/notes/{ids[-1]}", cookie=cookie)[0]
+            if status == 200:
+                ids.pop()
+            return status
+        raise ValueError(f"Unknown operation: {op}")
+
+    def run(self):
+        try:
+            status, _, self.admin_cookie = self.transport.request(
+                "POST", "/api/login", {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+            )
+            if status != 200:
+                raise RuntimeError("Could not log in as the admin user")
+            for i in range(self.warmup + self.operations):
+                op = self.rng.choices(self.ops, cum_weights=self.op_weights)[0]
+                start = time.perf_counter()
+                status = self._step(op)
+                elapsed = time.perf_counter() - start
+                if i < self.warmup:
+                    continue
+                self.latencies[op].append(elapsed)
+                if status >= 400:
+                    self.errors[op] += 1
+        except Exception as e:
+            self.error = e
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not ordered:
+        return None
+    rank = max(1, round(fraction * len(ordered) + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    endpoints = {}
+    for op in sorted(latencies):
+        ordered = sorted(latencies[op])
+        if not ordered:
+            continue
+        endpoints[op] = {
+            "requests": len(ordered),
+            "errors": errors[op],
+            "throughput": len(ordered) / elapsed,
+            "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "elapsed_s": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "endpoints": endpoints
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Return a list of regressions of `result` against `baseline`
+
+    An endpoint regresses when its p95 latency grows, or its throughput
+    drops, by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    for op, current in result["endpoints"].items():
+        previous = baseline["endpoints"].get(op)
+        if previous is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{op}: p95 {previous['p95_ms']:.3f} ms -> {current['p95_ms']:.3f} ms")
+        if current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{op}: throughput {previous['throughput']:.1f}/s -> {current['throughput']:.1f}/s")
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"total: throughput {baseline['throughput']:.1f}/s -> {result['throughput']:.1f}/s")
+    return regressions
+
+
+def print_report(result):
+    print(f"{'endpoint':<12} {'requests':>9} {'errors':>7} {'req/s':>10} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for op, stats in result["endpoints"].items():
+        print(f"{op:<12} {stats['requests']:>9} {stats['errors']:>7} {stats['throughput']:>10.1f} "
+              f"{stats['p50_ms']:>9.3f} {stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f}")
+    print(f"{'total':<12} {result['requests']:>9} {result['errors']:>7} {result['throughput']:>10.1f}")
+    memory = result.get("memory")
+    if memory:
+        for name in ("user", "note"):
+            if f"bytes_per_{name}" in memory:
+                print(f"store memory per {name}: {memory[f'bytes_per_{name}']:.0f} bytes "
+                      f"(record {memory[f'record_bytes_per_{name}']:.0f}, "
+                      f"as dict {memory[f'dict_bytes_per_{name}']:.0f})")
+    startup = result.get("startup")
+    if startup:
+        print(f"startup with {startup['notes']} notes: {startup['wal_startup_s']:.2f}s replaying "
+              f"{startup['wal_replayed']} logged writes ({startup['wal_bytes'] / 2 ** 20:.1f} MiB, "
+              f"store {startup['wal_load_s']:.2f}s), {startup['snapshot_startup_s']:.2f}s from a "
+              f"{startup['snapshot_bytes'] / 2 ** 20:.1f} MiB snapshot (store {startup['snapshot_load_s']:.2f}s, "
+              f"written in {startup['snapshot_write_s']:.2f}s)")
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {op: 0 for op in DEFAULT_MIX}
+        for part in text.split(","):
+            op, _, weight = part.partition("=")
+            if op not in DEFAULT_MIX:
+                raise argparse.ArgumentTypeError(f"unknown operation {op!r}")
+            mix[op] = float(weight)
+    return {op: weight for op, weight in mix.items() if weight > 0}
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    server = thread = None
+
+    if args.target == "http" and args.url:
+        transports = [HTTPTransport(args.url) for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        accounts = seed_over_http(transports[0], args.users, args.notes, args.skew, args.content_size, rng)
+    else:
+        os.environ.setdefault("NOTES_LOG_LEVEL", args.log_level)
+        # Every simulated client shares one address, which the per-client
+        # limit would throttle; measure the server, not the limiter
+        os.environ.setdefault("NOTES_RATE_LIMIT_ENABLED", "true" if args.rate_limit else "false")
+        if args.startup:
+            # Keep everything in the log until the startup is measured
+            os.environ.setdefault("NOTES_DB_DATA_DIR", tempfile.mkdtemp(prefix="notes-bench-"))
+            os.environ.setdefault("NOTES_DB_SNAPSHOT_BYTES", str(2 ** 62))
+            os.environ.setdefault("NOTES_DB_SNAPSHOT_INTERVAL", str(2 ** 62))
+        from app import create_app
+        app = create_app()
+        start = time.perf_counter()
+        accounts = seed_in_process(args.users, args.notes, args.skew, args.content_size, rng)
+        if args.target == "http":
+            from app.server import PooledWSGIServer
+            server = PooledWSGIServer("127.0.0.1", 0, app, threads=args.threads)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            transports = [HTTPTransport(f"http://127.0.0.1:{server.port}") for _ in range(args.concurrency)]
+        else:
+            transports = [TestClientTransport(app) for _ in range(args.concurrency)]
+    seed_time = time.perf_counter() - start
+    logger.info("Seeded %s users and %s notes in %.1fs", args.users, args.notes, seed_time)
+    memory = None if args.url else store_memory()
+
+    per_worker = args.requests // args.concurrency
+    workers = [
+        Worker(i, transports[i], accounts[i::args.concurrency], args.mix, args.skew,
+               per_worker, args.warmup, args.content_size, args.seed + i + 1)
+        for i in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
+
+    latencies = {op: [] for op in args.mix}
+    errors = {op: 0 for op in args.mix}
+    for worker in workers:
+        for op in args.mix:
+            latencies[op].extend(worker.latencies[op])
+            errors[op] += worker.errors[op]
+
+    result = summarize(latencies, errors, elapsed)
+    result["seed_s"] = seed_time
+    result["memory"] = memory
+    if args.startup and not args.url:
+        result["startup"] = measure_startup()
+    result["config"] = {
+        "target": args.url or args.target,
+        "backend": os.environ.get("NOTES_DB_BACKEND", "memory") if not args.url else "remote",
+        "users": args.users,
+        "notes": args.notes,
+        "skew": args.skew,
+        "content_size": args.content_size,
+        "concurrency": args.concurrency,
+        "threads": args.threads,
+        "warmup": args.warmup,
+        "mix": args.mix,
+        "seed": args.seed,
+        "rate_limit": args.rate_limit,
+        "startup": args.startup
+    }
+    result["environment"] = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform()
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Notes API")
+    parser.add_argument("--target", choices=("inprocess", "http"), default="inprocess",
+                        help="test client, or real HTTP against --url or a server started here")
+    parser.add_argument("--url", help="base URL of a running server, seeded through the API")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--notes", type=int, default=10000)
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent of notes and traffic per user (0 is uniform)")
+    parser.add_argument("--content-size", type=int, default=200, help="characters of content per note")
+    parser.add_argument("--requests", type=int, default=10000, help="measured requests in total")
+    parser.add_argument("--warmup", type=int, default=100, help="unmeasured requests per client first")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--threads", type=int, default=8, help="server threads for a server started here")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(None),
+                        help="operation weights, e.g. get=50,list=30,update=20")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING", help="app log level unless NOTES_LOG_LEVEL is set")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep rate limiting on for a server started here (off unless NOTES_RATE_LIMIT_ENABLED is set)")
+    parser.add_argument("--startup", action="store_true",
+                        help="keep the memory store on disk (NOTES_DB_DATA_DIR, a temporary directory "
+                             "unless set) and measure restarting it after the run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed relative slowdown before a change counts as a regression")
+    args = parser.parse_args()
+    if not 1 <= args.concurrency <= args.users:
+        parser.error("--concurrency must be between 1 and --users")
+
+    from app.log import configure_logging
+    configure_logging(level=args.log_level)
+    logger.setLevel(logging.INFO)
+    result = run(args)
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        logger.info("Results written to %s", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against", args.baseline)
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import logging
+import uuid
+
+import pytest
+
+from app import create_app, db
+
+# Settings every test app starts from, as NOTES_* environment variables
+TEST_SETTINGS = {
+    "LOG_LEVEL": "WARNING",
+    # Every client shares one address, which the per-client limit would throttle
+    "RATE_LIMIT_ENABLED": "false",
+}
+
+
+@pytest.fixture(params=["memory", "memory-wal", "sqlite"])
+def store(request, tmp_path):
+    """Bare store of each backend, without the app's instrumentation"""
+    if request.param == "memory-wal":
+        db.init_db("memory", data_dir=str(tmp_path / "data"))
+    else:
+        db.init_db(request.param, str(tmp_path / "notes.db"))
+    yield db.store
+    db.close_persistence()
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_app(request, tmp_path, monkeypatch):
+    """Builds the app on each backend, with NOTES_* settings on top of TEST_SETTINGS"""
+    def make_app(**settings):
+        settings = dict(TEST_SETTINGS, DB_BACKEND=request.param, DB_PATH=tmp_path / "notes.db",
+                        PROFILE_DIR=tmp_path / "profiles", **settings)
+        for name, value in settings.items():
+            monkeypatch.setenv(f"NOTES_{name}", str(value))
+        return create_app()
+
+    yield make_app
+    logging.getLogger().setLevel(logging.WARNING)
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def login(app):
+    """Logs in on a client of its own, which keeps the session cookie"""
+    def login(email, password):
+        client = app.test_client()
+        r = client.post("/api/login", json={"email": email, "password": password})
+        assert r.status_code == 200
+        return client
+
+    return login
+
+@pytest.fixture
+def register(app, login):
+    """Registers a user under a unique name, returns their logged in client and id"""
+    def register(prefix="user"):
+        name = f"{prefix}-{uuid.uuid4().hex[:8]}"
+        r = app.test_client().post("/api/register", json={"name": name, "email": f"{name}@x", "password": "p"})
+        assert r.status_code == 201
+        return login(f"{name}@x", "p"), r.get_json()["user_id"]
+
+    return register
+
+@pytest.fixture
+def admin(login):
+    return login("admin@example.com", "admin123")
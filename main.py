@@ -1,12 +1,28 @@
+import argparse
 import logging
 from app import create_app
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Configure logging (set up by create_app)
 logger = logging.getLogger(__name__)
 
 app = create_app()
 
 if __name__ == '__main__':
-    logger.info("Starting Notes API server")
-    app.run(host='0.0.0.0', port=12001, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Notes API server")
+    parser.add_argument('--host', default=app.config['HOST'])
+    parser.add_argument('--port', type=int, default=app.config['PORT'])
+    parser.add_argument('--workers', type=int, default=app.config['WORKERS'],
+                        help="worker processes (more than one needs NOTES_DB_BACKEND=sqlite)")
+    parser.add_argument('--threads', type=int, default=app.config['THREADS'],
+                        help="request threads per worker")
+    parser.add_argument('--debug', action='store_true',
+                        help="run the single-process development server with the reloader")
+    args = parser.parse_args()
+
+    if args.debug:
+        logger.info("Starting Notes API development server")
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        from app.server import serve
+        logger.info("Starting Notes API server")
+        serve(app, args.host, args.port, workers=args.workers, threads=args.threads)
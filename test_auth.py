@@ -0,0 +1,94 @@
+import time
+import types
+import uuid
+
+import pytest
+
+from app import auth
+from app.crud import TokenRepo
+
+
+@pytest.fixture
+def user(app):
+    """Registers a user, returns their email and id"""
+    name = f"token-{uuid.uuid4().hex[:8]}"
+    r = app.test_client().post("/api/register", json={"name": name, "email": f"{name}@x", "password": "p"})
+    assert r.status_code == 201
+    return f"{name}@x", r.get_json()["user_id"]
+
+@pytest.fixture
+def issue(app):
+    """Logs in and returns the bearer token, on a client without the cookie"""
+    def issue(user):
+        r = app.test_client().post("/api/login", json={"email": user[0], "password": "p"})
+        assert r.status_code == 200
+        body = r.get_json()
+        assert body["token_type"] == "Bearer"
+        return body["token"]
+
+    return issue
+
+def get(app, token, url="/api/notes"):
+    return app.test_client().get(url, headers={"Authorization": f"Bearer {token}"})
+
+def test_token_is_issued_and_used(app, user, issue):
+    r = app.test_client().post("/api/login", json={"email": user[0], "password": "p"})
+    assert 0 < r.get_json()["expires_in"] <= app.config["TOKEN_TTL"]
+    token = issue(user)
+    assert get(app, token).status_code == 200
+    assert get(app, token + "x").status_code == 401
+    assert app.test_client().get("/api/notes").status_code == 401
+    # Only a hash of the token is stored
+    assert TokenRepo.by_id(token, time.time()) is None
+    assert TokenRepo.by_id(auth.tokens.hash(token), time.time()) is not None
+
+def test_token_expires_after_its_ttl(make_app, monkeypatch):
+    app = make_app(TOKEN_TTL=60)
+    token = app.test_client().post("/api/login", json={"email": "admin@example.com",
+                                                       "password": "admin123"}).get_json()["token"]
+    assert get(app, token).status_code == 200
+    assert get(app, token).status_code == 200
+    # Cached or not, the token stops working once its TTL has passed
+    later = time.time() + 61
+    monkeypatch.setattr(auth, "time", types.SimpleNamespace(time=lambda: later))
+    assert get(app, token).status_code == 401
+    auth.tokens.cache.clear()
+    assert get(app, token).status_code == 401
+
+def test_logout_revokes_the_token(app, user, issue):
+    token, other = issue(user), issue(user)
+    client = app.test_client()
+    r = client.post("/api/logout", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    assert get(app, token).status_code == 401
+    assert get(app, other).status_code == 200
+
+    # Logging out of a cookie session revokes its token too
+    client.post("/api/login", json={"email": user[0], "password": "p"})
+    assert client.get("/api/notes").status_code == 200
+    client.post("/api/logout")
+    assert client.get("/api/notes").status_code == 401
+
+def test_deleting_a_user_revokes_all_their_tokens(app, user, issue, admin):
+    tokens = [issue(user), issue(user)]
+    assert all(get(app, token).status_code == 200 for token in tokens)
+    assert admin.delete(f"/api/admin/users/{user[1]}").status_code == 202
+    assert [get(app, token).status_code for token in tokens] == [401, 401]
+    assert admin.get("/api/notes").status_code == 200
+
+def test_cache_is_emptied_when_another_worker_revokes(app, user, issue):
+    kept, revoked = issue(user), issue(user)
+    assert get(app, kept).status_code == get(app, revoked).status_code == 200
+    before = auth.tokens.cache.stats()
+    assert get(app, revoked).status_code == 200
+    assert auth.tokens.cache.stats()["hits"] == before["hits"] + 1
+
+    # Another worker deletes the token, leaving this worker's cache alone
+    version = TokenRepo.auth_version()
+    assert TokenRepo.delete(auth.tokens.hash(revoked)) is not None
+    assert TokenRepo.auth_version() != version
+    assert get(app, revoked).status_code == 401
+    assert get(app, kept).status_code == 200
+    after = auth.tokens.cache.stats()
+    assert after["flushes"] == before["flushes"] + 1
+    assert after["misses"] == before["misses"] + 2
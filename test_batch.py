@@ -0,0 +1,104 @@
+import gc
+import uuid
+
+import pytest
+
+from app import db
+from app.crud import NoteRepo
+from app.models import Note, User
+
+
+def create(client, title="title", content="content"):
+    r = client.post("/api/notes", json={"title": title, "content": content})
+    assert r.status_code == 201
+    return r.get_json()["note_id"]
+
+def listing(client):
+    return client.get("/api/notes?include=content").get_json()
+
+def test_batch_is_applied_whole(register):
+    client, _ = register()
+    kept, deleted = create(client), create(client)
+    r = client.post("/api/notes/batch", json={"operations": [
+        {"op": "create", "title": "new", "content": "c"},
+        {"op": "update", "id": kept, "content": "updated"},
+        {"op": "update", "id": kept, "title": "renamed"},
+        {"op": "delete", "id": deleted},
+    ]})
+    assert r.status_code == 200
+    results = r.get_json()["results"]
+    assert [result["status"] for result in results] == [201, 200, 200, 200]
+    assert results[2]["note"]["version"] == 3
+    notes = {note["id"]: note for note in listing(client)["notes"]}
+    assert sorted(notes) == sorted([kept, results[0]["note_id"]])
+    assert (notes[kept]["title"], notes[kept]["content"]) == ("renamed", "updated")
+
+@pytest.mark.parametrize("invalid, status", [
+    ({"op": "update", "id": 0, "title": "t"}, 404),
+    ({"op": "update", "title": 1}, 404),
+    ({"op": "create", "title": "t", "content": 1}, 400),
+    ({"op": "rename"}, 400),
+])
+def test_batch_with_an_invalid_item_changes_nothing(register, invalid, status):
+    client, _ = register()
+    note_id = create(client)
+    before = listing(client)
+    r = client.post("/api/notes/batch", json={"operations": [
+        {"op": "create", "title": "new", "content": "c"},
+        {"op": "update", "id": note_id, "content": "updated"},
+        invalid,
+    ]})
+    assert r.status_code == status
+    assert [error["index"] for error in r.get_json()["errors"]] == [2]
+    assert listing(client) == before
+
+def test_batch_of_another_users_note_is_refused(register):
+    owner, _ = register()
+    other, _ = register()
+    note_id = create(owner)
+    r = other.post("/api/notes/batch", json={"operations": [{"op": "delete", "id": note_id}]})
+    assert r.status_code == 403
+    assert owner.get(f"/api/notes/{note_id}").status_code == 200
+
+def test_batch_refused_by_the_store_changes_nothing(register):
+    """A note deleted or changed after the batch was checked fails all of it"""
+    client, user_id = register()
+    gone, changed = create(client), create(client)
+    db.store.delete_note(gone)
+    db.store.update_note(changed, {"title": "meanwhile"})
+    before = listing(client)
+    assert NoteRepo.apply_batch([("create", Note(None, "new", "c", user_id)),
+                                 ("update", gone, {"title": "gone"})]) is None
+    assert NoteRepo.apply_batch([("create", Note(None, "new", "c", user_id)),
+                                 ("delete", changed, 1)]) is None
+    assert NoteRepo.apply_batch([("update", changed, {"title": "stale"}, 1)]) is None
+    assert listing(client) == before
+
+def test_refused_batch_hands_out_no_version(register):
+    client, user_id = register()
+    note_id = create(client)
+    etag = client.get(f"/api/notes/{note_id}").headers["ETag"]
+    listed = client.get("/api/notes").headers["ETag"]
+    assert NoteRepo.apply_batch([("update", note_id, {"title": "refused"}, 1), ("delete", 0)]) is None
+    assert client.get(f"/api/notes/{note_id}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/api/notes", headers={"If-None-Match": listed}).status_code == 304
+    r = client.put(f"/api/notes/{note_id}", json={"title": "applied"})
+    assert r.get_json()["note"]["version"] == 2
+
+def test_refused_batch_leaves_no_blobs():
+    db.init_db("memory", blob_threshold=16)
+    try:
+        name = f"blobs-{uuid.uuid4().hex[:8]}"
+        owner = db.store.insert_user(User(None, name, f"{name}@x", "p"))
+        note_id = db.store.insert_note(Note(None, "t", "x" * 32, owner))
+        live = db.store.blobs.stats()["live"]
+        with pytest.raises(KeyError):
+            db.store.apply_batch([("create", Note(None, "t", "y" * 32, owner)),
+                                  ("update", note_id, {"content": "z" * 32}),
+                                  ("delete", 0)])
+        gc.collect()
+        assert db.store.blobs.stats()["live"] == live
+        assert db.store.get_note(note_id).text() == "x" * 32
+        assert db.store.get_note(note_id).version == 1
+    finally:
+        db.close_persistence()
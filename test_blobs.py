@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+from app.models import Note, User
+
+
+@pytest.fixture
+def app(make_app):
+    # Contents of a kilobyte or more go out of line
+    return make_app(DB_BLOB_THRESHOLD=1024)
+
+def create(client, title="title", content="content"):
+    r = client.post("/api/notes", json={"title": title, "content": content})
+    assert r.status_code == 201
+    return r.get_json()["note_id"]
+
+def test_large_contents_round_trip(store):
+    """Contents over the blob threshold read back whole, summaries match them"""
+    name = f"blob-{uuid.uuid4().hex[:8]}"
+    owner = store.insert_user(User(None, name, f"{name}@x", "p"))
+    expected = {}
+    for n in range(6):
+        content = f"{n} ünïcode " * 8000
+        note_id = store.insert_note(Note(None, f"{n}", content, owner))
+        if n % 2:
+            content = content.upper()
+            store.update_note(note_id, {"content": content})
+        expected[note_id] = content
+
+    notes = {note.id: note for note in store.notes_by_owner(owner)}
+    assert {note_id: note.text() for note_id, note in notes.items()} == expected
+    for summary in store.note_summaries(owner):
+        content = expected[summary.id]
+        assert (summary.size, summary.snippet) == (len(content.encode()), content[:100])
+
+def test_listing_sends_summaries_unless_asked_for_content(register):
+    client, _ = register()
+    contents = ["small", "large ünïcode " * 4000]
+    note_ids = [create(client, content=content) for content in contents]
+
+    summaries = client.get("/api/notes").get_json()["notes"]
+    assert [(note["id"], note["size"], note["snippet"]) for note in summaries] == \
+           [(note_id, len(content.encode()), content[:100]) for note_id, content in zip(note_ids, contents)]
+    assert all("content" not in note for note in summaries)
+    notes = client.get("/api/notes?include=content").get_json()["notes"]
+    assert [note["content"] for note in notes] == contents
+    r = client.get(f"/api/notes/{note_ids[1]}")
+    assert r.get_json()["note"]["content"] == contents[1]
+
+@pytest.mark.parametrize("data", [
+    {"title": 1, "content": "c"},
+    {"title": "t", "content": ["c"]},
+    {"title": "t", "content": None},
+    ["t", "c"],
+])
+def test_create_rejects_non_string_fields(register, data):
+    client, _ = register()
+    r = client.post("/api/notes", json=data)
+    assert r.status_code == 400
+    assert client.get("/api/notes").get_json()["notes"] == []
+
+@pytest.mark.parametrize("data, error", [
+    ({"title": 1}, "Title and content must be strings"),
+    ({"content": {"text": "c"}}, "Title and content must be strings"),
+    (["t"], "No data provided"),
+])
+def test_update_rejects_non_string_fields(register, data, error):
+    client, _ = register()
+    note_id = create(client)
+    r = client.put(f"/api/notes/{note_id}", json=data)
+    assert (r.status_code, r.get_json()["error"]) == (400, error)
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["version"] == 1
@@ -0,0 +1,42 @@
+def cache_stats(admin):
+    return admin.get("/api/admin/cache").get_json()["responses"]
+
+def test_listing_is_served_from_cache_until_it_changes(register, admin):
+    client, _ = register()
+    client.post("/api/notes", json={"title": "t", "content": "c"})
+    before = cache_stats(admin)
+    first = client.get("/api/notes").data
+    assert client.get("/api/notes").data == first
+    after = cache_stats(admin)
+    assert (after["misses"] - before["misses"], after["hits"] - before["hits"]) == (1, 1)
+
+    client.post("/api/notes", json={"title": "t2", "content": "c2"})
+    assert len(client.get("/api/notes").get_json()["notes"]) == 2
+
+def test_note_is_served_from_cache_until_it_changes(register, admin):
+    client, _ = register()
+    note_id = client.post("/api/notes", json={"title": "t", "content": "c"}).get_json()["note_id"]
+    client.get(f"/api/notes/{note_id}")
+    before = cache_stats(admin)
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["title"] == "t"
+    assert cache_stats(admin)["hits"] - before["hits"] == 1
+
+    client.put(f"/api/notes/{note_id}", json={"title": "changed"})
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["title"] == "changed"
+    client.delete(f"/api/notes/{note_id}")
+    assert client.get(f"/api/notes/{note_id}").status_code == 404
+
+def test_deleted_users_responses_are_dropped(register, admin):
+    client, user_id = register()
+    note_id = client.post("/api/notes", json={"title": "t", "content": "c"}).get_json()["note_id"]
+    for _ in range(2):
+        assert client.get("/api/notes").status_code == 200
+        assert client.get(f"/api/notes/{note_id}").status_code == 200
+    before = cache_stats(admin)
+
+    assert admin.delete(f"/api/admin/users/{user_id}").status_code == 202
+    after = cache_stats(admin)
+    # The listing and the note were cached for their owner
+    assert after["invalidations"] - before["invalidations"] == 2
+    assert after["entries"] == before["entries"] - 2
+    assert admin.get(f"/api/notes/{note_id}").status_code == 404
@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app import changes
+from app.crud import NoteRepo
+
+
+def follow(client, cursor, timeout=0, **params):
+    r = client.get("/api/notes/changes", query_string=dict(params, since=cursor, timeout=timeout))
+    assert r.status_code == 200
+    body = r.get_json()
+    return [(change["type"], change.get("note_id")) for change in body["changes"]], body["cursor"]
+
+def test_changes_of_own_notes_in_order(register):
+    client, _ = register()
+    other, _ = register()
+    cursor = client.get("/api/notes/changes").get_json()["cursor"]
+    note_id = client.post("/api/notes", json={"title": "t", "content": "c"}).get_json()["note_id"]
+    other.post("/api/notes", json={"title": "t", "content": "c"})
+    client.put(f"/api/notes/{note_id}", json={"title": "changed"})
+    client.delete(f"/api/notes/{note_id}")
+
+    found, cursor = follow(client, cursor)
+    assert found == [("note_created", note_id), ("note_updated", note_id), ("note_deleted", note_id)]
+    assert follow(client, cursor) == ([], cursor)
+
+def test_others_follow_only_as_admin(register, admin):
+    client, user_id = register()
+    other, _ = register()
+    cursor = admin.get("/api/notes/changes", query_string={"owner": user_id}).get_json()["cursor"]
+    note_id = client.post("/api/notes", json={"title": "t", "content": "c"}).get_json()["note_id"]
+    assert follow(admin, cursor, owner=user_id)[0] == [("note_created", note_id)]
+    assert other.get("/api/notes/changes", query_string={"owner": user_id}).status_code == 403
+
+def test_long_poll_returns_with_the_next_change(register):
+    client, user_id = register()
+    cursor = client.get("/api/notes/changes").get_json()["cursor"]
+    created = []
+
+    def write():
+        time.sleep(0.2)
+        created.append(NoteRepo.create("t", "c", user_id))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    started = time.monotonic()
+    found, _ = follow(client, cursor, timeout=10)
+    writer.join()
+    assert found == [("note_created", created[0])]
+    assert time.monotonic() - started < 5
+
+def test_long_poll_times_out(register):
+    client, _ = register()
+    cursor = client.get("/api/notes/changes").get_json()["cursor"]
+    started = time.monotonic()
+    assert follow(client, cursor, timeout=0.2) == ([], cursor)
+    assert time.monotonic() - started >= 0.2
+
+@pytest.mark.parametrize("cursor", ["elsewhere-0", "nonsense", "-1"])
+def test_unknown_cursor_must_resync(register, cursor):
+    client, _ = register()
+    r = client.get("/api/notes/changes", query_string={"since": cursor})
+    assert r.status_code == 410
+    body = r.get_json()
+    assert body["resync"] is True
+    assert follow(client, body["cursor"]) == ([], body["cursor"])
+
+def test_cursor_pushed_out_must_resync(app, register):
+    client, user_id = register()
+    changes.feed.configure(capacity=5)
+    cursor = client.get("/api/notes/changes").get_json()["cursor"]
+    for _ in range(10):
+        NoteRepo.create("t", "c", user_id)
+    r = client.get("/api/notes/changes", query_string={"since": cursor})
+    assert r.status_code == 410
+    assert follow(client, r.get_json()["cursor"])[0] == []
+
+def test_deleted_user_is_reported_once(register, admin):
+    client, user_id = register()
+    cursor = admin.get("/api/notes/changes", query_string={"owner": user_id}).get_json()["cursor"]
+    for _ in range(3):
+        client.post("/api/notes", json={"title": "t", "content": "c"})
+    assert admin.delete(f"/api/admin/users/{user_id}").status_code == 202
+    found, _ = follow(admin, cursor, owner=user_id)
+    assert [event for event, _ in found] == ["note_created"] * 3 + ["user_deleted"]
+
+@pytest.mark.parametrize("make_app", ["sqlite"], indirect=True)
+def test_changes_of_other_processes_are_followed(app, register):
+    """With SQLite, writes made through another connection reach the feed"""
+    client, user_id = register()
+    cursor = client.get("/api/notes/changes").get_json()["cursor"]
+    # Another worker's feed reads on from a cursor handed out here
+    other = changes.SharedChangeFeed()
+    other.configure()
+    assert other.position(cursor) == changes.feed.position(cursor)
+
+    def write():
+        time.sleep(0.2)
+        with sqlite3.connect(app.config["DB_PATH"]) as connection:
+            connection.execute("INSERT INTO notes (title, content, owner_id) VALUES ('t', 'c', ?)", (user_id,))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    found, cursor = follow(client, cursor, timeout=10)
+    writer.join()
+    assert [event for event, _ in found] == ["note_created"]
+    assert other.read(user_id, other.position(cursor)) == ([], changes.feed.last())
+
+def test_memory_feed_reads_each_owner_across_the_ring():
+    feed = changes.ChangeFeed(capacity=4)
+    for n in range(1, 10):
+        feed.append(n % 2, "note_updated", n, 1)
+    # Changes 6 to 9 are left, of owners 0, 1, 0, 1
+    assert feed.read(1, 4) is None
+    assert feed.read(1, 5) == ([(7, 1, "note_updated", 7, 1), (9, 1, "note_updated", 9, 1)], 9)
+    assert feed.read(0, 5, limit=1) == ([(6, 0, "note_updated", 6, 1)], 6)
+    assert feed.read(0, 6) == ([(8, 0, "note_updated", 8, 1)], 9)
+    assert feed.read(2, 5) == ([], 9)
+    assert feed.wait(1, 5, timeout=0)
+    assert not feed.wait(1, 9, timeout=0)
+    # Owners pushed out of the ring leave nothing behind
+    for n in range(4):
+        feed.append(2, "note_updated", n, 1)
+    assert set(feed._index) == {2}
+
+@pytest.mark.parametrize("capacity", [0, -1])
+def test_capacity_below_one_is_refused(make_app, capacity):
+    with pytest.raises(ValueError, match="capacity"):
+        make_app(CHANGES_CAPACITY=capacity)
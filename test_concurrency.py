@@ -0,0 +1,247 @@
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+from app import changes, db
+from app.models import Note, User
+
+THREADS = 16
+# Seconds the read/write race runs for
+DURATION = 1.0
+
+
+@pytest.fixture(autouse=True)
+def fast_switching():
+    """Force thread switches as often as possible so races show up"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+def run_threads(target, count=THREADS):
+    """Run target(i) on `count` threads released at once, re-raising the first error"""
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def run(i):
+        barrier.wait()
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def new_user(store, prefix):
+    name = f"{prefix}-{uuid.uuid4().hex[:8]}"
+    return store.insert_user(User(None, name, f"{name}@x", "p"))
+
+def test_concurrent_registrations(app):
+    """Every registration gets its own id and a taken email is only granted once"""
+    prefix = uuid.uuid4().hex[:8]
+    ids = []
+    statuses = []
+
+    def register(i):
+        client = app.test_client()
+        for n in range(20):
+            r = client.post("/api/register", json={"name": f"{prefix}-{i}-{n}", "email": f"{prefix}-{i}-{n}@x", "password": "p"})
+            assert r.status_code == 201
+            ids.append(r.get_json()["user_id"])
+        r = client.post("/api/register", json={"name": f"{prefix}-same-{i}", "email": f"{prefix}-same@x", "password": "p"})
+        statuses.append(r.status_code)
+
+    run_threads(register)
+    assert len(ids) == len(set(ids)) == THREADS * 20
+    assert sorted(statuses) == [201] + [409] * (THREADS - 1)
+
+def test_concurrent_reads_see_whole_rows(store):
+    """Readers racing writers never fail and never see half of an update"""
+    owner = new_user(store, "rw")
+    note_ids = [store.insert_note(Note(None, "v1", "v1", owner)) for _ in range(20)]
+    deadline = time.monotonic() + DURATION
+
+    def write(i):
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            note_id = note_ids[0] if n % 2 else note_ids[(i + n) % len(note_ids)]
+            note = store.get_note(note_id)
+            try:
+                store.update_note(note_id, {"title": f"v{note.version + 1}", "content": f"v{note.version + 1}"},
+                                  note.version)
+            except db.VersionConflict:
+                pass
+            if n % 10 == 0:
+                store.delete_note(store.insert_note(Note(None, "v1", "v1", owner)))
+
+    def read(i):
+        while time.monotonic() < deadline:
+            note = store.get_note(note_ids[0])
+            assert note.title == note.content == f"v{note.version}"
+            if i % 4 == 1:
+                continue
+            after = None
+            seen = []
+            while True:
+                page = store.notes_by_owner(owner, after, 7)
+                for note in page:
+                    assert note.title == note.content == f"v{note.version}"
+                seen.extend(note.id for note in page)
+                if len(page) < 7:
+                    break
+                after = page[-1].id
+            assert seen == sorted(set(seen))
+            assert set(note_ids) <= set(seen)
+
+    run_threads(lambda i: read(i) if i % 2 else write(i))
+    assert len(store.notes_by_owner(owner)) == len(note_ids)
+
+def test_concurrent_versioned_updates(store):
+    """Of the updates made against the same version exactly one wins"""
+    note_id = store.insert_note(Note(None, "t", "c", new_user(store, "vu")))
+    winners = []
+
+    def update(i):
+        for version in range(1, 21):
+            try:
+                if store.update_note(note_id, {"title": f"{i}"}, version) is not None:
+                    winners.append(version)
+            except db.VersionConflict:
+                pass
+
+    run_threads(update)
+    assert store.get_note(note_id).version == len(winners) + 1
+    assert sorted(winners) == list(range(1, len(winners) + 1))
+
+def test_concurrent_ids_and_unique_columns(store):
+    """Rows created from many threads get distinct, increasing ids, and a
+    unique value is only granted once"""
+    owner = new_user(store, "ni")
+    email = f"{uuid.uuid4().hex[:8]}@x"
+    ids = []
+    taken = []
+
+    def create(i):
+        mine = [store.insert_note(Note(None, "t", "c", owner)) for _ in range(100)]
+        assert mine == sorted(mine)
+        ids.extend(mine)
+        try:
+            taken.append(store.insert_user(User(None, f"{email}-{i}", email, "p")))
+        except db.DuplicateUser:
+            pass
+
+    run_threads(create)
+    assert len(set(ids)) == THREADS * 100
+    assert sorted(note.id for note in store.notes_by_owner(owner)) == sorted(ids)
+    assert len(taken) == 1
+
+def test_concurrent_writes_survive_restart(tmp_path):
+    """Every write acknowledged to any thread is replayed after a restart"""
+    data_dir = str(tmp_path / "data")
+    db.init_db("memory", data_dir=data_dir, fsync="always")
+    owner = new_user(db.store, "wal")
+    written = []
+
+    def write(i):
+        for n in range(50):
+            note_id = db.store.insert_note(Note(None, f"{i}-{n}", "c", owner))
+            if n % 5 == 0:
+                db.store.update_note(note_id, {"content": "updated"})
+            if n % 7 == 0:
+                db.store.delete_note(note_id)
+            else:
+                written.append(note_id)
+
+    run_threads(write)
+    before = {note.id: note for note in db.store.notes_by_owner(owner)}
+    db.init_db("memory", data_dir=data_dir)
+    after = {note.id: note for note in db.store.notes_by_owner(owner)}
+    db.close_persistence()
+    assert sorted(after) == sorted(written)
+    assert after == before
+
+def test_concurrent_patches_of_one_base(store):
+    """Of the patches made against the same version exactly one applies"""
+    owner = new_user(store, "patch")
+    for content in ("short", "long ünïcode " * 8000):
+        note_id = store.insert_note(Note(None, "patched", content, owner))
+        won = []
+
+        def patch(i):
+            for version in range(1, 6):
+                while store.get_note(note_id).version < version:
+                    time.sleep(0)
+                try:
+                    patched = store.patch_note(note_id, owner, [(0, 0, f"{i}:")], version)
+                except db.VersionConflict:
+                    continue
+                won.append((version, i, patched[1]))
+
+        run_threads(patch)
+        assert sorted(version for version, i, checksum in won) == [1, 2, 3, 4, 5]
+        expected = content
+        for version, i, checksum in sorted(won):
+            expected = f"{i}:" + expected
+        assert store.get_note(note_id).text() == expected
+        assert checksum == db.content_checksum(expected)
+
+def test_projections_read_whole_rows(store):
+    """Projected columns always come from one version of a row, passwords never"""
+    owner = new_user(store, "projected")
+    note_ids = [store.insert_note(Note(None, "v1", "v1", owner)) for _ in range(20)]
+
+    def run(i):
+        if i % 2:
+            for n in range(2, 30):
+                note_id = note_ids[(i + n) % len(note_ids)]
+                while True:
+                    version = store.get_note(note_id).version
+                    try:
+                        store.update_note(note_id, {"title": f"v{version + 1}", "content": f"v{version + 1}"}, version)
+                        break
+                    except db.VersionConflict:
+                        pass
+            return
+        for _ in range(30):
+            for note_id, title, content, version, size in store.note_columns(
+                    owner, ("id", "title", "content", "version", "size")):
+                assert title == content == f"v{version}" and size == len(content)
+
+    run_threads(run)
+    with pytest.raises(KeyError):
+        store.user_columns(("id", "password"))
+    assert store.get_user(owner).password == "p"
+
+def test_change_feed_followers_see_every_change():
+    """Readers waiting on the feed see each change of their owner once, in order"""
+    feed = changes.ChangeFeed(capacity=100000, max_waiters=THREADS)
+    writers = THREADS // 2
+    per_writer = 200
+    seen = {}
+
+    def run(i):
+        owner = i % writers
+        if i < writers:
+            for n in range(per_writer):
+                feed.append(owner, "note_updated", owner, n)
+            return
+        position, versions = 0, []
+        while len(versions) < per_writer:
+            assert feed.wait(owner, position, 5)
+            found, position = feed.read(owner, position)
+            versions.extend(change[4] for change in found)
+        seen[owner] = versions
+
+    run_threads(run)
+    assert seen == {owner: list(range(per_writer)) for owner in range(writers)}
+    assert feed.stats()["owners_waiting"] == 0
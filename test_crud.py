@@ -0,0 +1,55 @@
+import uuid
+
+from app import crud
+from app.crud import NoteRepo, UserRepo, query_db
+
+
+def new_user(prefix="crud"):
+    name = f"{prefix}-{uuid.uuid4().hex[:8]}"
+    return UserRepo.create(name, f"{name}@x", "p", False), name
+
+def test_repeated_query_reuses_its_plan(app):
+    first, first_name = new_user()
+    second, second_name = new_user()
+    query = "SELECT * FROM users WHERE id = ?"
+    hits = crud._plan.cache_info().hits
+    assert query_db(query, (first,), one=True)["name"] == first_name
+    assert query_db(query, (second,), one=True)["name"] == second_name
+    assert query_db(query, (0,), one=True) is None
+    assert query_db(query, (second,)) == [query_db(query, (second,), one=True)]
+    assert crud._plan.cache_info().hits - hits >= 3
+
+def test_differing_queries_get_their_own_plans(app):
+    owner, name = new_user()
+    note_ids = [NoteRepo.create(f"t{n}", f"c{n}", owner) for n in range(3)]
+    by_email = query_db("SELECT * FROM users WHERE email = ?", (f"{name}@x",), one=True)
+    by_name = query_db("select *  from users\n where name = ?;", (name,), one=True)
+    assert by_email == by_name
+    assert by_email["id"] == owner
+    notes = query_db("SELECT * FROM notes WHERE owner_id = ?", (owner,))
+    assert [note["id"] for note in notes] == note_ids
+    assert query_db("SELECT * FROM notes WHERE id = ?", (note_ids[1],), one=True)["title"] == "t1"
+
+    assert query_db("UPDATE notes SET title = ?, content = ? WHERE id = ?", ("new", "body", note_ids[0])) is True
+    note = query_db("SELECT * FROM notes WHERE id = ?", (note_ids[0],), one=True)
+    assert (note["title"], note["content"], note["version"]) == ("new", "body", 2)
+    assert query_db("DELETE FROM notes WHERE id = ?", (note_ids[2],)) is True
+    assert query_db("SELECT * FROM notes WHERE id = ?", (note_ids[2],), one=True) is None
+    assert query_db("SELECT COUNT(*) FROM notes") == NoteRepo.count()
+
+def test_returned_rows_are_copies(app):
+    owner, name = new_user()
+    note_id = NoteRepo.create("title", "content", owner)
+    query = "SELECT * FROM notes WHERE id = ?"
+    row = query_db(query, (note_id,), one=True)
+    row["title"] = "changed"
+    row["owner_id"] = 0
+    assert query_db(query, (note_id,), one=True)["title"] == "title"
+    assert NoteRepo.by_id(note_id).owner_id == owner
+    users = query_db("SELECT * FROM users WHERE name = ?", (name,))
+    users[0]["admin"] = True
+    assert UserRepo.by_name(name).admin is False
+
+def test_update_of_unknown_columns_is_not_planned(app):
+    assert crud._plan("UPDATE notes SET owner_id = ? WHERE id = ?") is None
+    assert crud._plan("UPDATE notes SET title = ? WHERE id = ?") is not None
@@ -0,0 +1,79 @@
+import dataclasses
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+
+from app import cache
+from app.encoding import OrjsonProvider, StdlibJSONProvider, json_provider
+
+pytest.importorskip("orjson")
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+@pytest.fixture
+def providers(app):
+    return OrjsonProvider(app), StdlibJSONProvider(app)
+
+@pytest.mark.parametrize("obj", [
+    {"b": 1, "a": [1.5, None, True, "text"], "c": {"z": 0, "y": -1}},
+    {"when": datetime.datetime(2024, 5, 17, 12, 30, 5, tzinfo=datetime.timezone.utc)},
+    {"day": datetime.date(2024, 5, 17)},
+    {"id": uuid.UUID(int=1), "amount": decimal.Decimal("1.10"), "point": Point(1, 2)},
+    {1: "one", 2: "two"},
+    {"big": 2 ** 70},
+    [{"nested": {2: "non-str key deep down"}}],
+])
+def test_orjson_matches_stdlib(providers, obj):
+    fast, stdlib = providers
+    assert fast.encode(obj) == stdlib.encode(obj)
+    assert fast.dumps(obj) == stdlib.dumps(obj)
+    assert fast.dumps(obj, indent=2) == stdlib.dumps(obj, indent=2)
+    assert fast.dumps(obj, separators=(",", ":")) == stdlib.dumps(obj, separators=(",", ":"))
+
+def test_non_ascii_is_written_as_utf8(providers):
+    fast, stdlib = providers
+    obj = {"text": "ünïcode ✓ 😀"}
+    assert fast.encode(obj) == '{"text":"ünïcode ✓ 😀"}'.encode()
+    assert json.loads(fast.encode(obj)) == json.loads(stdlib.encode(obj)) == obj
+
+def test_loads_accepts_what_stdlib_does(providers):
+    fast, _ = providers
+    assert fast.loads('{"a": [1, 2.5, "x"]}') == {"a": [1, 2.5, "x"]}
+    assert fast.loads("[NaN]")[0] != fast.loads("[NaN]")[0]
+
+def test_unknown_provider_is_refused():
+    with pytest.raises(ValueError):
+        json_provider("simplejson")
+    assert json_provider("auto") is OrjsonProvider
+
+def test_responses_match_stdlib(app, register):
+    client, _ = register()
+    for n in range(3):
+        client.post("/api/notes", json={"title": f"t{n}", "content": f"content {n} ünï"})
+    urls = ["/api/notes", "/api/notes?include=content", "/api/notes?fields=id,title,size",
+            "/api/notes?stream=ndjson", "/api/notes/search?q=content"]
+    note_id = client.get("/api/notes").get_json()["notes"][0]["id"]
+    urls.append(f"/api/notes/{note_id}")
+
+    assert isinstance(app.json, OrjsonProvider)
+    fast = [client.get(url).data for url in urls]
+    app.json = StdlibJSONProvider(app)
+    for responses in (cache.responses, cache.fragments, cache.summaries):
+        responses.clear()
+    stdlib = [client.get(url).data for url in urls]
+    for url, fast_body, stdlib_body in zip(urls, fast, stdlib):
+        if "ndjson" in url:
+            assert [json.loads(line) for line in fast_body.splitlines()] == \
+                   [json.loads(line) for line in stdlib_body.splitlines()]
+        else:
+            assert json.loads(fast_body) == json.loads(stdlib_body), url
+        # Only the escaping of non-ASCII text differs
+        assert fast_body.decode() == stdlib_body.decode("unicode_escape"), url
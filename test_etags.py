@@ -0,0 +1,45 @@
+def create(client, title="title", content="content"):
+    r = client.post("/api/notes", json={"title": title, "content": content})
+    assert r.status_code == 201
+    return r.get_json()["note_id"]
+
+def test_unchanged_note_is_not_sent_again(register):
+    client, _ = register()
+    note_id = create(client)
+    r = client.get(f"/api/notes/{note_id}")
+    etag = r.headers["ETag"]
+    r = client.get(f"/api/notes/{note_id}", headers={"If-None-Match": etag})
+    assert (r.status_code, r.data, r.headers["ETag"]) == (304, b"", etag)
+
+    client.put(f"/api/notes/{note_id}", json={"title": "changed"})
+    r = client.get(f"/api/notes/{note_id}", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.get_json()["note"]["title"] == "changed"
+    assert r.headers["ETag"] != etag
+
+def test_unchanged_listing_is_not_sent_again(register):
+    client, _ = register()
+    create(client)
+    etag = client.get("/api/notes").headers["ETag"]
+    assert client.get("/api/notes", headers={"If-None-Match": etag}).status_code == 304
+    # Another representation of the same notes has a tag of its own
+    assert client.get("/api/notes?limit=1", headers={"If-None-Match": etag}).status_code == 200
+
+    create(client)
+    r = client.get("/api/notes", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert len(r.get_json()["notes"]) == 2
+
+def test_update_with_stale_etag_fails(register):
+    client, _ = register()
+    note_id = create(client)
+    etag = client.get(f"/api/notes/{note_id}").headers["ETag"]
+    r = client.put(f"/api/notes/{note_id}", json={"title": "first"}, headers={"If-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+    r = client.put(f"/api/notes/{note_id}", json={"title": "second"}, headers={"If-Match": etag})
+    assert r.status_code == 412
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["title"] == "first"
+    r = client.put(f"/api/notes/{note_id}", json={"title": "second"}, headers={"If-Match": "*"})
+    assert r.status_code == 200
@@ -0,0 +1,67 @@
+import time
+
+from app.crud import JobRepo, UserRepo
+from app.jobs import JobRunner
+
+
+def wait_for_job(admin, location, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = admin.get(location).get_json()["job"]
+        if job["status"] in ("done", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+def test_deleted_user_is_gone_before_their_notes_are(register, admin):
+    client, user_id = register()
+    note_ids = [client.post("/api/notes", json={"title": f"t{n}", "content": "c"}).get_json()["note_id"]
+                for n in range(3)]
+    r = admin.delete(f"/api/admin/users/{user_id}")
+    assert r.status_code == 202
+    assert r.headers["Location"] == f"/api/admin/jobs/{r.get_json()['job_id']}"
+    # Their session and notes stop working straight away
+    assert client.get("/api/notes").status_code == 401
+    assert admin.get(f"/api/notes/{note_ids[0]}").status_code == 404
+
+    job = wait_for_job(admin, r.headers["Location"])
+    assert (job["status"], job["total"], job["done"], job["error"]) == ("done", 3, 3, None)
+    assert admin.delete(f"/api/admin/users/{user_id}").status_code == 404
+
+def test_deleted_users_name_can_be_taken_again(app, register, admin):
+    _, user_id = register("reused")
+    user, = admin.get("/api/admin/users", query_string={"after": user_id - 1, "limit": 1}).get_json()["users"]
+    r = admin.delete(f"/api/admin/users/{user_id}")
+    assert wait_for_job(admin, r.headers["Location"])["status"] == "done"
+    r = app.test_client().post("/api/register", json={"name": user["name"], "email": user["email"], "password": "p"})
+    assert r.status_code == 201
+    assert r.get_json()["user_id"] != user_id
+
+def test_job_is_claimed_by_one_runner(app):
+    job = JobRepo.create("delete_user", 0)
+    assert JobRepo.claim(job.id, "first", 60).owner == "first"
+    assert JobRepo.claim(job.id, "second", 60) is None
+    # The holder renews its lease, the others wait for it to run out
+    assert JobRepo.claim(job.id, "first", -1).status == "running"
+    assert JobRepo.claim(job.id, "second", 60).owner == "second"
+    JobRepo.finish(job.id)
+    assert JobRepo.claim(job.id, "second", 60) is None
+    assert JobRepo.by_id(job.id).status == "done"
+
+def test_runner_leaves_a_held_job_until_its_lease_runs_out(register, admin):
+    client, user_id = register()
+    client.post("/api/notes", json={"title": "t", "content": "c"})
+    job = JobRepo.create("delete_user", user_id, UserRepo.hide(user_id))
+    JobRepo.claim(job.id, "elsewhere", 60)
+
+    runner = JobRunner(lease=0.05)
+    runner.start()
+    assert runner.wait(timeout=5)
+    job = JobRepo.by_id(job.id)
+    assert (job.status, job.owner, job.done) == ("running", "elsewhere", 0)
+
+    # A stopped process never renews its lease, and an idle runner takes over
+    JobRepo.claim(job.id, "elsewhere", -1)
+    assert wait_for_job(admin, f"/api/admin/jobs/{job.id}")["status"] == "done"
+    assert JobRepo.by_id(job.id).done == 1
+    # Leave the runner idle, rather than scanning for the jobs of later tests
+    runner.lease = 3600
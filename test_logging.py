@@ -0,0 +1,51 @@
+import logging
+
+import pytest
+
+from app import log
+
+
+class Capture(logging.Handler):
+    """Keeps the records that reach the root logger"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def capture():
+    handler = Capture()
+    yield handler
+    logging.getLogger().removeHandler(handler)
+
+def access_records(capture):
+    return [record for record in capture.records if record.name == "app.access"]
+
+def test_requests_are_logged_with_their_id(make_app, capture):
+    app = make_app(LOG_LEVEL="INFO")
+    # After the app's own handler, which stamps the request id
+    logging.getLogger().addHandler(capture)
+    r = app.test_client().get("/api/status")
+    record, = access_records(capture)
+    assert record.request_id == r.headers["X-Request-ID"]
+    assert record.getMessage().startswith("127.0.0.1 GET /api/status 200 ")
+
+def test_access_log_follows_the_level(make_app, capture):
+    app = make_app(LOG_LEVEL="WARNING")
+    logging.getLogger().addHandler(capture)
+    app.test_client().get("/api/status")
+    assert access_records(capture) == []
+    # Werkzeug's own request lines are held to the same level
+    assert logging.getLogger("werkzeug").getEffectiveLevel() == logging.WARNING
+
+def test_access_log_is_sampled(make_app, capture):
+    app = make_app(LOG_LEVEL="INFO", LOG_SAMPLING='{"app.access": 0}')
+    logging.getLogger().addHandler(capture)
+    sampled_out = log.stats()["sampled_out"]
+    client = app.test_client()
+    for _ in range(5):
+        client.get("/api/status")
+    assert log.stats()["sampled_out"] - sampled_out == 5
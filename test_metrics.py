@@ -0,0 +1,45 @@
+def scrape(client):
+    r = client.get("/api/metrics")
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    samples = {}
+    for line in r.get_data(as_text=True).splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+def delta(before, after, name):
+    return after.get(name, 0) - before.get(name, 0)
+
+def test_requests_are_counted_and_timed(app, register):
+    client, _ = register()
+    before = scrape(app.test_client())
+    for _ in range(3):
+        assert client.get("/api/notes").status_code == 200
+    assert client.get("/api/notes/0").status_code == 404
+    after = scrape(app.test_client())
+
+    route = 'method="GET",route="/api/notes"'
+    assert delta(before, after, f'notes_http_requests_total{{{route},status="200"}}') == 3
+    assert delta(before, after, 'notes_http_requests_total{method="GET",route="/api/notes/<int:note_id>",'
+                                'status="404"}') == 1
+    assert delta(before, after, f"notes_http_request_duration_seconds_count{{{route}}}") == 3
+    assert delta(before, after, f'notes_http_request_duration_seconds_bucket{{{route},le="+Inf"}}') == 3
+    assert delta(before, after, f"notes_http_request_duration_seconds_sum{{{route}}}") > 0
+    # Buckets are cumulative
+    buckets = [value for name, value in after.items()
+               if name.startswith(f"notes_http_request_duration_seconds_bucket{{{route},")]
+    assert buckets == sorted(buckets)
+    # The scrape that is being answered is in flight, the others are done
+    assert after[f"notes_http_requests_in_flight{{{route}}}"] == 0
+
+def test_store_operations_are_timed(app, register):
+    client, _ = register()
+    backend = app.config["DB_BACKEND"]
+    before = scrape(app.test_client())
+    client.post("/api/notes", json={"title": "t", "content": "c"})
+    after = scrape(app.test_client())
+    labels = f'backend="{backend}",op="insert_note"'
+    assert delta(before, after, f"notes_store_operation_duration_seconds_count{{{labels}}}") == 1
+    assert delta(before, after, f"notes_store_rows_returned_total{{{labels}}}") == 1
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from app import routes
+
+
+@pytest.fixture
+def notes(register):
+    """A user with seven notes, and the ids of those notes"""
+    client, _ = register("paged")
+    note_ids = [client.post("/api/notes", json={"title": f"t{n}", "content": f"c{n}"}).get_json()["note_id"]
+                for n in range(7)]
+    return client, note_ids
+
+def pages(client, limit, **params):
+    after = None
+    seen = []
+    while True:
+        query = dict(params, limit=limit) if after is None else dict(params, limit=limit, after=after)
+        body = client.get("/api/notes", query_string=query).get_json()
+        seen.append([note["id"] for note in body["notes"]])
+        after = body["next_after"]
+        if after is None:
+            return seen
+
+def test_pages_end_at_their_limit(notes):
+    client, note_ids = notes
+    assert pages(client, 3) == [note_ids[0:3], note_ids[3:6], note_ids[6:]]
+    assert pages(client, 7) == [note_ids, []]
+    assert pages(client, 8) == [note_ids]
+    assert pages(client, 2, include="content")[0] == note_ids[0:2]
+
+def test_after_starts_past_that_id(notes):
+    client, note_ids = notes
+    body = client.get("/api/notes", query_string={"after": note_ids[4]}).get_json()
+    assert [note["id"] for note in body["notes"]] == note_ids[5:]
+    assert "next_after" not in body
+    body = client.get("/api/notes", query_string={"after": note_ids[-1], "limit": 5}).get_json()
+    assert body == {"notes": [], "next_after": None}
+
+@pytest.mark.parametrize("query", [{"after": "x"}, {"limit": "0"}, {"limit": "1001"}, {"limit": "-1"},
+                                   {"limit": "1.5"}])
+def test_invalid_paging_is_refused(notes, query):
+    client, _ = notes
+    assert client.get("/api/notes", query_string=query).status_code == 400
+
+@pytest.mark.parametrize("params", [{}, {"include": "content"}, {"fields": "id,title"}, {"limit": 5},
+                                    {"after": 0, "limit": 6}])
+def test_streams_match_the_listing(notes, monkeypatch, params):
+    client, note_ids = notes
+    # Small chunks, so streams cross several of them
+    monkeypatch.setattr(routes, "STREAM_CHUNK_SIZE", 2)
+    if "after" in params:
+        params = dict(params, after=note_ids[0])
+    expected = client.get("/api/notes", query_string=params).get_json()["notes"]
+
+    r = client.get("/api/notes", query_string=dict(params, stream="json"))
+    assert r.mimetype == "application/json"
+    assert json.loads(r.data) == {"notes": expected}
+
+    r = client.get("/api/notes", query_string=dict(params, stream="ndjson"))
+    assert r.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in r.data.splitlines()] == expected
+
+def test_users_are_paged_and_streamed(admin, register):
+    user_ids = [register("listed")[1] for _ in range(3)]
+    body = admin.get("/api/admin/users", query_string={"after": user_ids[0] - 1, "limit": 2}).get_json()
+    assert [user["id"] for user in body["users"]] == user_ids[:2]
+    assert body["next_after"] == user_ids[1]
+    body = admin.get("/api/admin/users", query_string={"after": user_ids[1], "limit": 2}).get_json()
+    assert [user["id"] for user in body["users"]][:1] == user_ids[2:]
+
+    r = admin.get("/api/admin/users", query_string={"after": user_ids[0] - 1, "stream": "ndjson", "limit": 3})
+    assert [json.loads(line)["id"] for line in r.data.splitlines()] == user_ids
+    assert all("password" not in json.loads(line) for line in r.data.splitlines())
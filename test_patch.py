@@ -0,0 +1,63 @@
+import pytest
+
+from app import db
+
+
+def create(client, title="title", content="content"):
+    r = client.post("/api/notes", json={"title": title, "content": content})
+    assert r.status_code == 201
+    return r.get_json()["note_id"]
+
+def test_patch(register):
+    client, _ = register()
+    note_id = create(client, content="hello world")
+    r = client.patch(f"/api/notes/{note_id}", json={"base_version": 1, "edits": [[0, 5, "goodbye"], [11, 11, "!"]]})
+    assert r.status_code == 200
+    assert r.get_json() == {"version": 2, "checksum": db.content_checksum("goodbye world!")}
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["content"] == "goodbye world!"
+
+def test_patch_of_stale_version_conflicts(register):
+    client, _ = register()
+    note_id = create(client, content="hello")
+    client.put(f"/api/notes/{note_id}", json={"content": "hello again"})
+    r = client.patch(f"/api/notes/{note_id}", json={"base_version": 1, "edits": [[0, 0, ">"]]})
+    assert r.status_code == 409
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["content"] == "hello again"
+
+@pytest.mark.parametrize("data", [
+    {"base_version": 1, "edits": [[0, 99, "x"]]},
+    {"base_version": 1, "edits": [[3, 1, "x"]]},
+    {"base_version": 1, "edits": [[2, 3, "x"], [0, 1, "y"]]},
+    {"base_version": 1, "edits": []},
+    {"base_version": "1", "edits": [[0, 0, "x"]]},
+    {"edits": [[0, 0, "x"]]},
+    ["not", "an", "object"],
+])
+def test_invalid_patch_is_rejected(register, data):
+    client, _ = register()
+    note_id = create(client, content="hello")
+    r = client.patch(f"/api/notes/{note_id}", json=data)
+    assert r.status_code == 400
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["version"] == 1
+
+def test_patch_of_another_users_note(register):
+    owner, _ = register()
+    other, _ = register()
+    note_id = create(owner)
+    assert other.patch(f"/api/notes/{note_id}", json={"base_version": 1, "edits": [[0, 0, "x"]]}).status_code == 403
+    db.store.delete_note(note_id)
+    assert owner.patch(f"/api/notes/{note_id}", json={"base_version": 1, "edits": [[0, 0, "x"]]}).status_code == 404
+
+def test_patch_of_large_content(make_app):
+    app = make_app(DB_BLOB_THRESHOLD=1024)
+    client = app.test_client()
+    client.post("/api/login", json={"email": "admin@example.com", "password": "admin123"})
+    content = "line ünïcode\n" * 2000
+    note_id = create(client, content=content)
+    expected = content[:13] + "changed\n" + content[26:] + "end"
+    r = client.patch(f"/api/notes/{note_id}", json={"base_version": 1,
+                                                    "edits": [[13, 25, "changed"], [len(content), len(content), "end"]]})
+    assert r.get_json() == {"version": 2, "checksum": db.content_checksum(expected)}
+    assert client.get(f"/api/notes/{note_id}").get_json()["note"]["content"] == expected
+    summary, = [note for note in client.get("/api/notes").get_json()["notes"] if note["id"] == note_id]
+    assert summary["size"] == len(expected.encode())
@@ -0,0 +1,78 @@
+import pstats
+import threading
+import time
+
+from app import profiling
+
+
+def test_admin_asks_for_a_profile(admin, tmp_path):
+    r = admin.get("/api/notes", headers={"X-Profile": "1"})
+    assert r.status_code == 200
+    profile_id = r.headers["X-Profile-ID"]
+    capture, = [capture for capture in admin.get("/api/admin/profiles").get_json()["profiles"]
+                if capture["id"] == profile_id]
+    assert (capture["trigger"], capture["kind"], capture["path"]) == ("header", "cprofile", "/api/notes")
+    assert capture["store_seconds"] > 0 and capture["serialization_seconds"] >= 0
+
+    r = admin.get(f"/api/admin/profiles/{profile_id}")
+    assert r.status_code == 200
+    path = tmp_path / "download.prof"
+    path.write_bytes(r.data)
+    assert pstats.Stats(str(path)).total_calls > 0
+
+def test_only_admins_get_profiles(register, admin):
+    client, _ = register()
+    r = client.get("/api/notes", headers={"X-Profile": "1"})
+    assert r.status_code == 200
+    assert "X-Profile-ID" not in r.headers
+    assert client.get("/api/admin/profiles").status_code == 403
+    assert admin.get("/api/admin/profiles/unknown").status_code == 404
+
+def test_slow_requests_sampled_while_others_run(tmp_path):
+    """Only requests over the threshold are written, with samples of their own stack"""
+    profiler = profiling.Profiler()
+    profiler.configure(slow_threshold=0.05, interval=0.001, directory=str(tmp_path), max_files=8)
+
+    def slow_request():
+        time.sleep(0.1)
+
+    def run(i):
+        handle = profiler.begin()
+        started = time.perf_counter()
+        if i % 2:
+            slow_request()
+        profiler.finish(handle, "GET", f"/{i}", 200, time.perf_counter() - started)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    captures = profiler.captures()
+    assert sorted(capture["path"] for capture in captures) == ["/1", "/3", "/5", "/7"]
+    for capture in captures:
+        assert capture["kind"] == "sampled" and capture["samples"] > 0
+        with open(tmp_path / capture["file"]) as f:
+            assert any("slow_request" in line for line in f)
+    assert profiler.stats()["in_flight"] == 0
+
+def test_sampled_profile_ids_are_not_sent(make_app):
+    app = make_app(PROFILE_SAMPLE_RATE=1)
+    r = app.test_client().get("/")
+    assert r.status_code == 200
+    assert "X-Profile-ID" not in r.headers
+    assert [capture["trigger"] for capture in profiling.profiler.captures()] == ["sample"]
+
+def test_ring_keeps_the_newest_captures(tmp_path):
+    profiler = profiling.Profiler()
+    profiler.configure(directory=str(tmp_path), max_files=2)
+    for i in range(3):
+        profiler.finish(profiler.begin(requested=True), "GET", f"/{i}", 200, 0.01)
+    assert [capture["path"] for capture in profiler.captures()] == ["/2", "/1"]
+    assert len(list(tmp_path.iterdir())) == 4
+
+def test_nothing_is_watched_when_disabled():
+    profiler = profiling.Profiler()
+    profiler.configure()
+    assert profiler.begin() is None
+    assert profiler.stats()["in_flight"] == 0
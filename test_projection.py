@@ -0,0 +1,46 @@
+import zlib
+
+import pytest
+
+
+@pytest.fixture
+def notes(register):
+    client, user_id = register()
+    for n in range(3):
+        client.post("/api/notes", json={"title": f"t{n}", "content": f"content {n} ünï"})
+    return client, user_id
+
+def test_notes_have_only_the_fields_asked_for(notes):
+    client, user_id = notes
+    full = client.get("/api/notes?include=content").get_json()["notes"]
+    body = client.get("/api/notes?fields=title,id,content").get_json()
+    assert body["notes"] == [{"id": note["id"], "title": note["title"], "content": note["content"]}
+                             for note in full]
+    summaries = client.get("/api/notes?fields=size,snippet,owner_id,version&limit=2").get_json()
+    assert summaries["notes"] == [{"size": len(note["content"].encode()), "snippet": note["content"],
+                                   "owner_id": user_id, "version": 1} for note in full[:2]]
+    assert summaries["next_after"] == full[1]["id"]
+
+@pytest.mark.parametrize("fields", ["password", "id,password", "", "id,"])
+def test_unknown_note_fields_are_refused(notes, fields):
+    client, _ = notes
+    r = client.get("/api/notes", query_string={"fields": fields})
+    assert r.status_code == 400
+    assert "expected some of" in r.get_json()["error"]
+
+def test_unknown_fields_are_refused_before_the_etag_matches(notes):
+    client, _ = notes
+    etag = client.get("/api/notes").headers["ETag"]
+    assert client.get("/api/notes", headers={"If-None-Match": etag}).status_code == 304
+    # The tag the listing would have under ?fields=password, which differs
+    # only in the checksum of the query string
+    etag = f'{etag.rsplit("-", 1)[0]}-{zlib.crc32(b"fields=password"):08x}"'
+    r = client.get("/api/notes?fields=password", headers={"If-None-Match": etag})
+    assert r.status_code == 400
+
+def test_users_have_only_public_fields(admin):
+    users = admin.get("/api/admin/users").get_json()["users"]
+    assert users and all(set(user) == {"id", "name", "email", "admin"} for user in users)
+    users = admin.get("/api/admin/users?fields=name,id").get_json()["users"]
+    assert all(set(user) == {"id", "name"} for user in users)
+    assert admin.get("/api/admin/users?fields=password").status_code == 400
@@ -0,0 +1,91 @@
+import pytest
+
+from app import ratelimit
+from app.ratelimit import RateLimiter
+
+
+@pytest.fixture
+def app(make_app):
+    # Registering and logging in take 10 tokens of the client's 20, which
+    # never refill; each user gets 3 requests and then one every 2 seconds
+    return make_app(RATE_LIMIT_ENABLED="true", RATE_LIMIT_USER_RATE=0.5, RATE_LIMIT_USER_BURST=3,
+                    RATE_LIMIT_CLIENT_RATE=0, RATE_LIMIT_CLIENT_BURST=20, RATE_LIMIT_IDLE_TIMEOUT=300)
+
+def test_user_over_their_share_is_told_to_retry(register):
+    client, _ = register()
+    for _ in range(3):
+        assert client.get("/api/notes").status_code == 200
+    r = client.get("/api/notes")
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == "2"
+    assert r.get_json()["retry_after"] == 2
+
+def test_refused_requests_cost_the_client_nothing(register, login):
+    client, _ = register()
+    for _ in range(3):
+        client.get("/api/notes")
+    for _ in range(20):
+        r = client.get("/api/notes")
+        assert (r.status_code, r.headers["Retry-After"]) == (429, "2")
+    # The client has 7 tokens left, enough for another login
+    login("admin@example.com", "admin123")
+    assert ratelimit.admission.clients.stats()["limited"] == 0
+
+def test_client_out_of_tokens_is_refused(app, register):
+    client, _ = register()
+    anonymous = app.test_client()
+    for _ in range(2):
+        assert anonymous.post("/api/login", json={"email": "nobody@x", "password": "p"}).status_code == 401
+    r = anonymous.post("/api/login", json={"email": "nobody@x", "password": "p"})
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == "300"
+
+def test_rate_zero_refills_after_idle_timeout():
+    limiter = RateLimiter(0, 2, idle_timeout=10)
+    assert limiter.take("a", now=0) == limiter.take("a", now=0) == 0
+    assert limiter.take("a", now=1) == 10
+    # Every attempt counts as use, the bucket only refills once left alone
+    assert limiter.take("a", now=9) == 10
+    assert limiter.take("a", now=19) == 0
+    assert limiter.take("b", now=19) == 0
+
+def test_rate_limiter_refills_at_rate():
+    limiter = RateLimiter(2, 4)
+    for _ in range(4):
+        assert limiter.take("a", now=0) == 0
+    assert limiter.take("a", 2, now=0) == 1
+    assert limiter.take("a", 2, now=1) == 0
+
+@pytest.mark.parametrize("rate, burst", [(-1, 10), (1, 0)])
+def test_invalid_limits_are_refused(rate, burst):
+    with pytest.raises(ValueError):
+        RateLimiter(rate, burst)
+
+def test_refusal_by_user_is_given_back_to_client():
+    admission = ratelimit.Admission()
+    admission.configure(user_rate=0, user_burst=1, client_rate=0, client_burst=3)
+    assert admission.check("get_notes", 1, "addr") is None
+    assert admission.check("get_notes", 1, "addr") == ("user", 300)
+    assert admission.check("get_notes", 1, "addr") == ("user", 300)
+    assert admission.check("get_notes", 2, "addr") is None
+    assert admission.check("get_notes", 3, "addr") is None
+    assert admission.check("get_notes", 4, "addr") == ("client", 300)
+
+def test_idle_and_surplus_buckets_are_evicted():
+    limiter = RateLimiter(1, 5, max_buckets=3, idle_timeout=10)
+    for key in "abc":
+        limiter.take(key, now=0)
+    limiter.take("d", now=1)
+    assert limiter.stats()["buckets"] == 3
+    limiter.take("b", now=2)
+    limiter.take("e", now=20)
+    assert (limiter.stats()["buckets"], limiter.stats()["evictions"]) == (1, 4)
+
+def test_route_costs_are_configured(make_app):
+    app = make_app(RATE_LIMIT_ENABLED="true", RATE_LIMIT_CLIENT_RATE=0, RATE_LIMIT_CLIENT_BURST=4,
+                   RATE_LIMIT_COSTS='{"root": 0, "get_notes": 3}')
+    client = app.test_client()
+    for _ in range(10):
+        assert client.get("/").status_code == 200
+    assert client.get("/api/notes").status_code == 401
+    assert client.get("/api/notes").status_code == 429
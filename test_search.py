@@ -0,0 +1,47 @@
+import uuid
+
+
+def search(client, query):
+    r = client.get("/api/notes/search", query_string={"q": query})
+    assert r.status_code == 200
+    return [result["note"]["id"] for result in r.get_json()["results"]]
+
+def create(client, title, content):
+    return client.post("/api/notes", json={"title": title, "content": content}).get_json()["note_id"]
+
+def test_search_ranks_titles_first(register):
+    client, _ = register()
+    term = uuid.uuid4().hex[:8]
+    in_content = create(client, "plain", f"about {term} and more")
+    in_title = create(client, f"{term} notes", "nothing here")
+    create(client, "other", "unrelated")
+    assert search(client, term) == [in_title, in_content]
+    assert search(client, f"{term} more") == [in_content]
+    assert search(client, f"{term} missing") == []
+
+def test_search_sees_only_own_notes(register):
+    client, user_id = register()
+    other, other_id = register()
+    term = uuid.uuid4().hex[:8]
+    mine = create(client, "mine", term)
+    create(other, "theirs", term)
+    create(other, "theirs", f"{user_id} {term}")
+    assert search(client, term) == [mine]
+    # Owner ids are not searchable terms
+    assert search(client, str(user_id)) == []
+    assert search(other, str(other_id)) == []
+
+def test_search_follows_changes(register):
+    client, _ = register()
+    old, new = uuid.uuid4().hex[:8], uuid.uuid4().hex[:8]
+    note_id = create(client, "t", old)
+    assert search(client, old) == [note_id]
+    client.put(f"/api/notes/{note_id}", json={"content": new})
+    assert search(client, old) == []
+    assert search(client, new) == [note_id]
+    client.delete(f"/api/notes/{note_id}")
+    assert search(client, new) == []
+
+def test_search_needs_a_query(register):
+    client, _ = register()
+    assert client.get("/api/notes/search", query_string={"q": " "}).status_code == 400
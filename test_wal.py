@@ -0,0 +1,118 @@
+import marshal
+import os
+import time
+import zlib
+
+import pytest
+
+from app import db, wal
+from app.models import Job, Note, Token, User
+
+META = {"epoch": "feed", "secret_key": "secret"}
+USERS = [(1, "admin", "admin@x", "p", True, False)]
+NOTES = [(1, "title", "content ünïcode", 1, 1)]
+
+
+def test_snapshot_round_trip(tmp_path):
+    wal.write_snapshot(str(tmp_path), 7, META, USERS, NOTES)
+    assert wal.read_snapshot(str(tmp_path)) == (7, META, USERS, NOTES)
+
+def test_snapshot_of_format_1_is_read(tmp_path):
+    """Snapshots written before the header named a marshal version still load"""
+    wal.write_snapshot(str(tmp_path), 7, META, USERS, NOTES)
+    path = tmp_path / wal.SNAPSHOT_FILE
+    sections = path.read_bytes()[wal.SNAPSHOT_HEADER.size:]
+    path.write_bytes(wal.SNAPSHOT_HEADER_V1.pack(wal.SNAPSHOT_MAGIC, 1, 7) + sections)
+    assert wal.read_snapshot(str(tmp_path)) == (7, META, USERS, NOTES)
+
+def test_snapshot_in_newer_marshal_version_is_refused(tmp_path):
+    wal.write_snapshot(str(tmp_path), 7, META, USERS, NOTES)
+    path = tmp_path / wal.SNAPSHOT_FILE
+    data = path.read_bytes()
+    header = wal.SNAPSHOT_HEADER.pack(wal.SNAPSHOT_MAGIC, wal.SNAPSHOT_FORMAT, 7, marshal.version + 1)
+    path.write_bytes(header + data[wal.SNAPSHOT_HEADER.size:])
+    with pytest.raises(RuntimeError, match="marshal format"):
+        wal.read_snapshot(str(tmp_path))
+
+def test_log_round_trip(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path), fsync="never")
+    log.append(("insert_note", 1, "title", "content"))
+    log.append(("delete_note", 1))
+    log.close()
+    assert list(wal.replay(str(tmp_path))) == [(1, ("insert_note", 1, "title", "content")),
+                                               (2, ("delete_note", 1))]
+    assert list(wal.replay(str(tmp_path), after=1)) == [(2, ("delete_note", 1))]
+
+def test_log_segment_without_header_is_replayed(tmp_path):
+    """Segments written before they started with a header still replay"""
+    payload = marshal.dumps((1, "delete_note", 1))
+    with open(tmp_path / wal._segment_name(0), "wb") as f:
+        f.write(wal.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    assert list(wal.replay(str(tmp_path))) == [(1, ("delete_note", 1))]
+
+def test_log_in_newer_marshal_version_is_refused(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path), fsync="never")
+    log.append(("delete_note", 1))
+    log.close()
+    path = tmp_path / wal._segment_name(0)
+    data = path.read_bytes()
+    path.write_bytes(wal.SEGMENT_HEADER.pack(wal.SEGMENT_MAGIC, marshal.version + 1)
+                     + data[wal.SEGMENT_HEADER.size:])
+    with pytest.raises(RuntimeError, match="marshal format"):
+        list(wal.replay(str(tmp_path)))
+    assert path.read_bytes()[wal.SEGMENT_HEADER.size:] == data[wal.SEGMENT_HEADER.size:]
+
+def test_torn_write_is_truncated(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path), fsync="never")
+    log.append(("delete_note", 1))
+    log.append(("delete_note", 2))
+    log.close()
+    path = tmp_path / wal._segment_name(0)
+    os.truncate(path, os.path.getsize(path) - 1)
+    assert list(wal.replay(str(tmp_path))) == [(1, ("delete_note", 1))]
+    assert list(wal.replay(str(tmp_path))) == [(1, ("delete_note", 1))]
+
+@pytest.fixture
+def reopen(tmp_path):
+    """Opens the memory store on a data directory, closing it first if open"""
+    def reopen():
+        db.close_persistence()
+        db.init_db("memory", data_dir=str(tmp_path / "data"), fsync="always")
+        return db.store
+
+    yield reopen
+    db.close_persistence()
+
+def written(store):
+    """Every kind of write the store logs, returns what they left"""
+    owner = store.insert_user(User(None, "restart", "restart@x", "p"))
+    kept = store.insert_note(Note(None, "kept", "content", owner))
+    gone = store.insert_note(Note(None, "gone", "content", owner))
+    store.update_note(kept, {"title": "renamed"})
+    store.apply_batch([("create", Note(None, "batched", "c", owner)), ("delete", gone, 1)])
+    store.insert_token(Token("hash", owner, time.time() + 60))
+    store.create_job(Job("job", "delete_user", owner))
+    store.claim_job("job", "runner", 123.0, 0)
+    return owner
+
+def state(store, owner):
+    notes = [(note.id, note.title, note.text(), note.version) for note in store.notes_by_owner(owner)]
+    token = store.get_token("hash", time.time())
+    return notes, token.user_id, store.get_job("job").to_tuple(), store.auth_version()
+
+def test_writes_survive_a_restart(reopen):
+    store = reopen()
+    owner = written(store)
+    expected = state(store, owner)
+    assert state(reopen(), owner) == expected
+
+def test_writes_after_a_snapshot_survive_a_restart(reopen):
+    store = reopen()
+    owner = written(store)
+    db.persistence.snapshot()
+    store.update_note(store.notes_by_owner(owner)[0].id, {"content": "after the snapshot"})
+    expected = state(store, owner)
+    assert state(reopen(), owner) == expected
+    # And from a snapshot alone
+    db.persistence.snapshot()
+    assert state(reopen(), owner) == expected